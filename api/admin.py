@@ -100,3 +100,89 @@ class CalendarEventAdmin(admin.ModelAdmin):
     'end_ts',
     'event_location',
   ]
+
+
+@admin.register(mdl.WatchUpload)
+class WatchUploadAdmin(admin.ModelAdmin):
+  list_display = [
+    'user',
+    'timestamp',
+    'kind',
+    'size',
+    'digest',
+    'segment',
+  ]
+
+
+@admin.register(mdl.Job)
+class JobAdmin(admin.ModelAdmin):
+  list_display = [
+    'id',
+    'name',
+    'status',
+    'attempts',
+    'created_ts',
+    'started_ts',
+    'finished_ts',
+  ]
+  list_filter = ['status', 'name']
+
+
+@admin.register(mdl.MinuteSummary)
+class MinuteSummaryAdmin(admin.ModelAdmin):
+  list_display = [
+    'user',
+    'timestamp',
+    'ppg_count',
+    'heart_rate',
+    'acc_count',
+    'acc_mean',
+    'acc_std',
+    'acc_enmo',
+  ]
+
+
+@admin.register(mdl.EmaSchedule)
+class EmaScheduleAdmin(admin.ModelAdmin):
+  list_display = [
+    'user',
+    'planned_ts',
+    'sent_ts',
+    'status',
+  ]
+  list_filter = ['status']
+
+
+@admin.register(mdl.PushWorker)
+class PushWorkerAdmin(admin.ModelAdmin):
+  list_display = [
+    'name',
+    'heartbeat_ts',
+  ]
+
+
+@admin.register(mdl.PushDelivery)
+class PushDeliveryAdmin(admin.ModelAdmin):
+  list_display = [
+    'user',
+    'source',
+    'planned_ts',
+    'sent_ts',
+    'fcm_latency_ms',
+    'outcome',
+    'response_latency_ms',
+  ]
+  list_filter = ['source', 'outcome']
+
+
+@admin.register(mdl.ResponseMetric)
+class ResponseMetricAdmin(admin.ModelAdmin):
+  list_display = [
+    'user',
+    'day_ts',
+    'pushes',
+    'delivered',
+    'responded',
+    'response_p50_ms',
+    'lag_p95_ms',
+  ]
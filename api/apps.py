@@ -7,3 +7,4 @@ class ApiConfig(AppConfig):
 
   def ready(self):
     from api import signals   # noqa -- create token when user signs up
+    from api import tasks   # noqa -- register background job handlers
@@ -0,0 +1,19 @@
+from django.urls import path
+from api import async_views
+from api import urls
+
+# streamed responses are collected whole under ASGI (an export would be held in memory): served by the dashboard pool (WSGI)
+SYNC_ONLY_URLS = {'exportWatchDataApi'}
+
+urlpatterns = [
+   # file views (slow uploads from phones and watches)
+  path('submit_ppg', async_views.InsertPPG.as_view(), name = 'submitPPGApi'),
+  path('submit_acc', async_views.InsertAcc.as_view(), name = 'submitAccApi'),
+  path('submit_off_body', async_views.InsertOffBody.as_view(), name = 'submitOffBodyApi'),
+
+   # resumable file upload views
+  path('upload_session/<str:session_id>', async_views.UploadSessionChunk.as_view(), name = 'uploadSessionApi'),
+
+   # the other api views (short requests) stay sync
+  *[x for x in urls.urlpatterns if x.name not in SYNC_ONLY_URLS],
+]
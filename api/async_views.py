@@ -0,0 +1,131 @@
+from typing import Optional
+import math
+
+from asgiref.sync import sync_to_async
+from django.http import HttpResponse, JsonResponse
+from django.views import View
+from django.views.decorators.csrf import csrf_exempt
+
+from rest_framework import status
+from rest_framework.authtoken.models import Token
+
+from api import models as mdl
+from api import services as svc
+from api import resumable
+from api import storage
+from api import throttling
+from api import uploadhandlers
+from api import views
+
+AUTH_KEYWORD = 'Token'
+
+
+async def get_user(request) -> Optional[mdl.User]:
+  """ Token authentication (same header as rest_framework's TokenAuthentication) with an async query """
+
+  auth = request.headers.get('Authorization', '').split()
+  if len(auth) != 2 or auth[0] != AUTH_KEYWORD: return None
+  try:
+    token = await Token.objects.select_related('user').aget(key = auth[1])
+  except Token.DoesNotExist:
+    return None
+  return token.user if token.user.is_active else None
+
+
+class AsyncView(View):
+  """ Token authenticated async view: the ASGI server receives the body without holding a thread, handlers run once it is complete """
+
+  throttle_scope: str = None   # see api.throttling
+
+  @classmethod
+  def as_view(cls, **initkwargs):
+    return csrf_exempt(super().as_view(**initkwargs))   # token authenticated, as the rest_framework views
+
+  async def dispatch(self, request, *args, **kwargs):
+    user = await get_user(request)
+    if user is None:
+      res = JsonResponse(dict(detail = 'Authentication credentials were not provided.'), status = status.HTTP_401_UNAUTHORIZED)
+      res['WWW-Authenticate'] = AUTH_KEYWORD
+      return res
+
+    request.user = user
+    if self.throttle_scope:
+      wait, request.batch_interval = await sync_to_async(throttling.take)(self.throttle_scope, user.pk)   # the hint is added by batch_hint_middleware
+      if wait:
+        res = JsonResponse(dict(detail = f'Request was throttled. Expected available in {math.ceil(wait)} seconds.'), status = status.HTTP_429_TOO_MANY_REQUESTS)
+        res['Retry-After'] = str(math.ceil(wait))
+        return res
+
+    return await super().dispatch(request, *args, **kwargs)
+
+
+class InsertWatchFile(AsyncView):
+  """ A smartwatch file view: multipart parsing (into the participant's directory) and storing run in a worker thread """
+
+  kind: str = None
+  serializer_class = None
+  throttle_scope = 'files'
+
+  async def post(self, request, *args, **kwargs):
+    return await sync_to_async(self.store)(request)
+
+  def store(self, request):
+    request.upload_handlers = [uploadhandlers.UserDirUploadHandler(request)]
+    serializer = self.serializer_class(data = request.FILES)
+
+    if not serializer.is_valid():
+      return JsonResponse(serializer.errors, status = status.HTTP_400_BAD_REQUEST)
+
+    # save the file as a new segment (re-sent files are acknowledged, but not stored twice)
+    if not svc.create_watch_upload(request.user, self.kind, serializer.validated_data['file']):
+      return JsonResponse(dict(duplicate = True), status = status.HTTP_200_OK)
+
+    return HttpResponse(status = status.HTTP_200_OK)
+
+
+class InsertPPG(InsertWatchFile):
+  kind = 'ppg'
+  serializer_class = views.InsertPPG.InputSerializer
+
+
+class InsertAcc(InsertWatchFile):
+  kind = 'acc'
+  serializer_class = views.InsertAcc.InputSerializer
+
+
+class InsertOffBody(InsertWatchFile):
+  kind = 'offbody'
+  serializer_class = views.InsertOffBody.InputSerializer
+
+
+class UploadSessionChunk(AsyncView):
+  throttle_scope = 'files'
+
+  async def get(self, request, session_id, *args, **kwargs):
+    session = await sync_to_async(resumable.get_session)(request.user.email, session_id)
+    if not session:
+      return HttpResponse(status = status.HTTP_404_NOT_FOUND)
+
+    return JsonResponse(dict(offset = session['offset'], size = session['size']), status = status.HTTP_200_OK)
+
+  async def put(self, request, session_id, *args, **kwargs):
+    session = await sync_to_async(resumable.get_session)(request.user.email, session_id)
+    if not session:
+      return HttpResponse(status = status.HTTP_404_NOT_FOUND)
+
+    # chunks must follow the received bytes, a client resumes from the offset returned by GET
+    offset = request.GET.get('offset', '')
+    if not offset.isdigit():
+      return JsonResponse(dict(offset = 'Offset is required'), status = status.HTTP_400_BAD_REQUEST)
+    if int(offset) != session['offset']:
+      return JsonResponse(dict(offset = session['offset']), status = status.HTTP_409_CONFLICT)
+
+    # the body is spooled already, copying it into the session file is blocking disk i/o
+    chunks = iter(lambda: request.read(storage.CHUNK_SIZE), b'')
+    offset = await sync_to_async(resumable.write_chunk)(request.user.email, session, session['offset'], chunks)
+    if offset > resumable.get_max_size(session):
+      await sync_to_async(resumable.remove_session)(request.user.email, session_id)
+      if session['size']: return JsonResponse(dict(size = 'Received more bytes than declared'), status = status.HTTP_400_BAD_REQUEST)
+      return JsonResponse(dict(size = f'Uploads are limited to {resumable.SESSION_MAX_SIZE} bytes'), status = status.HTTP_413_REQUEST_ENTITY_TOO_LARGE)
+
+    return JsonResponse(dict(offset = offset), status = status.HTTP_200_OK)
@@ -0,0 +1,43 @@
+from typing import List
+import select
+
+from django.db import connection, connections
+
+PARTICIPANTS_CHANNEL = 'sosw_participants'
+
+
+def is_supported() -> bool:
+  """ Whether the database delivers notifications (PostgreSQL LISTEN/NOTIFY), otherwise listeners have to poll """
+
+  return connection.vendor == 'postgresql'
+
+
+def notify_participant(user_id: int):
+  """ Tells listeners (the push service) that a participant joined or changed the fcm token, delivered on commit """
+
+  if not is_supported(): return
+  with connection.cursor() as cursor:
+    cursor.execute('SELECT pg_notify(%s, %s)', [PARTICIPANTS_CHANNEL, str(user_id)])
+
+
+class Listener:
+  """ Receives participant notifications on a dedicated database connection """
+
+  def __init__(self):
+    self.db = connections.create_connection('default')
+    self.db.ensure_connection()
+    self.db.set_autocommit(True)
+    with self.db.cursor() as cursor:
+      cursor.execute(f'LISTEN {PARTICIPANTS_CHANNEL}')
+
+  def wait(self, timeout: float) -> List[int]:
+    """ Blocks until notifications arrive (or timeout seconds), returns the notified user ids """
+
+    conn = self.db.connection
+    if select.select([conn], [], [], timeout)[0]: conn.poll()
+    ans = [int(x.payload) for x in conn.notifies if x.payload.isdigit()]
+    conn.notifies.clear()
+    return ans
+
+  def close(self):
+    self.db.close()
@@ -0,0 +1,76 @@
+from typing import Dict, Tuple
+
+import numpy as np
+
+MINUTE_MS = 60*1000
+GRAVITY = 9.80665   # the watch reports acceleration in m/s^2
+SMOOTHING_MS = 100
+DETRENDING_MS = 1000
+MIN_BEAT_INTERVAL_MS = 333   # 180 bpm
+MAX_BEAT_INTERVAL_MS = 1500   # 40 bpm
+MIN_BEATS = 10   # fewer beats in a minute: no heart rate
+
+
+def get_minutes(timestamps: np.ndarray) -> np.ndarray:
+  """ Returns start timestamps of the minutes that samples belong to """
+
+  return timestamps - timestamps%MINUTE_MS
+
+
+def _moving_average(x: np.ndarray, size: int) -> np.ndarray:
+  if size < 2: return x
+  return np.convolve(x, np.ones(size)/size, mode = 'same')
+
+
+def _group_median(keys: np.ndarray, values: np.ndarray) -> Tuple[Dict[int, float], Dict[int, int]]:
+  # sorts by (key, value), then takes the middle element(s) of each key's run
+  order = np.lexsort((values, keys))
+  keys, values = keys[order], values[order]
+  groups, starts, counts = np.unique(keys, return_index = True, return_counts = True)
+  lo = values[starts + (counts - 1)//2]
+  hi = values[starts + counts//2]
+  return dict(zip(groups.tolist(), ((lo + hi)/2).tolist())), dict(zip(groups.tolist(), counts.tolist()))
+
+
+def get_ppg_summaries(timestamps: np.ndarray, values: np.ndarray) -> Dict[int, dict]:
+  """ Returns sample counts and heart rate (bpm, from the interval between PPG peaks) per minute """
+
+  if len(timestamps) == 0: return dict()
+
+  minutes, counts = np.unique(get_minutes(timestamps), return_counts = True)
+  ans = {m: dict(ppg_count = c, heart_rate = None) for m, c in zip(minutes.tolist(), counts.tolist())}
+  if len(timestamps) < 3: return ans
+
+  # band-limit the signal: smooth out noise, remove the baseline drift, then take local maxima above the baseline
+  period = max(float(np.median(np.diff(timestamps))), 1.0)
+  signal = values[:, 0].astype(np.float64)
+  signal = _moving_average(signal, int(SMOOTHING_MS/period))
+  signal = signal - _moving_average(signal, int(DETRENDING_MS/period))
+  peaks = np.flatnonzero((signal[1:-1] > signal[:-2]) & (signal[1:-1] >= signal[2:]) & (signal[1:-1] > 0)) + 1
+
+  intervals = np.diff(timestamps[peaks])
+  beat_minutes = get_minutes(timestamps[peaks][1:])
+  valid = (intervals >= MIN_BEAT_INTERVAL_MS) & (intervals <= MAX_BEAT_INTERVAL_MS)
+  if not valid.any(): return ans
+
+  medians, beats = _group_median(beat_minutes[valid], intervals[valid].astype(np.float64))
+  for minute, interval in medians.items():
+    if beats[minute] >= MIN_BEATS: ans[minute]['heart_rate'] = 60000/interval
+  return ans
+
+
+def get_acc_summaries(timestamps: np.ndarray, values: np.ndarray) -> Dict[int, dict]:
+  """ Returns sample counts, mean and standard deviation of acceleration magnitude (g) and ENMO (mg) per minute """
+
+  if len(timestamps) == 0 or values.shape[1] < 3: return dict()
+
+  magnitude = np.sqrt(np.square(values[:, :3].astype(np.float64)).sum(axis = 1))/GRAVITY
+  enmo = np.maximum(magnitude - 1, 0)*1000   # euclidean norm minus one g, negative values rounded up to zero
+  minutes, index, counts = np.unique(get_minutes(timestamps), return_inverse = True, return_counts = True)
+  mean = np.bincount(index, weights = magnitude)/counts
+  std = np.sqrt(np.maximum(np.bincount(index, weights = magnitude**2)/counts - mean**2, 0))
+  enmo = np.bincount(index, weights = enmo)/counts
+  return {
+    m: dict(acc_count = c, acc_mean = a, acc_std = s, acc_enmo = e)
+    for m, c, a, s, e in zip(minutes.tolist(), counts.tolist(), mean.tolist(), std.tolist(), enmo.tolist())
+  }
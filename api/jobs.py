@@ -0,0 +1,134 @@
+from typing import Callable, Dict, Optional
+import traceback
+import time
+
+from django.db.models import F, Q
+
+import numpy as np
+
+from api import models as mdl
+
+MAX_ATTEMPTS = 5
+RETRY_DELAY_MS = 30*1000   # doubles with every failed attempt
+STALE_MS = 60*60*1000   # a running job of a dead worker goes back to the queue
+FINISHED_MAX_AGE_MS = 7*24*60*60*1000
+CLAIM_BATCH = 16
+STATS_WINDOW_MS = 60*60*1000
+
+HANDLERS: Dict[str, Callable] = dict()
+
+
+def now_ms() -> int:
+  return int(time.time()*1000)
+
+
+def handler(name: str):
+  """ Registers a function as the handler of a job name """
+
+  def decorator(func: Callable) -> Callable:
+    HANDLERS[name] = func
+    return func
+
+  return decorator
+
+
+def enqueue(name: str, max_attempts: Optional[int] = None, **payload) -> mdl.Job:
+  """ Queues a job, payload must be json-serializable keyword arguments of the handler (max_attempts 1: a job that must not run twice) """
+
+  ts = now_ms()
+  return mdl.Job.objects.create(name = name, payload = payload, max_attempts = max_attempts, created_ts = ts, run_after_ts = ts)
+
+
+def enqueue_unique(name: str, **payload) -> Optional[mdl.Job]:
+  """ Queues a job unless the same one is waiting already (e.g., periodic jobs of several workers) """
+
+  if mdl.Job.objects.filter(name = name, payload = payload, status = 'pending').exists(): return None
+  return enqueue(name, **payload)
+
+
+def claim() -> Optional[mdl.Job]:
+  """ Takes the oldest due job, None if the queue is empty """
+
+  # a conditional update takes a job: concurrent workers never run the same one (on any database)
+  candidates = mdl.Job.objects.filter(status = 'pending', run_after_ts__lte = now_ms()).order_by('id')
+  for job_id in candidates.values_list('id', flat = True)[:CLAIM_BATCH]:
+    taken = mdl.Job.objects.filter(id = job_id, status = 'pending').update(
+      status = 'running',
+      started_ts = now_ms(),
+      attempts = F('attempts') + 1,
+    )
+    if taken: return mdl.Job.objects.get(id = job_id)
+  return None
+
+
+def run(job: mdl.Job) -> bool:
+  """ Runs a claimed job, failed ones are retried later with a growing delay, returns True on success """
+
+  try:
+    result = HANDLERS[job.name](**job.payload)
+  except Exception:
+    job.error = traceback.format_exc()
+    if job.attempts < (job.max_attempts or MAX_ATTEMPTS):
+      job.status = 'pending'
+      job.run_after_ts = now_ms() + RETRY_DELAY_MS*2**(job.attempts - 1)
+    else:
+      job.status = 'failed'
+      job.finished_ts = now_ms()
+    job.save(update_fields = ['status', 'error', 'run_after_ts', 'finished_ts'])
+    return False
+
+  job.status = 'done'
+  job.result = result
+  job.finished_ts = now_ms()
+  job.save(update_fields = ['status', 'result', 'finished_ts'])
+  return True
+
+
+def run_pending(max_jobs: Optional[int] = None) -> int:
+  """ Runs due jobs until the queue is empty, returns the number of processed jobs """
+
+  ans = 0
+  while max_jobs is None or ans < max_jobs:
+    job = claim()
+    if job is None: break
+    run(job)
+    ans += 1
+  return ans
+
+
+def requeue_stale(max_age: int = STALE_MS) -> int:
+  """ Puts jobs of crashed workers back into the queue (or fails them after their last attempt), returns the number of requeued ones """
+
+  ts = now_ms()
+  stale = mdl.Job.objects.filter(status = 'running', started_ts__lt = ts - max_age)
+  last = Q(max_attempts__isnull = True, attempts__gte = MAX_ATTEMPTS) | Q(attempts__gte = F('max_attempts'))
+  stale.filter(last).update(status = 'failed', error = 'the worker stopped while running the job', finished_ts = ts)
+  return stale.update(status = 'pending')
+
+
+def purge_finished(max_age: int = FINISHED_MAX_AGE_MS) -> int:
+  """ Removes old successful jobs, returns their number """
+
+  return mdl.Job.objects.filter(status = 'done', finished_ts__lt = now_ms() - max_age).delete()[0]
+
+
+def get_stats(window: int = STATS_WINDOW_MS) -> dict:
+  """ Returns queue depth and latency (queued to finished, milliseconds) of jobs finished within the window """
+
+  ts = now_ms()
+  pending = mdl.Job.objects.filter(status = 'pending')
+  oldest_ts = pending.order_by('created_ts').values_list('created_ts', flat = True).first()
+  latencies = np.array(
+    mdl.Job.objects.filter(status = 'done', finished_ts__gte = ts - window).values_list('created_ts', 'finished_ts'),
+    dtype = np.int64,
+  ).reshape(-1, 2)
+  latencies = latencies[:, 1] - latencies[:, 0]
+  return dict(
+    pending = pending.count(),
+    running = mdl.Job.objects.filter(status = 'running').count(),
+    failed = mdl.Job.objects.filter(status = 'failed').count(),
+    done = len(latencies),
+    oldest_pending_age = ts - oldest_ts if oldest_ts is not None else None,
+    latency_p50 = int(np.percentile(latencies, 50)) if len(latencies) else None,
+    latency_p95 = int(np.percentile(latencies, 95)) if len(latencies) else None,
+  )
@@ -0,0 +1,230 @@
+from django.core.handlers.asgi import ASGIHandler
+from django.core.handlers.wsgi import WSGIHandler
+from django.core.management.base import BaseCommand
+from django.conf import settings
+from django.test.utils import override_settings
+
+from concurrent.futures import ThreadPoolExecutor
+from os.path import join
+from io import BytesIO
+import threading
+import tempfile
+import asyncio
+import shutil
+import time
+import sys
+
+import numpy as np
+
+from rest_framework.authtoken.models import Token
+
+from api import services as svc
+from api import resumable
+from api import storage
+from api import throttling
+from dashboard import loadshedding
+from dashboard import ingestion_settings
+from dashboard import ingestion_asgi_settings
+
+EMAIL = 'benchmark_ingestion@sosw.local'
+
+
+class SlowStream:
+  """ Request body of a slow client (wsgi.input): each piece arrives after a delay """
+
+  def __init__(self, data: bytes, piece: int, delay: float):
+    self.buf = BytesIO(data)
+    self.piece = piece
+    self.delay = delay
+
+  def read(self, size: int = -1) -> bytes:
+    size = self.piece if size is None or size < 0 else min(size, self.piece)
+    data = self.buf.read(size)
+    if data: time.sleep(self.delay)
+    return data
+
+  def readline(self, size: int = -1) -> bytes:
+    size = self.piece if size is None or size < 0 else min(size, self.piece)
+    data = self.buf.readline(size)
+    if data: time.sleep(self.delay)
+    return data
+
+
+class Command(BaseCommand):
+  help = 'Compares concurrent slow uploads (resumable chunks) on the sync ingestion app (WSGI, a gthread pool) and the async one (ASGI, one event loop)'
+
+  def add_arguments(self, parser):
+    parser.add_argument('--uploads', type = int, default = 1000, help = 'concurrent clients')
+    parser.add_argument('--size', type = int, default = 64*1024, help = 'bytes per upload')
+    parser.add_argument('--duration', type = float, default = 2.0, help = 'seconds a client takes to send its body')
+    parser.add_argument('--pieces', type = int, default = 16, help = 'body pieces per upload')
+    parser.add_argument('--ramp', type = float, default = 2.0, help = 'seconds over which clients connect')
+    parser.add_argument('--threads', type = int, default = 32, help = 'threads of the sync app (gthread workers x threads)')
+
+  def handle(self, *args, **options):
+    self.options = options
+    self.host = settings.ALLOWED_HOSTS[0] if settings.ALLOWED_HOSTS and settings.ALLOWED_HOSTS[0] != '*' else 'localhost'
+    self.data = b''.join(f'{1669852800000 + i},{i}\n'.encode() for i in range(options['size']))[:options['size']]
+    self.piece = -(-len(self.data)//options['pieces'])
+    self.delay = options['duration']/options['pieces']
+    self.arrivals = np.linspace(0, options['ramp'], options['uploads'], endpoint = False)
+
+    # sessions, token buckets and counts go to a scratch directory
+    scratch = tempfile.mkdtemp()
+    data_dir = storage.DATA_DUMP_DIR
+    storage.DATA_DUMP_DIR = join(scratch, 'data')
+    throttle_dir, table = throttling.THROTTLE_DIR, throttling.buckets
+    throttling.THROTTLE_DIR = join(scratch, 'throttle')
+    throttling.buckets = throttling.BucketTable(join(throttling.THROTTLE_DIR, throttling.BUCKETS_FILENAME))
+    buckets = throttling.BUCKETS
+    throttling.BUCKETS = dict(buckets, files = (2*options['uploads'], 1.0))   # one participant sends all uploads, none is throttled
+    max_in_flight = loadshedding.MAX_IN_FLIGHT
+    loadshedding.MAX_IN_FLIGHT = 0   # capacity is measured, not shedding
+    user = svc.create_user(
+      username = EMAIL,
+      email = EMAIL,
+      full_name = 'Benchmark',
+      gender = 'M',
+      date_of_birth = '2000-01-01',
+      password = 'benchmark_password',
+    )
+    try:
+      self.key = Token.objects.get(user = user).key
+      # the apps of dashboard.ingestion_wsgi and dashboard.ingestion_asgi
+      with override_settings(ROOT_URLCONF = ingestion_settings.ROOT_URLCONF, MIDDLEWARE = ingestion_settings.MIDDLEWARE):
+        self.report('sync (wsgi)', self.run_sync())
+      with override_settings(ROOT_URLCONF = ingestion_asgi_settings.ROOT_URLCONF, MIDDLEWARE = ingestion_asgi_settings.MIDDLEWARE):
+        self.report('async (asgi)', self.run_async())
+    finally:
+      user.delete()
+      shutil.rmtree(scratch)
+      storage.DATA_DUMP_DIR = data_dir
+      throttling.BUCKETS = buckets
+      loadshedding.MAX_IN_FLIGHT = max_in_flight
+      throttling.counts.clear()   # not flushed into the server's counts
+      throttling.buckets.close()
+      throttling.THROTTLE_DIR, throttling.buckets = throttle_dir, table
+
+  def get_paths(self):
+    sessions = [resumable.create_session(EMAIL, 'ppg', f'ppg{i}.csv', len(self.data)) for i in range(self.options['uploads'])]
+    return [f'/api/upload_session/{x["id"]}' for x in sessions]
+
+  def run_sync(self):
+    app = WSGIHandler()
+
+    def upload(path, arrived):
+      status = []
+      environ = {
+        'REQUEST_METHOD': 'PUT',
+        'PATH_INFO': path,
+        'QUERY_STRING': 'offset=0',
+        'SERVER_NAME': self.host,
+        'SERVER_PORT': '80',
+        'HTTP_HOST': self.host,
+        'HTTP_AUTHORIZATION': f'Token {self.key}',
+        'CONTENT_TYPE': 'application/octet-stream',
+        'CONTENT_LENGTH': str(len(self.data)),
+        'wsgi.input': SlowStream(self.data, self.piece, self.delay),
+        'wsgi.errors': sys.stderr,
+        'wsgi.url_scheme': 'http',
+      }
+      res = app(environ, lambda x, headers: status.append(x))
+      b''.join(res)
+      res.close()
+      return status[0].startswith('200'), time.perf_counter() - arrived
+
+    paths = self.get_paths()
+    with Sampler() as sampler, ThreadPoolExecutor(max_workers = self.options['threads']) as pool:
+      started = time.perf_counter()
+      futures = list()
+      for path, arrival in zip(paths, self.arrivals):
+        time.sleep(max(0, started + arrival - time.perf_counter()))
+        # a connection waits for a free thread, then holds it while the client sends
+        futures.append(pool.submit(upload, path, started + arrival))
+      results = [x.result() for x in futures]
+      wall = time.perf_counter() - started
+    return results, wall, sampler.peak
+
+  def run_async(self):
+    app = ASGIHandler()
+
+    async def upload(path, arrived):
+      await asyncio.sleep(arrived - time.perf_counter())
+      status = []
+      pieces = [self.data[i:i + self.piece] for i in range(0, len(self.data), self.piece)]
+      done = asyncio.Event()
+
+      async def receive():
+        if not pieces:
+          await done.wait()   # the connection stays open until the response
+          return dict(type = 'http.disconnect')
+        await asyncio.sleep(self.delay)
+        body = pieces.pop(0)
+        return dict(type = 'http.request', body = body, more_body = bool(pieces))
+
+      async def send(message):
+        if message['type'] == 'http.response.start': status.append(message['status'])
+        if message['type'] == 'http.response.body' and not message.get('more_body'): done.set()
+
+      scope = dict(
+        type = 'http',
+        asgi = dict(version = '3.0'),
+        http_version = '1.1',
+        method = 'PUT',
+        scheme = 'http',
+        path = path,
+        raw_path = path.encode(),
+        query_string = b'offset=0',
+        root_path = '',
+        headers = [
+          (b'host', self.host.encode()),
+          (b'authorization', f'Token {self.key}'.encode()),
+          (b'content-type', b'application/octet-stream'),
+          (b'content-length', str(len(self.data)).encode()),
+        ],
+        client = ('127.0.0.1', 0),
+        server = (self.host, 80),
+      )
+      await app(scope, receive, send)
+      return status[0] == 200, time.perf_counter() - arrived
+
+    async def run(paths):
+      started = time.perf_counter()
+      return await asyncio.gather(*[upload(x, started + y) for x, y in zip(paths, self.arrivals)])
+
+    paths = self.get_paths()
+    with Sampler() as sampler:
+      started = time.perf_counter()
+      results = asyncio.run(run(paths))
+      wall = time.perf_counter() - started
+    return results, wall, sampler.peak
+
+  def report(self, name, run):
+    results, wall, threads = run
+    latencies = np.array([x[1] for x in results])
+    self.stdout.write(f'{name}:')
+    self.stdout.write(f'  uploads:        {len(results)} ({sum(not x[0] for x in results)} failed)')
+    self.stdout.write(f'  wall_seconds:   {wall:.2f}')
+    self.stdout.write(f'  uploads/s:      {len(results)/wall:.1f}')
+    self.stdout.write(f'  latency_p50_s:  {np.percentile(latencies, 50):.2f}')
+    self.stdout.write(f'  latency_p95_s:  {np.percentile(latencies, 95):.2f}')
+    self.stdout.write(f'  peak_threads:   {threads}')
+
+
+class Sampler:
+  """ Samples the number of live threads in the background """
+
+  def __enter__(self):
+    self.peak = threading.active_count()
+    self.stopped = threading.Event()
+    self.thread = threading.Thread(target = self.run, daemon = True)
+    self.thread.start()
+    return self
+
+  def run(self):
+    while not self.stopped.wait(0.01):
+      self.peak = max(self.peak, threading.active_count() - 1)   # without the sampler
+
+  def __exit__(self, *args):
+    self.stopped.set()
+    self.thread.join()
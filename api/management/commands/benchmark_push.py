@@ -0,0 +1,30 @@
+from django.core.management.base import BaseCommand
+
+import time
+
+from api import push
+
+
+class Command(BaseCommand):
+  help = 'Measures push notification throughput (one request per push vs. batches) against the local fake FCM backend'
+
+  def add_arguments(self, parser):
+    parser.add_argument('--pushes', type = int, default = 2000)
+    parser.add_argument('--latency', type = float, default = 0.05, help = 'simulated seconds per FCM request')
+
+  def handle(self, *args, **options):
+    tokens = {i: f'token-{i}' for i in range(options['pushes'])}
+
+    fcm = push.FakeMessaging(latency = options['latency'])
+    started = time.perf_counter()
+    for token in tokens.values():
+      fcm.send(push.get_ema_message(token))
+    single = time.perf_counter() - started
+
+    fcm = push.backend = push.FakeMessaging(latency = options['latency'])
+    started = time.perf_counter()
+    push.send_ema_pushes(tokens)
+    batched = time.perf_counter() - started
+
+    self.stdout.write(f'send:      {options["pushes"]/single:.0f} pushes/s')
+    self.stdout.write(f'send_each: {options["pushes"]/batched:.0f} pushes/s ({fcm.requests} requests)')
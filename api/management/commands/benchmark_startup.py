@@ -0,0 +1,53 @@
+from django.core.management.base import BaseCommand
+
+from collections import defaultdict
+import subprocess
+import statistics
+import time
+import sys
+
+import numpy as np
+
+LAZY_MODULES = ['firebase_admin', 'plotly', 'pandas']   # must not be imported by a starting web worker
+
+
+def get_import_times(module: str) -> tuple:
+  """ Imports a module in a fresh interpreter with -X importtime, returns wall seconds and import microseconds per package """
+
+  started = time.perf_counter()
+  res = subprocess.run([sys.executable, '-X', 'importtime', '-c', f'import {module}'], capture_output = True, text = True, check = True)
+  wall = time.perf_counter() - started
+
+  # self times of modules summed per top-level package (e.g., django.db.models counts for django)
+  ans = defaultdict(int)
+  for line in res.stderr.splitlines():
+    if not line.startswith('import time:') or 'cumulative' in line: continue
+    own, _, name = line[len('import time:'):].split('|')
+    ans[name.strip().split('.')[0]] += int(own)
+  return wall, ans
+
+
+class Command(BaseCommand):
+  help = 'Measures web worker startup (python -X importtime of the wsgi app): time, heaviest imports, lazily loaded modules'
+
+  def add_arguments(self, parser):
+    parser.add_argument('--module', type = str, default = 'dashboard.wsgi')
+    parser.add_argument('--runs', type = int, default = 5)
+    parser.add_argument('--top', type = int, default = 15)
+
+  def handle(self, *args, **options):
+    walls, imports = list(), defaultdict(list)
+    for _ in range(options['runs']):
+      wall, times = get_import_times(options['module'])
+      walls.append(wall)
+      for name, cumulative in times.items():
+        imports[name].append(cumulative)
+
+    self.stdout.write(f'startup: {statistics.median(walls)*1000:.0f} ms (median of {options["runs"]} runs)')
+    self.stdout.write(f'imports: {sum(np.median(x) for x in imports.values())/1000:.0f} ms')
+    for name in LAZY_MODULES:
+      self.stdout.write(f'{name}: {"imported" if name in imports else "not imported"}')
+
+    self.stdout.write('heaviest packages (ms):')
+    for name, ms in sorted(((x, np.median(y)/1000) for x, y in imports.items()), key = lambda x: -x[1])[:options['top']]:
+      self.stdout.write(f'  {name}: {ms:.1f}')
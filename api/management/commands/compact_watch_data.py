@@ -0,0 +1,24 @@
+from django.core.management.base import BaseCommand
+
+from api import selectors as slc
+from api import resumable
+from api import storage
+
+
+class Command(BaseCommand):
+  help = 'Merges small smartwatch segments (raw csv and columnar) in timestamp order, removes abandoned uploads'
+
+  def add_arguments(self, parser):
+    parser.add_argument('--pid', type = int, default = None, help = 'participant id (all participants by default)')
+    parser.add_argument('--max-rows', type = int, default = storage.COMPACTION_MAX_ROWS, help = 'segments with fewer rows are merged')
+
+  def handle(self, *args, **options):
+    users = [slc.get_user(id = options['pid'])] if options['pid'] else slc.get_users()
+    for user in users:
+      removed = resumable.remove_stale_sessions(user.email)
+      if removed: self.stdout.write(f'{user.email}: removed {removed} abandoned uploads')
+      for kind in storage.KINDS:
+        removed = storage.compact_raw(user.email, kind)
+        if removed: self.stdout.write(f'{user.email} {kind}: merged {removed} raw segments')
+        removed = storage.compact(user.email, kind, max_rows = options['max_rows'])
+        if removed: self.stdout.write(f'{user.email} {kind}: merged {removed} columnar segments')
@@ -0,0 +1,33 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from api import selectors as slc
+from api import storage
+
+import sys
+
+
+class Command(BaseCommand):
+  help = 'Exports smartwatch data of a participant as csv (legacy file format)'
+
+  def add_arguments(self, parser):
+    parser.add_argument('pid', type = int)
+    parser.add_argument('kind', choices = storage.KINDS)
+    parser.add_argument('--from-ts', type = int, default = None)
+    parser.add_argument('--till-ts', type = int, default = None)
+    parser.add_argument('--raw', action = 'store_true', help = 'uploaded csv content as is (ignores the time range)')
+    parser.add_argument('--output', default = None, help = 'output file path (stdout by default)')
+
+  def handle(self, *args, **options):
+    user = slc.get_user(id = options['pid'])
+    if not user: raise CommandError('Invalid user id provided!')
+
+    wb = open(options['output'], 'wb') if options['output'] else sys.stdout.buffer
+    try:
+      if options['raw']:
+        size = storage.export_raw(user.email, options['kind'], wb)
+        self.stderr.write(f'{size} bytes exported')
+      else:
+        rows = storage.export_csv(user.email, options['kind'], wb, options['from_ts'], options['till_ts'])
+        self.stderr.write(f'{rows} rows exported')
+    finally:
+      if options['output']: wb.close()
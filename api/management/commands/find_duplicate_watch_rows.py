@@ -0,0 +1,23 @@
+from django.core.management.base import BaseCommand
+
+from api import selectors as slc
+from api import storage
+
+
+class Command(BaseCommand):
+  help = 'Reports ranges of smartwatch rows stored more than once (re-uploaded chunks), run once for existing data'
+
+  def add_arguments(self, parser):
+    parser.add_argument('--pid', type = int, default = None, help = 'participant id (all participants by default)')
+
+  def handle(self, *args, **options):
+    users = [slc.get_user(id = options['pid'])] if options['pid'] else slc.get_users()
+    for user in users:
+      for kind in storage.KINDS:
+        ranges = storage.find_duplicate_ranges(user.email, kind)
+        for x in ranges:
+          self.stdout.write(
+            f'{user.email} {kind} {x["segment"]} lines {x["from_line"]}-{x["till_line"]} '
+            f'({x["rows"]} rows, {x["from_ts"]}-{x["till_ts"]})'
+          )
+        if ranges: self.stdout.write(f'{user.email} {kind}: {sum(x["rows"] for x in ranges)} duplicate rows')
@@ -0,0 +1,20 @@
+from django.core.management.base import BaseCommand
+
+from api import selectors as slc
+from api import storage
+
+from os.path import join
+
+
+class Command(BaseCommand):
+  help = 'Moves existing per-participant smartwatch csv files into segments (run once)'
+
+  def add_arguments(self, parser):
+    parser.add_argument('--pid', type = int, default = None, help = 'participant id (all participants by default)')
+
+  def handle(self, *args, **options):
+    users = [slc.get_user(id = options['pid'])] if options['pid'] else slc.get_users()
+    for user in users:
+      for kind in storage.KINDS:
+        rows = storage.import_csv(user.email, kind, join(storage.DATA_DUMP_DIR, user.email, f'{kind}.csv'))
+        if rows: self.stdout.write(f'{user.email} {kind}: {rows} rows imported')
@@ -0,0 +1,18 @@
+from django.core.management.base import BaseCommand
+
+from api import selectors as slc
+from api import storage
+from api import tasks
+
+
+class Command(BaseCommand):
+  help = 'Loads stored off-body files into the OffBody table (already loaded records are skipped)'
+
+  def add_arguments(self, parser):
+    parser.add_argument('--pid', type = int, default = None, help = 'participant id (all participants by default)')
+
+  def handle(self, *args, **options):
+    users = [slc.get_user(id = options['pid'])] if options['pid'] else slc.get_users()
+    for user in users:
+      rows = sum(tasks.load_off_body(user.id, x['name']) for x in storage.get_raw_segments(user.email, 'offbody'))
+      if rows: self.stdout.write(f'{user.email}: {rows} off-body records')
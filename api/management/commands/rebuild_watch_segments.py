@@ -0,0 +1,18 @@
+from django.core.management.base import BaseCommand
+
+from api import selectors as slc
+from api import storage
+
+
+class Command(BaseCommand):
+  help = 'Re-creates columnar smartwatch segments from raw segments (e.g., after restoring a backup)'
+
+  def add_arguments(self, parser):
+    parser.add_argument('--pid', type = int, default = None, help = 'participant id (all participants by default)')
+
+  def handle(self, *args, **options):
+    users = [slc.get_user(id = options['pid'])] if options['pid'] else slc.get_users()
+    for user in users:
+      for kind in storage.KINDS:
+        rows = storage.rebuild_columnar(user.email, kind)
+        if rows: self.stdout.write(f'{user.email} {kind}: {rows} rows')
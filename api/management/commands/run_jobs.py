@@ -0,0 +1,52 @@
+from multiprocessing import Process
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import connections
+
+from api import jobs
+
+MAINTENANCE_INTERVAL = 60   # seconds
+METRICS_INTERVAL = 10*60   # seconds between re-computations of push metrics
+
+
+def work(poll_interval: float, once: bool):
+  connections.close_all()   # never share the parent's database connection
+  last_maintenance = last_metrics = 0
+  while True:
+    if time.time() - last_maintenance > MAINTENANCE_INTERVAL:
+      jobs.requeue_stale()
+      jobs.purge_finished()
+      last_maintenance = time.time()
+    if time.time() - last_metrics > METRICS_INTERVAL:
+      jobs.enqueue_unique('compute_push_metrics')
+      last_metrics = time.time()
+
+    if jobs.run_pending(): continue
+    if once: break
+    time.sleep(poll_interval)
+
+
+class Command(BaseCommand):
+  help = 'Runs queued background jobs (e.g., processing of smartwatch uploads)'
+
+  def add_arguments(self, parser):
+    parser.add_argument('--processes', type = int, default = 1, help = 'number of worker processes')
+    parser.add_argument('--poll-interval', type = float, default = 1.0, help = 'seconds between checks of an empty queue')
+    parser.add_argument('--once', action = 'store_true', help = 'exit when the queue is empty')
+    parser.add_argument('--stats', action = 'store_true', help = 'print queue depth and latency and exit')
+
+  def handle(self, *args, **options):
+    if options['stats']:
+      for key, value in jobs.get_stats().items():
+        self.stdout.write(f'{key}: {value}')
+      return
+
+    if options['processes'] == 1: return work(options['poll_interval'], options['once'])
+
+    connections.close_all()
+    workers = [Process(target = work, args = (options['poll_interval'], options['once'])) for _ in range(options['processes'])]
+    for worker in workers:
+      worker.start()
+    for worker in workers:
+      worker.join()
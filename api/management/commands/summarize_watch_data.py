@@ -0,0 +1,20 @@
+from django.core.management.base import BaseCommand
+
+from api import selectors as slc
+from api import storage
+from api import tasks
+
+
+class Command(BaseCommand):
+  help = 'Re-computes per-minute smartwatch summaries (heart rate, activity) from stored samples'
+
+  def add_arguments(self, parser):
+    parser.add_argument('--pid', type = int, default = None, help = 'participant id (all participants by default)')
+
+  def handle(self, *args, **options):
+    users = [slc.get_user(id = options['pid'])] if options['pid'] else slc.get_users()
+    for user in users:
+      for kind in tasks.SUMMARIZED_KINDS:
+        # a day at a time keeps memory use bounded
+        minutes = sum(tasks.summarize_watch_minutes(user.id, kind, *storage.get_day_range(x)) for x in storage.list_days(user.email, kind))
+        if minutes: self.stdout.write(f'{user.email} {kind}: {minutes} minutes')
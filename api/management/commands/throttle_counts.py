@@ -0,0 +1,22 @@
+from django.core.management.base import BaseCommand
+
+from datetime import datetime as dt
+import time
+
+from api import throttling
+
+
+class Command(BaseCommand):
+  help = 'Prints api requests per hour and endpoint group: allowed, asked to batch more (hinted) and throttled, to tune api.throttling.BUCKETS'
+
+  def add_arguments(self, parser):
+    parser.add_argument('--hours', type = int, default = 24)
+
+  def handle(self, *args, **options):
+    # workers add their counts every few seconds (see throttling.COUNTS_FLUSH_INTERVAL)
+    now = time.time()
+    self.stdout.write('hour,scope,burst,rate,' + ','.join(throttling.OUTCOMES))
+    for row in throttling.get_counts(now - options['hours']*throttling.HOUR, now):
+      burst, rate = throttling.BUCKETS[row['scope']]
+      hour = dt.fromtimestamp(row['hour']).strftime('%Y-%m-%d %H:00')
+      self.stdout.write(f'{hour},{row["scope"]},{burst},{rate:g},' + ','.join(str(row[x]) for x in throttling.OUTCOMES))
@@ -0,0 +1,98 @@
+from typing import Dict, Tuple
+
+import numpy as np
+
+DAY_MS = 24*60*60*1000
+RESPONSE_WINDOW_MS = 60*60*1000   # a later self-report does not answer the push
+USER_SHIFT = 42   # user id and a timestamp (ms, below 2**42) packed into one sortable key
+TS_MASK = (1 << USER_SHIFT) - 1
+
+
+def _keys(user_ids: np.ndarray, timestamps: np.ndarray) -> np.ndarray:
+  return (user_ids.astype(np.int64) << USER_SHIFT) | timestamps.astype(np.int64)
+
+
+def get_days(timestamps: np.ndarray, utc_offset_ms: int) -> np.ndarray:
+  """ Returns local midnights (timestamps) of the days that timestamps belong to """
+
+  return timestamps - (timestamps + utc_offset_ms)%DAY_MS
+
+
+def match_responses(push_users: np.ndarray, push_ts: np.ndarray, report_users: np.ndarray, report_ts: np.ndarray) -> np.ndarray:
+  """ Returns the timestamp of the self-report answering each push (-1: none): the participant's next one before their next push """
+
+  ans = np.full(len(push_ts), -1, dtype = np.int64)
+  if len(push_ts) == 0 or len(report_ts) == 0: return ans
+
+  # with (user, timestamp) keys, the next report of the same participant is a single searchsorted over all participants
+  order = np.argsort(_keys(push_users, push_ts), kind = 'stable')
+  pushes = _keys(push_users, push_ts)[order]
+  reports = np.sort(_keys(report_users, report_ts))
+  index = np.searchsorted(reports, pushes, side = 'left')
+  candidates = reports[np.minimum(index, len(reports) - 1)]
+  next_pushes = np.append(pushes[1:], np.iinfo(np.int64).max)   # a push of another participant has a greater key
+
+  answered = (
+    (index < len(reports)) &
+    (candidates >> USER_SHIFT == pushes >> USER_SHIFT) &
+    (candidates < next_pushes) &
+    ((candidates & TS_MASK) - (pushes & TS_MASK) <= RESPONSE_WINDOW_MS)
+  )
+  ans[order[answered]] = candidates[answered] & TS_MASK
+  return ans
+
+
+def _group_percentile(index: np.ndarray, values: np.ndarray, groups: int, q: float) -> np.ndarray:
+  # sorts by (group, value), then takes the lower nearest rank of each group's run, nan for empty groups
+  ans = np.full(groups, np.nan)
+  if len(values) == 0: return ans
+  order = np.lexsort((values, index))
+  index, values = index[order], values[order]
+  present, starts, counts = np.unique(index, return_index = True, return_counts = True)
+  ans[present] = values[starts + np.floor(q/100*(counts - 1)).astype(np.int64)]
+  return ans
+
+
+def get_daily_metrics(
+  user_ids: np.ndarray,
+  planned_ts: np.ndarray,
+  sent_ts: np.ndarray,
+  delivered: np.ndarray,
+  response_ts: np.ndarray,
+  utc_offset_ms: int,
+) -> Dict[Tuple[int, int], dict]:
+  """ Returns push counts, compliance and latencies (ms) per (user id, day of the planned time) """
+
+  if len(user_ids) == 0: return dict()
+
+  groups, index = np.unique(_keys(user_ids, get_days(planned_ts, utc_offset_ms)), return_inverse = True)
+  responded = response_ts >= 0
+  pushes = np.bincount(index, minlength = len(groups))
+  delivered_counts = np.bincount(index, weights = delivered, minlength = len(groups)).astype(np.int64)
+  responded_counts = np.bincount(index, weights = responded, minlength = len(groups)).astype(np.int64)
+  response = _group_percentile(index[responded], (response_ts - sent_ts)[responded], len(groups), 50)
+  lag_p50 = _group_percentile(index, sent_ts - planned_ts, len(groups), 50)
+  lag_p95 = _group_percentile(index, sent_ts - planned_ts, len(groups), 95)
+
+  def value(x: float):
+    return None if np.isnan(x) else int(x)
+
+  return {
+    (g >> USER_SHIFT, g & TS_MASK): dict(
+      pushes = p,
+      delivered = d,
+      responded = r,
+      response_p50_ms = value(a),
+      lag_p50_ms = value(b),
+      lag_p95_ms = value(c),
+    )
+    for g, p, d, r, a, b, c in zip(
+      groups.tolist(),
+      pushes.tolist(),
+      delivered_counts.tolist(),
+      responded_counts.tolist(),
+      response.tolist(),
+      lag_p50.tolist(),
+      lag_p95.tolist(),
+    )
+  }
@@ -0,0 +1,30 @@
+# Generated by Django 5.2.18 on 2026-10-20 01:17
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0009_rename_activity_type_activitytransition_activity_and_more'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='WatchUpload',
+            fields=[
+                ('id', models.AutoField(primary_key=True, serialize=False)),
+                ('timestamp', models.BigIntegerField()),
+                ('kind', models.CharField(max_length=16)),
+                ('size', models.BigIntegerField()),
+                ('digest', models.CharField(max_length=32)),
+                ('segment', models.CharField(max_length=128, null=True)),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'constraints': [models.UniqueConstraint(fields=('user', 'kind', 'size', 'digest'), name='unique_watch_upload')],
+            },
+        ),
+    ]
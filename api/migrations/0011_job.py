@@ -0,0 +1,31 @@
+# Generated by Django 5.2.18 on 2026-10-20 01:23
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0010_watchupload'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Job',
+            fields=[
+                ('id', models.AutoField(primary_key=True, serialize=False)),
+                ('name', models.CharField(max_length=64)),
+                ('payload', models.JSONField(default=dict)),
+                ('status', models.CharField(default='pending', max_length=16)),
+                ('attempts', models.IntegerField(default=0)),
+                ('error', models.TextField(null=True)),
+                ('created_ts', models.BigIntegerField()),
+                ('run_after_ts', models.BigIntegerField()),
+                ('started_ts', models.BigIntegerField(null=True)),
+                ('finished_ts', models.BigIntegerField(null=True)),
+            ],
+            options={
+                'indexes': [models.Index(fields=['status', 'run_after_ts'], name='job_queue_idx')],
+            },
+        ),
+    ]
@@ -0,0 +1,17 @@
+# Generated by Django 5.2.18 on 2026-10-20 01:29
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0011_job'),
+    ]
+
+    operations = [
+        migrations.AddConstraint(
+            model_name='offbody',
+            constraint=models.UniqueConstraint(fields=('user', 'timestamp'), name='unique_off_body'),
+        ),
+    ]
@@ -0,0 +1,32 @@
+# Generated by Django 5.2.18 on 2026-10-20 01:31
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0012_unique_off_body'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='MinuteSummary',
+            fields=[
+                ('id', models.AutoField(primary_key=True, serialize=False)),
+                ('timestamp', models.BigIntegerField()),
+                ('ppg_count', models.IntegerField(default=0)),
+                ('heart_rate', models.FloatField(null=True)),
+                ('acc_count', models.IntegerField(default=0)),
+                ('acc_mean', models.FloatField(null=True)),
+                ('acc_std', models.FloatField(null=True)),
+                ('acc_enmo', models.FloatField(null=True)),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'constraints': [models.UniqueConstraint(fields=('user', 'timestamp'), name='unique_minute_summary')],
+            },
+        ),
+    ]
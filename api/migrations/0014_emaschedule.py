@@ -0,0 +1,25 @@
+# Generated by Django 5.2.18 on 2026-10-20 01:34
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0013_minutesummary'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='EmaSchedule',
+            fields=[
+                ('id', models.AutoField(primary_key=True, serialize=False)),
+                ('planned_ts', models.BigIntegerField(db_index=True)),
+                ('sent_ts', models.BigIntegerField(null=True)),
+                ('status', models.CharField(default='pending', max_length=16)),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to=settings.AUTH_USER_MODEL)),
+            ],
+        ),
+    ]
@@ -0,0 +1,21 @@
+# Generated by Django 5.2.18 on 2026-10-20 01:52
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0014_emaschedule'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PushWorker',
+            fields=[
+                ('id', models.AutoField(primary_key=True, serialize=False)),
+                ('name', models.CharField(max_length=128, unique=True)),
+                ('heartbeat_ts', models.BigIntegerField(db_index=True)),
+            ],
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.2.18 on 2026-10-20 01:54
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0015_pushworker'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='job',
+            name='result',
+            field=models.JSONField(null=True),
+        ),
+    ]
@@ -0,0 +1,46 @@
+# Generated by Django 5.2.18 on 2026-10-20 01:56
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0016_job_result'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PushDelivery',
+            fields=[
+                ('id', models.AutoField(primary_key=True, serialize=False)),
+                ('source', models.CharField(max_length=16)),
+                ('planned_ts', models.BigIntegerField()),
+                ('sent_ts', models.BigIntegerField(db_index=True)),
+                ('fcm_latency_ms', models.IntegerField(null=True)),
+                ('outcome', models.CharField(max_length=16)),
+                ('response_ts', models.BigIntegerField(null=True)),
+                ('response_latency_ms', models.BigIntegerField(null=True)),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to=settings.AUTH_USER_MODEL)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='ResponseMetric',
+            fields=[
+                ('id', models.AutoField(primary_key=True, serialize=False)),
+                ('day_ts', models.BigIntegerField()),
+                ('pushes', models.IntegerField(default=0)),
+                ('delivered', models.IntegerField(default=0)),
+                ('responded', models.IntegerField(default=0)),
+                ('response_p50_ms', models.BigIntegerField(null=True)),
+                ('lag_p50_ms', models.BigIntegerField(null=True)),
+                ('lag_p95_ms', models.BigIntegerField(null=True)),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'constraints': [models.UniqueConstraint(fields=('user', 'day_ts'), name='unique_response_metric')],
+            },
+        ),
+    ]
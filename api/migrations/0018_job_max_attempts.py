@@ -0,0 +1,18 @@
+# Generated by Django 5.2.18 on 2026-10-20 02:50
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0017_pushdelivery_responsemetric'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='job',
+            name='max_attempts',
+            field=models.IntegerField(null=True),
+        ),
+    ]
@@ -0,0 +1,34 @@
+# Generated by Django 5.2.18 on 2026-10-20 02:52
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0018_job_max_attempts'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ThrottleBucket',
+            fields=[
+                ('key', models.CharField(max_length=128, primary_key=True, serialize=False)),
+                ('tokens', models.FloatField()),
+                ('updated_ts', models.FloatField(db_index=True)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='ThrottleCount',
+            fields=[
+                ('id', models.AutoField(primary_key=True, serialize=False)),
+                ('scope', models.CharField(max_length=16)),
+                ('outcome', models.CharField(max_length=16)),
+                ('hour', models.BigIntegerField()),
+                ('count', models.IntegerField(default=0)),
+            ],
+            options={
+                'constraints': [models.UniqueConstraint(fields=('scope', 'outcome', 'hour'), name='unique_throttle_count')],
+            },
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.2.18 on 2026-10-20 02:57
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0019_throttlebucket_throttlecount'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='emaschedule',
+            name='claimed_ts',
+            field=models.BigIntegerField(null=True),
+        ),
+    ]
@@ -0,0 +1,19 @@
+# Generated by Django 5.2.18 on 2026-10-20 03:04
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0020_emaschedule_claimed_ts'),
+    ]
+
+    operations = [
+        migrations.DeleteModel(
+            name='ThrottleBucket',
+        ),
+        migrations.DeleteModel(
+            name='ThrottleCount',
+        ),
+    ]
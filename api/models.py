@@ -32,6 +32,9 @@ class OffBody(mdl.Model):
   timestamp = mdl.BigIntegerField(db_index = True)
   is_off_body = mdl.BooleanField()
 
+  class Meta:
+    constraints = [mdl.UniqueConstraint(fields = ['user', 'timestamp'], name = 'unique_off_body')]
+
 
 class Location(mdl.Model):
   id = mdl.AutoField(primary_key = True)
@@ -83,3 +86,91 @@ class CalendarEvent(mdl.Model):
   start_ts = mdl.BigIntegerField()
   end_ts = mdl.BigIntegerField()
   event_location = mdl.CharField(null = True, max_length = 256)
+
+
+class WatchUpload(mdl.Model):
+  id = mdl.AutoField(primary_key = True)
+  user = mdl.ForeignKey(to = 'User', on_delete = mdl.CASCADE, db_index = True)
+  timestamp = mdl.BigIntegerField()
+  kind = mdl.CharField(max_length = 16)
+  size = mdl.BigIntegerField()
+  digest = mdl.CharField(max_length = 32)
+  segment = mdl.CharField(max_length = 128, null = True)
+
+  class Meta:
+    constraints = [mdl.UniqueConstraint(fields = ['user', 'kind', 'size', 'digest'], name = 'unique_watch_upload')]
+
+
+class Job(mdl.Model):
+  id = mdl.AutoField(primary_key = True)
+  name = mdl.CharField(max_length = 64)
+  payload = mdl.JSONField(default = dict)
+  status = mdl.CharField(max_length = 16, default = 'pending')
+  attempts = mdl.IntegerField(default = 0)
+  max_attempts = mdl.IntegerField(null = True)   # None: jobs.MAX_ATTEMPTS
+  error = mdl.TextField(null = True)
+  result = mdl.JSONField(null = True)   # return value of the handler
+  created_ts = mdl.BigIntegerField()
+  run_after_ts = mdl.BigIntegerField()
+  started_ts = mdl.BigIntegerField(null = True)
+  finished_ts = mdl.BigIntegerField(null = True)
+
+  class Meta:
+    indexes = [mdl.Index(fields = ['status', 'run_after_ts'], name = 'job_queue_idx')]
+
+
+class MinuteSummary(mdl.Model):
+  id = mdl.AutoField(primary_key = True)
+  user = mdl.ForeignKey(to = 'User', on_delete = mdl.CASCADE, db_index = True)
+  timestamp = mdl.BigIntegerField()   # start of the minute
+  ppg_count = mdl.IntegerField(default = 0)
+  heart_rate = mdl.FloatField(null = True)
+  acc_count = mdl.IntegerField(default = 0)
+  acc_mean = mdl.FloatField(null = True)
+  acc_std = mdl.FloatField(null = True)
+  acc_enmo = mdl.FloatField(null = True)
+
+  class Meta:
+    constraints = [mdl.UniqueConstraint(fields = ['user', 'timestamp'], name = 'unique_minute_summary')]
+
+
+class EmaSchedule(mdl.Model):
+  id = mdl.AutoField(primary_key = True)
+  user = mdl.ForeignKey(to = 'User', on_delete = mdl.CASCADE, db_index = True)
+  planned_ts = mdl.BigIntegerField(db_index = True)
+  sent_ts = mdl.BigIntegerField(null = True)
+  status = mdl.CharField(max_length = 16, default = 'pending')   # pending, sending, sent, failed, missed
+  claimed_ts = mdl.BigIntegerField(null = True)   # taken for sending by a push service instance
+
+
+class PushDelivery(mdl.Model):
+  id = mdl.AutoField(primary_key = True)
+  user = mdl.ForeignKey(to = 'User', on_delete = mdl.CASCADE, db_index = True)
+  source = mdl.CharField(max_length = 16)   # scheduled, manual, cohort
+  planned_ts = mdl.BigIntegerField()
+  sent_ts = mdl.BigIntegerField(db_index = True)
+  fcm_latency_ms = mdl.IntegerField(null = True)   # of the (batch) request, None: not requested (e.g., no token)
+  outcome = mdl.CharField(max_length = 16)   # sent, no_token, unregistered, unavailable, failed
+  response_ts = mdl.BigIntegerField(null = True)   # the self-report answering the push
+  response_latency_ms = mdl.BigIntegerField(null = True)
+
+
+class ResponseMetric(mdl.Model):
+  id = mdl.AutoField(primary_key = True)
+  user = mdl.ForeignKey(to = 'User', on_delete = mdl.CASCADE, db_index = True)
+  day_ts = mdl.BigIntegerField()   # local midnight
+  pushes = mdl.IntegerField(default = 0)
+  delivered = mdl.IntegerField(default = 0)
+  responded = mdl.IntegerField(default = 0)
+  response_p50_ms = mdl.BigIntegerField(null = True)
+  lag_p50_ms = mdl.BigIntegerField(null = True)   # sent after planned
+  lag_p95_ms = mdl.BigIntegerField(null = True)
+
+  class Meta:
+    constraints = [mdl.UniqueConstraint(fields = ['user', 'day_ts'], name = 'unique_response_metric')]
+
+
+class PushWorker(mdl.Model):
+  id = mdl.AutoField(primary_key = True)
+  name = mdl.CharField(max_length = 128, unique = True)   # host and process of a push service instance
+  heartbeat_ts = mdl.BigIntegerField(db_index = True)
@@ -0,0 +1,174 @@
+from typing import TYPE_CHECKING, Callable, Dict, List, Optional
+from importlib import import_module
+from itertools import count
+from os import environ
+import random
+import time
+
+# firebase_admin (and google-auth) are imported on first use: web workers that never push don't pay for them
+if TYPE_CHECKING:
+  from firebase_admin import messaging
+  from firebase_admin import exceptions
+  import firebase_admin
+
+BATCH_SIZE = 500   # limit of a single send_each call
+TITLE = 'Stress report time!'
+BODY = 'Please log your current situation and stress levels.'
+CHANNEL_ID = 'sosw.app.push'
+RETRY_BASE_DELAY = 2   # seconds, doubles with every attempt
+RETRY_MAX_DELAY = 5*60
+RETRY_MAX_ATTEMPTS = 6
+BREAKER_THRESHOLD = 3   # failed requests in a row open the circuit
+BREAKER_RESET_TIMEOUT = 60   # seconds until a trial request
+TRANSIENT_ERRORS = [   # (module, name)
+  ('firebase_admin.exceptions', 'UnavailableError'),
+  ('firebase_admin.exceptions', 'InternalError'),
+  ('firebase_admin.exceptions', 'DeadlineExceededError'),
+  ('firebase_admin.exceptions', 'UnknownError'),
+  ('firebase_admin.messaging', 'QuotaExceededError'),
+]
+
+backend = None   # firebase_admin.messaging, or a FakeMessaging (FCM_BACKEND=fake)
+
+
+class FakeMessaging:
+  """ Local stand-in for firebase_admin.messaging: records messages, no network access """
+
+  def __init__(self, unregistered: Optional[set] = None, latency: float = 0.0, sleep: Callable[[float], None] = time.sleep):
+    self.unregistered = set(unregistered or [])   # tokens of uninstalled apps
+    self.latency = latency   # seconds per request (round trip)
+    self.sleep = sleep   # e.g., advancing a virtual clock instead of waiting
+    self.down = False   # an FCM outage: every message fails with UnavailableError
+    self.messages: List['messaging.Message'] = list()
+    self.requests = 0
+    self._ids = count()
+
+  def _send(self, message: 'messaging.Message') -> 'messaging.SendResponse':
+    from firebase_admin import messaging
+    from firebase_admin import exceptions
+
+    if self.down:
+      return messaging.SendResponse(None, exceptions.UnavailableError('The service is currently unavailable.'))
+    if message.token in self.unregistered:
+      return messaging.SendResponse(None, messaging.UnregisteredError('Requested entity was not found.'))
+    self.messages.append(message)
+    return messaging.SendResponse(dict(name = f'projects/fake/messages/{next(self._ids)}'), None)
+
+  def send(self, message: 'messaging.Message', dry_run: bool = False, app = None) -> str:
+    self.requests += 1
+    self.sleep(self.latency)
+    response = self._send(message)
+    if response.exception: raise response.exception
+    return response.message_id
+
+  def send_each(self, messages: List['messaging.Message'], dry_run: bool = False, app = None) -> 'messaging.BatchResponse':
+    from firebase_admin import messaging
+
+    self.requests += 1
+    self.sleep(self.latency)
+    return messaging.BatchResponse([self._send(x) for x in messages])
+
+
+def get_backend():
+  global backend
+  if backend is None:
+    from firebase_admin import messaging
+    backend = FakeMessaging() if environ.get('FCM_BACKEND') == 'fake' else messaging
+  return backend
+
+
+def get_app() -> Optional['firebase_admin.App']:
+  import firebase_admin
+  import firebase_admin.credentials
+
+  if isinstance(get_backend(), FakeMessaging): return None
+  if not firebase_admin._apps:
+    firebase_admin.initialize_app(credential = firebase_admin.credentials.Certificate('fcm_secret.json'))
+  return firebase_admin.get_app()
+
+
+def get_ema_message(token: str) -> 'messaging.Message':
+  from firebase_admin import messaging
+
+  return messaging.Message(
+    android = messaging.AndroidConfig(
+      priority = 'high',
+      notification = messaging.AndroidNotification(
+        title = TITLE,
+        body = BODY,
+        channel_id = CHANNEL_ID,
+      ),
+    ),
+    token = token,
+  )
+
+
+def send_ema_pushes(
+  tokens: Dict[int, str],
+  latencies: Optional[Dict[int, int]] = None,
+) -> Dict[int, Optional['exceptions.FirebaseError']]:
+  """ Sends EMA push notifications (user id -> fcm token) in batches, returns None or the error per user id """
+
+  ans = dict()
+  user_ids = list(tokens)
+  for i in range(0, len(user_ids), BATCH_SIZE):
+    batch = user_ids[i:i + BATCH_SIZE]
+    started = time.perf_counter()
+    res = get_backend().send_each([get_ema_message(tokens[x]) for x in batch], app = get_app())
+    if latencies is not None: latencies.update(dict.fromkeys(batch, int((time.perf_counter() - started)*1000)))   # milliseconds of the batch request
+    for user_id, response in zip(batch, res.responses):   # responses follow the order of messages
+      ans[user_id] = None if response.success else response.exception
+  return ans
+
+
+def get_outcome(error: Optional[Exception]) -> str:
+  """ Names the result of a push: sent, unregistered, unavailable (transient) or failed """
+
+  from firebase_admin import messaging
+
+  if error is None: return 'sent'
+  if isinstance(error, messaging.UnregisteredError): return 'unregistered'
+  if is_transient(error): return 'unavailable'
+  return 'failed'
+
+
+def is_transient(error: Exception) -> bool:
+  """ Whether sending may succeed later (e.g., an FCM outage), as opposed to a bad or expired token """
+
+  if error is None: return False
+  return isinstance(error, tuple(getattr(import_module(module), name) for module, name in TRANSIENT_ERRORS))
+
+
+def get_retry_delay(attempt: int) -> float:
+  """ Returns seconds to wait before a retry: exponential backoff with full jitter (retries of a cohort spread out) """
+
+  return random.uniform(0, min(RETRY_MAX_DELAY, RETRY_BASE_DELAY*2**attempt))
+
+
+class CircuitBreaker:
+  """ Stops sending while FCM is down: opens after failed requests in a row, allows a trial request after a timeout """
+
+  def __init__(self, clock: Callable[[], float] = time.time, threshold: int = BREAKER_THRESHOLD, reset_timeout: float = BREAKER_RESET_TIMEOUT):
+    self.clock = clock
+    self.threshold = threshold
+    self.reset_timeout = reset_timeout
+    self.failures = 0
+    self.opened_at: Optional[float] = None
+
+  @property
+  def retry_at(self) -> float:
+    """ When the next (trial) request is allowed """
+
+    return self.clock() if self.opened_at is None else self.opened_at + self.reset_timeout
+
+  def allow(self) -> bool:
+    return self.opened_at is None or self.clock() >= self.retry_at
+
+  def record_success(self):
+    self.failures = 0
+    self.opened_at = None
+
+  def record_failure(self):
+    self.failures += 1
+    if self.failures >= self.threshold or self.opened_at is not None:   # a failed trial opens it again
+      self.opened_at = self.clock()
@@ -0,0 +1,107 @@
+from typing import Iterable, Optional
+from uuid import uuid4
+import json
+import time
+import re
+
+from django.core.files.uploadedfile import UploadedFile
+
+from os import makedirs, listdir, remove
+from os.path import join, exists, getsize
+import os
+
+from api import storage
+
+UPLOADS_DIRNAME = '.uploads'
+SESSION_MAX_AGE = 7*24*60*60   # seconds
+SESSION_MAX_SIZE = 512*1024*1024   # bytes, also the limit of sessions without a declared size
+SESSION_ID_REGEX = re.compile(r'^[0-9a-f]{32}$')
+
+
+class AssembledUploadedFile(UploadedFile):
+  """ A completely received resumable upload, handed over to the regular file upload path """
+
+  def __init__(self, path: str, name: str):
+    super().__init__(open(path, 'rb'), name = name, content_type = 'text/csv', size = getsize(path))
+    self.path = path
+
+  def temporary_file_path(self):
+    return self.path
+
+  def close(self):
+    try:
+      return self.file.close()
+    except FileNotFoundError:
+      pass
+
+
+def get_uploads_dir(email: str) -> str:
+  return join(storage.DATA_DUMP_DIR, email, UPLOADS_DIRNAME)
+
+
+def create_session(email: str, kind: str, name: str, size: Optional[int]) -> dict:
+  """ Starts a resumable upload, returns the session """
+
+  dirpath = get_uploads_dir(email)
+  makedirs(dirpath, exist_ok = True)
+  session = dict(id = uuid4().hex, kind = kind, name = name, size = size, created = int(time.time()))
+  open(join(dirpath, f'{session["id"]}.part'), 'wb').close()
+  with open(join(dirpath, f'{session["id"]}.json'), 'w') as w:
+    json.dump(session, w)
+  return session
+
+
+def get_session(email: str, session_id: str) -> Optional[dict]:
+  """ Returns the session with the number of bytes received so far, None if there is no such session """
+
+  if not SESSION_ID_REGEX.match(session_id): return None
+  path = join(get_uploads_dir(email), f'{session_id}.json')
+  if not exists(path): return None
+
+  with open(path, 'r') as r:
+    session = json.load(r)
+  session['offset'] = getsize(join(get_uploads_dir(email), f'{session_id}.part'))
+  return session
+
+
+def get_max_size(session: dict) -> int:
+  return session['size'] or SESSION_MAX_SIZE
+
+
+def write_chunk(email: str, session: dict, offset: int, chunks: Iterable[bytes]) -> int:
+  """ Writes a chunk at offset (which must be the received size), returns the new offset (past get_max_size: nothing more is written) """
+
+  fd = os.open(join(get_uploads_dir(email), f'{session["id"]}.part'), os.O_WRONLY)
+  try:
+    for chunk in chunks:
+      if offset + len(chunk) > get_max_size(session): return offset + len(chunk)   # the rest of the body is not read
+      os.pwrite(fd, chunk, offset)
+      offset += len(chunk)
+  finally:
+    os.close(fd)
+  return offset
+
+
+def open_assembled_file(email: str, session: dict) -> AssembledUploadedFile:
+  return AssembledUploadedFile(join(get_uploads_dir(email), f'{session["id"]}.part'), session['name'])
+
+
+def remove_session(email: str, session_id: str):
+  for ext in ['part', 'json']:
+    path = join(get_uploads_dir(email), f'{session_id}.{ext}')
+    if exists(path): remove(path)
+
+
+def remove_stale_sessions(email: str, max_age: int = SESSION_MAX_AGE) -> int:
+  """ Removes abandoned uploads, returns the number of removed sessions """
+
+  dirpath = get_uploads_dir(email)
+  if not exists(dirpath): return 0
+
+  ans = 0
+  for filename in listdir(dirpath):
+    # the part file is touched by every chunk
+    if filename.endswith('.part') and time.time() - os.stat(join(dirpath, filename)).st_mtime > max_age:
+      remove_session(email, filename[:-len('.part')])
+      ans += 1
+  return ans
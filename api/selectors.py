@@ -1,4 +1,5 @@
-from typing import Optional, List
+from typing import Dict, Optional, List
+from django.db.models import Avg, Count, F, Max, Sum
 from api import models as mdl
 from datetime import datetime as dt
 from dateutil import tz
@@ -26,6 +27,19 @@ def get_users(exclude_superusers = True) -> List[mdl.User]:
   return mdl.User.objects.all()
 
 
+def get_participants(ids: Optional[List[int]] = None) -> List[mdl.User]:
+  """ Returns participants that can receive push notifications (all of them, or those of the given ids) """
+
+  users = mdl.User.objects.filter(is_superuser = False).exclude(fcm_token__isnull = True).exclude(fcm_token = '')
+  return users if ids is None else users.filter(id__in = ids)
+
+
+def get_job(id: int, name: Optional[str] = None) -> Optional[mdl.Job]:
+  jobs = mdl.Job.objects.filter(id = id)
+  if name: jobs = jobs.filter(name = name)
+  return jobs.first()
+
+
 def get_fcm_token(id: int = None, email: str = None) -> mdl.User:
   if id: return mdl.User.objects.get(id = id).fcm_token
   if email: return mdl.User.objects.get(email = email).fcm_token
@@ -91,6 +105,71 @@ def get_offbody_count(user: mdl.User, from_ts: int, till_ts: int) -> List[mdl.Of
   ).count()
 
 
+def get_offbody_hourly_counts(user: mdl.User) -> Dict[int, int]:
+  """ Returns numbers of off-body data per hour (hour start timestamp -> count) """
+
+  hour_ms = 60*60*1000
+  counts = mdl.OffBody.objects.filter(user = user).annotate(hour = F('timestamp')/hour_ms).values('hour').annotate(count = Count('id'))
+  return {x['hour']*hour_ms: x['count'] for x in counts}
+
+
+def get_users_ema_schedules(user_ids: List[int], from_ts: int, till_ts: int) -> List[mdl.EmaSchedule]:
+  """ Returns planned EMA push notifications of many participants """
+
+  return mdl.EmaSchedule.objects.filter(
+    user_id__in = user_ids,
+    planned_ts__gte = from_ts,
+    planned_ts__lte = till_ts,
+  ).order_by('user_id', 'planned_ts')
+
+
+def get_minute_summaries(user: mdl.User, from_ts: int, till_ts: int) -> List[mdl.MinuteSummary]:
+  """ Returns per-minute smartwatch summaries """
+
+  return mdl.MinuteSummary.objects.filter(
+    user = user,
+    timestamp__gte = from_ts,
+    timestamp__lte = till_ts,
+  ).order_by('timestamp')
+
+
+def get_push_deliveries(from_ts: int) -> List[mdl.PushDelivery]:
+  """ Returns push attempts planned since the timestamp """
+
+  return mdl.PushDelivery.objects.filter(planned_ts__gte = from_ts).order_by('id')
+
+
+def get_self_report_times(user_ids: List[int], from_ts: int) -> List[tuple]:
+  """ Returns (user id, timestamp) of self-reports since the timestamp """
+
+  return list(mdl.SelfReport.objects.filter(user_id__in = user_ids, timestamp__gte = from_ts).values_list('user_id', 'timestamp'))
+
+
+def get_response_metrics(from_ts: int) -> Dict[int, dict]:
+  """ Returns push compliance (%) and response time (mean of daily medians, minutes) per user id since the day timestamp """
+
+  rows = mdl.ResponseMetric.objects.filter(day_ts__gte = from_ts).values('user_id').annotate(
+    delivered = Sum('delivered'),
+    responded = Sum('responded'),
+    response_ms = Avg('response_p50_ms'),
+    lag_ms = Max('lag_p95_ms'),
+  )
+  return {
+    x['user_id']: dict(
+      delivered = x['delivered'],
+      compliance = round(100*x['responded']/x['delivered']) if x['delivered'] else None,
+      response_minutes = round(x['response_ms']/60000, 1) if x['response_ms'] is not None else None,
+      lag_seconds = round(x['lag_ms']/1000, 1) if x['lag_ms'] is not None else None,
+    ) for x in rows
+  }
+
+
+def get_live_push_workers(since_ts: int) -> List[str]:
+  """ Returns names of push service instances with a heartbeat since the timestamp """
+
+  return list(mdl.PushWorker.objects.filter(heartbeat_ts__gte = since_ts).order_by('name').values_list('name', flat = True))
+
+
 def get_location_count(user: mdl.User, from_ts: int, till_ts: int) -> List[mdl.Location]:
   """ Returns list of locations data """
 
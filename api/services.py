@@ -1,8 +1,16 @@
-from typing import Iterable, List
+from typing import Dict, Iterable, List, Optional
 
+from django.core.files.uploadedfile import UploadedFile
+from django.db import IntegrityError, transaction
 from django.utils.timezone import datetime
 
 from api import models as mdl
+from api import storage
+from api import jobs
+from api import events
+from api import push
+
+UPLOAD_LEASE_MS = 10*60*1000   # a file not stored by then (e.g., a killed worker) is stored by a retry
 
 
 def create_user(
@@ -12,17 +20,29 @@ def create_user(
   gender: str,
   date_of_birth: str,
   password: str,
+  fcm_token: Optional[str] = None,
 ) -> mdl.User:
-  """ Creates a user object """
+  """ Creates a user object, a participant with an fcm token is announced to the push service """
 
-  return mdl.User.objects.create_user(
+  user = mdl.User.objects.create_user(
     username = username,
     email = email,
     full_name = full_name,
     gender = gender,
     date_of_birth = date_of_birth,
     password = password,
+    fcm_token = fcm_token or None,
   )
+  if user.fcm_token: events.notify_participant(user.id)
+  return user
+
+
+def set_fcm_token(user: mdl.User, fcm_token: str):
+  """ Updates the fcm token of a user, the push service plans notifications of the (new) participant """
+
+  user.fcm_token = fcm_token
+  user.save(update_fields = ['fcm_token'])
+  events.notify_participant(user.id)
 
 
 def create_self_report_data(
@@ -67,6 +87,18 @@ def create_off_body_data(
   )
 
 
+def create_off_body_data_bulk(
+  user: mdl.User,
+  timestamps: Iterable[int],
+  is_off_body: Iterable[bool],
+) -> int:
+  """ Creates off-body data records in bulk (already stored ones are skipped), returns the number of given records """
+
+  objs = [mdl.OffBody(user = user, timestamp = x, is_off_body = y) for x, y in zip(timestamps, is_off_body)]
+  mdl.OffBody.objects.bulk_create(objs, batch_size = 5000, ignore_conflicts = True)
+  return len(objs)
+
+
 def create_location_data(
   user: mdl.User,
   timestamp: datetime,
@@ -169,3 +201,165 @@ def create_activity_recognition_data(
     activity = activity,
     confidence = confidence,
   )
+
+
+def update_minute_summaries(user: mdl.User, summaries: Dict[int, dict]) -> int:
+  """ Creates or overwrites fields of per-minute summaries (minute start timestamp -> fields), returns their number """
+
+  if not summaries: return 0
+  fields = sorted(set(x for summary in summaries.values() for x in summary))
+  mdl.MinuteSummary.objects.bulk_create(
+    [mdl.MinuteSummary(user = user, timestamp = ts, **summary) for ts, summary in summaries.items()],
+    batch_size = 5000,
+    update_conflicts = True,
+    unique_fields = ['user', 'timestamp'],
+    update_fields = fields,
+  )
+  return len(summaries)
+
+
+def create_ema_schedules(user: mdl.User, planned_timestamps: Iterable[int]) -> List[mdl.EmaSchedule]:
+  """ Creates planned EMA push notifications of a participant """
+
+  return mdl.EmaSchedule.objects.bulk_create([mdl.EmaSchedule(user = user, planned_ts = x) for x in planned_timestamps])
+
+
+def create_ema_schedules_bulk(planned_timestamps: Dict[int, Iterable[int]]) -> List[mdl.EmaSchedule]:
+  """ Creates planned EMA push notifications of many participants (user id -> timestamps) """
+
+  return mdl.EmaSchedule.objects.bulk_create([
+    mdl.EmaSchedule(user_id = user_id, planned_ts = x) for user_id, timestamps in planned_timestamps.items() for x in timestamps
+  ], batch_size = 5000)
+
+
+def claim_ema_schedules(schedule_ids: Iterable[int], claimed_ts: Optional[int] = None) -> List[int]:
+  """ Marks pending EMA push notifications as being sent, returns ids of those not taken or cancelled already """
+
+  # rows locked by another push service instance are skipped, it sends them
+  with transaction.atomic():
+    ans = list(mdl.EmaSchedule.objects.select_for_update(skip_locked = True).filter(
+      id__in = list(schedule_ids),
+      status = 'pending',
+    ).values_list('id', flat = True))
+    claimed_ts = int(datetime.now().timestamp()*1000) if claimed_ts is None else claimed_ts
+    mdl.EmaSchedule.objects.filter(id__in = ans).update(status = 'sending', claimed_ts = claimed_ts)
+  return ans
+
+
+def release_ema_schedules(schedule_ids: Iterable[int]) -> List[mdl.EmaSchedule]:
+  """ Puts EMA push notifications left as being sent (e.g., by a crashed push service instance) back to pending, returns them """
+
+  with transaction.atomic():
+    ans = list(mdl.EmaSchedule.objects.select_for_update(skip_locked = True).filter(id__in = list(schedule_ids), status = 'sending'))
+    mdl.EmaSchedule.objects.filter(id__in = [x.id for x in ans]).update(status = 'pending', claimed_ts = None)
+  return ans
+
+
+def update_ema_schedules(schedule_ids: Iterable[int], status: str, sent_ts: Optional[int] = None):
+  mdl.EmaSchedule.objects.filter(id__in = list(schedule_ids)).update(status = status, sent_ts = sent_ts)
+
+
+def queue_ema_pushes(user_ids: Optional[List[int]] = None) -> mdl.Job:
+  """ Queues EMA push notifications to participants (None: all active participants), sent by a jobs worker """
+
+  # a single attempt: a retry would prompt the participants of batches sent already once more
+  return jobs.enqueue('send_ema_pushes', max_attempts = 1, user_ids = user_ids, queued_ts = jobs.now_ms())
+
+
+def create_push_deliveries(
+  source: str,
+  planned_ts: Dict[int, int],
+  sent_ts: int,
+  errors: Dict[int, Optional[Exception]],
+  latencies: Dict[int, int],
+) -> int:
+  """ Logs push attempts (user id -> planned time), users without a result had no fcm token, returns their number """
+
+  mdl.PushDelivery.objects.bulk_create([
+    mdl.PushDelivery(
+      user_id = user_id,
+      source = source,
+      planned_ts = ts,
+      sent_ts = sent_ts,
+      fcm_latency_ms = latencies.get(user_id),
+      outcome = push.get_outcome(errors[user_id]) if user_id in errors else 'no_token',
+    ) for user_id, ts in planned_ts.items()
+  ], batch_size = 5000)
+  return len(planned_ts)
+
+
+def update_push_responses(delivery_ids: List[int], response_timestamps: List[Optional[int]], sent_timestamps: List[int]):
+  """ Stores the self-report answering each push (None: unanswered) """
+
+  mdl.PushDelivery.objects.bulk_update([
+    mdl.PushDelivery(
+      id = x,
+      response_ts = response_ts,
+      response_latency_ms = None if response_ts is None else response_ts - sent_ts,
+    ) for x, response_ts, sent_ts in zip(delivery_ids, response_timestamps, sent_timestamps)
+  ], fields = ['response_ts', 'response_latency_ms'], batch_size = 5000)
+
+
+def update_response_metrics(metrics: Dict[tuple, dict]) -> int:
+  """ Creates or overwrites daily push metrics ((user id, day timestamp) -> fields), returns their number """
+
+  if not metrics: return 0
+  fields = sorted(set(x for metric in metrics.values() for x in metric))
+  mdl.ResponseMetric.objects.bulk_create(
+    [mdl.ResponseMetric(user_id = user_id, day_ts = day_ts, **metric) for (user_id, day_ts), metric in metrics.items()],
+    batch_size = 5000,
+    update_conflicts = True,
+    unique_fields = ['user', 'day_ts'],
+    update_fields = fields,
+  )
+  return len(metrics)
+
+
+def clear_fcm_tokens(user_ids: Iterable[int]):
+  """ Forgets fcm tokens of participants (e.g., uninstalled apps) """
+
+  mdl.User.objects.filter(id__in = list(user_ids)).update(fcm_token = None)
+
+
+def beat_push_worker(name: str, ts: int):
+  """ Records that a push service instance is alive """
+
+  mdl.PushWorker.objects.update_or_create(name = name, defaults = dict(heartbeat_ts = ts))
+
+
+def remove_push_workers(names: Iterable[str] = None, before_ts: Optional[int] = None):
+  """ Removes push service instances that stopped (names) or died long ago (heartbeats before a timestamp) """
+
+  if names is not None: mdl.PushWorker.objects.filter(name__in = list(names)).delete()
+  if before_ts is not None: mdl.PushWorker.objects.filter(heartbeat_ts__lt = before_ts).delete()
+
+
+def create_watch_upload(user: mdl.User, kind: str, file: UploadedFile) -> Optional[mdl.WatchUpload]:
+  """ Stores a smartwatch file and queues its processing, returns None if the same file was uploaded before (e.g., a retry) """
+
+  size, digest = storage.get_fingerprint(file)
+  ts = int(datetime.now().timestamp()*1000)
+  try:
+    with transaction.atomic():
+      upload = mdl.WatchUpload.objects.create(
+        user = user,
+        timestamp = ts,
+        kind = kind,
+        size = size,
+        digest = digest,
+      )
+  except IntegrityError:
+    # a row without a segment is a store that never finished: a retry takes it over once the lease ran out
+    upload = mdl.WatchUpload.objects.get(user = user, kind = kind, size = size, digest = digest)
+    taken = mdl.WatchUpload.objects.filter(id = upload.id, segment__isnull = True, timestamp__lt = ts - UPLOAD_LEASE_MS).update(timestamp = ts)
+    if not taken: return None
+
+  try:
+    upload.segment = storage.store_upload(user.email, kind, file)['name']
+  except Exception:
+    upload.delete()   # let the client retry
+    raise
+  with transaction.atomic():
+    upload.save(update_fields = ['segment'])
+    jobs.enqueue('index_watch_segment', user_id = user.id, kind = kind, segment = upload.segment)
+  return upload
@@ -0,0 +1,795 @@
+from typing import BinaryIO, Iterable, Iterator, List, Optional, Tuple
+from datetime import datetime as dt
+from datetime import timezone
+from heapq import merge
+from uuid import uuid4
+from io import BytesIO
+import hashlib
+import fcntl
+import shutil
+import gzip
+import json
+import time
+
+from django.core.files.uploadedfile import UploadedFile
+
+from os import environ, makedirs, listdir, remove, replace
+from os.path import join, basename, exists, isdir
+import os
+
+import numpy as np
+
+DATA_DUMP_DIR = environ['DATA_DUMP_DIR']
+CODEC = environ.get('WATCH_DATA_CODEC', 'gzip')   # raw segments: 'gzip' frames or 'none'
+
+KINDS = ['ppg', 'acc', 'offbody']
+SEGMENTS_DIRNAME = 'segments'
+RAW_DIRNAME = 'raw'
+QUARANTINE_DIRNAME = 'quarantine'
+MANIFEST_FILENAME = 'manifest.jsonl'
+DAY_MS = 24*60*60*1000
+TZ_OFFSET_MS = 9*60*60*1000   # Asia/Seoul (UTC+9, no DST), same days as the DQ plots
+TIMESTAMP_DTYPE = np.int64
+MAX_TIMESTAMP = 4102444800000   # 2100-01-01, later ones are not millisecond timestamps (e.g., microseconds)
+VALUE_DTYPE = np.float32
+COMPACTION_MAX_ROWS = 1_000_000
+COMPACTION_RAW_MAX_SIZE = 16*1024*1024
+COMPACTION_RAW_TARGET_SIZE = 64*1024*1024
+COMPACTION_RAW_MAX_SEGMENTS = 256   # segments merged at once, each holds an open file and a decompressed frame
+EXPORT_BLOCK_ROWS = 10_000
+CHUNK_SIZE = 1024*1024
+INGEST_BLOCK_SIZE = 8*1024*1024
+FRAME_SIZE = 256*1024
+GZIP_LEVEL = 6
+
+
+def get_segments_dir(email: str, kind: str) -> str:
+  return join(DATA_DUMP_DIR, email, SEGMENTS_DIRNAME, kind)
+
+
+def get_day(timestamp: int) -> str:
+  """ Returns the (Asia/Seoul) day directory name of a millisecond timestamp """
+
+  day = (int(timestamp) + TZ_OFFSET_MS)//DAY_MS
+  return dt.fromtimestamp(day*DAY_MS/1000, tz = timezone.utc).strftime('%Y%m%d')
+
+
+def get_day_range(day: str) -> Tuple[int, int]:
+  """ Returns the first and last millisecond timestamps of a day directory """
+
+  from_ts = int(dt.strptime(day, '%Y%m%d').replace(tzinfo = timezone.utc).timestamp()*1000) - TZ_OFFSET_MS
+  return from_ts, from_ts + DAY_MS - 1
+
+
+def validate_csv(data: bytes) -> Tuple[np.ndarray, np.ndarray, List[bytes]]:
+  """ Parses raw smartwatch csv content with vectorized checks, returns (timestamps, values) and rejected lines """
+
+  data = data.replace(b'\r', b'')
+  for word, number in [(b'true', b'1'), (b'false', b'0'), (b'True', b'1'), (b'False', b'0')]:
+    if word in data: data = data.replace(word, number)   # boolean columns (e.g., off-body)
+  if not data.endswith(b'\n'): data += b'\n'
+  buf = np.frombuffer(data, dtype = np.uint8)
+  ends = np.flatnonzero(buf == ord('\n'))
+  starts = np.r_[0, ends[:-1] + 1]
+
+  # per line: number of cells and whether the first cell is a non-empty digit string
+  is_comma = buf == ord(',')
+  commas = np.r_[0, np.cumsum(is_comma)]
+  non_digits = np.r_[0, np.cumsum((buf < ord('0')) | (buf > ord('9')))]
+  comma_pos = np.r_[np.flatnonzero(is_comma), len(buf)]
+  ts_ends = np.minimum(comma_pos[np.searchsorted(comma_pos, starts)], ends)
+  widths = commas[ends] - commas[starts] + 1
+  valid = (ts_ends > starts) & (non_digits[ts_ends] == non_digits[starts])   # headers and broken lines fail
+  width = int(np.bincount(widths[valid]).argmax()) if valid.any() else 1   # the most common row format, not a truncated first line
+  valid &= widths == width
+
+  text = buf[np.repeat(valid, ends - starts + 1)].tobytes().replace(b'\n', b',')[:-1]
+  try:
+    cells = np.fromstring(text, dtype = np.float64, sep = ',') if text else np.empty(0)
+  except ValueError:
+    cells = None
+  if cells is None or len(cells) != valid.sum()*width:
+    # a non-numeric cell: find the broken rows one by one
+    for i in np.flatnonzero(valid):
+      try:
+        [float(x) for x in data[starts[i]:ends[i]].split(b',')]
+      except ValueError:
+        valid[i] = False
+    text = buf[np.repeat(valid, ends - starts + 1)].tobytes().replace(b'\n', b',')[:-1]
+    cells = np.fromstring(text, dtype = np.float64, sep = ',') if text else np.empty(0)
+
+  cells = cells.reshape(-1, width)
+  broken = ~np.isfinite(cells).all(axis = 1) | (cells[:, 0] > MAX_TIMESTAMP)   # e.g., nan values, 16 or 20 digit timestamps
+  valid[np.flatnonzero(valid)[broken]] = False
+  cells = cells[~broken]
+  rejected = [data[i:j] for i, j in zip(starts[~valid & (ends > starts)], ends[~valid & (ends > starts)])]
+  return cells[:, 0].astype(TIMESTAMP_DTYPE), cells[:, 1:].astype(VALUE_DTYPE), rejected
+
+
+def parse_csv(data: bytes) -> Tuple[np.ndarray, np.ndarray]:
+  """ Parses raw smartwatch csv content into (timestamps, values) arrays """
+
+  timestamps, values, _ = validate_csv(data)
+  return timestamps, values
+
+
+def normalize(timestamps: np.ndarray, values: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+  """ Sorts samples by timestamp and drops exact duplicates (e.g., re-uploaded chunks) """
+
+  rows = _pack(timestamps, values)
+  _, first = np.unique(rows, return_index = True)
+  first = first[np.argsort(timestamps[first], kind = 'stable')]
+  return timestamps[first], values[first]
+
+
+def _pack(timestamps: np.ndarray, values: np.ndarray) -> np.ndarray:
+  # one opaque item per row, so rows can be compared, sorted and looked up as a whole
+  dtype = np.dtype([('timestamp', '<i8'), ('values', '<f4', (values.shape[1],))])
+  rows = np.empty(len(timestamps), dtype = dtype)
+  rows['timestamp'] = timestamps
+  rows['values'] = values
+  return rows.view(f'V{dtype.itemsize}')
+
+
+def _save(path: str, arr: np.ndarray):
+  tmp_path = f'{path}.{uuid4().hex}.tmp'
+  with open(tmp_path, 'wb') as wb:
+    np.save(wb, arr)
+  replace(tmp_path, path)
+
+
+def write_segments(email: str, kind: str, timestamps: np.ndarray, values: np.ndarray, name: Optional[str] = None) -> List[str]:
+  """ Stores samples as immutable per-day segments (a given name replaces earlier ones), returns their paths """
+
+  if len(timestamps) == 0: return list()
+
+  order = np.argsort(timestamps, kind = 'stable')
+  timestamps = np.ascontiguousarray(timestamps[order], dtype = TIMESTAMP_DTYPE)
+  values = np.ascontiguousarray(values[order], dtype = VALUE_DTYPE)
+
+  days = (timestamps + TZ_OFFSET_MS)//DAY_MS
+  bounds = np.flatnonzero(np.diff(days)) + 1
+  name = name or f'{int(time.time()*1000)}-{uuid4().hex}'
+
+  ans = list()
+  for i, j in zip(np.r_[0, bounds], np.r_[bounds, len(timestamps)]):
+    dirpath = join(get_segments_dir(email, kind), get_day(timestamps[i]))
+    makedirs(dirpath, exist_ok = True)
+
+    # values go first: a segment becomes visible to readers with its timestamps file
+    path = join(dirpath, name)
+    _save(f'{path}.val.npy', values[i:j])
+    _save(f'{path}.ts.npy', timestamps[i:j])
+    ans.append(path)
+
+  return ans
+
+
+def iter_line_blocks(chunks: Iterable[bytes], block_size: int = INGEST_BLOCK_SIZE) -> Iterator[bytes]:
+  """ Regroups byte chunks into blocks of whole lines, about block_size each """
+
+  pending = list()
+  pending_size = 0
+  for chunk in chunks:
+    pending.append(chunk)
+    pending_size += len(chunk)
+    if pending_size < block_size: continue
+
+    data = b''.join(pending)
+    start = 0
+    while len(data) - start >= block_size:
+      cut = data.rfind(b'\n', start, start + block_size) + 1
+      if not cut: cut = data.find(b'\n', start + block_size) + 1   # a line longer than a block
+      if not cut: break
+      yield data[start:cut]
+      start = cut
+    pending, pending_size = [data[start:]], len(data) - start
+
+  data = b''.join(pending)
+  if data: yield data
+
+
+def iter_file_chunks(path: str, chunk_size: int = CHUNK_SIZE) -> Iterator[bytes]:
+  with open(path, 'rb') as rb:
+    yield from iter(lambda: rb.read(chunk_size), b'')
+
+
+def get_quarantine_dir(email: str, kind: str) -> str:
+  return join(DATA_DUMP_DIR, email, QUARANTINE_DIRNAME, kind)
+
+
+def _drop_stored(email: str, kind: str, timestamps: np.ndarray, values: np.ndarray, name: str) -> Tuple[np.ndarray, np.ndarray]:
+  """ Drops sorted samples that other columnar segments hold already """
+
+  if len(timestamps) == 0: return timestamps, values
+
+  rows = _pack(timestamps, values)
+  keep = np.ones(len(timestamps), dtype = bool)
+  for day in list_days(email, kind, timestamps[0], timestamps[-1]):
+    for path in list_segments(email, kind, day):
+      if basename(path) == name: continue   # an earlier run of the same ingest
+      try:
+        stored_timestamps, stored_values = load_segment(path)
+      except FileNotFoundError:
+        continue   # merged away by compaction
+      if stored_values.shape[1] != values.shape[1]: continue
+
+      i = np.searchsorted(stored_timestamps, timestamps[0], side = 'left')
+      j = np.searchsorted(stored_timestamps, timestamps[-1], side = 'right')
+      if i < j: keep &= ~np.isin(rows, _pack(stored_timestamps[i:j], stored_values[i:j]))
+  return timestamps[keep], values[keep]
+
+
+def ingest(email: str, kind: str, chunks: Iterable[bytes], name: Optional[str] = None) -> dict:
+  """ Validates csv content and stores clean, sorted, de-duplicated columnar segments, returns the counts and time range """
+
+  name = name or f'{int(time.time()*1000)}-{uuid4().hex}'
+  quarantine_path = join(get_quarantine_dir(email, kind), f'{name}.csv')
+  if exists(quarantine_path): remove(quarantine_path)   # a repeated run
+
+  ans = dict(rows = 0, rejected = 0, duplicates = 0, from_ts = None, till_ts = None)
+  for i, block in enumerate(iter_line_blocks(chunks)):
+    timestamps, values, rejected = validate_csv(block)
+    if rejected:
+      makedirs(get_quarantine_dir(email, kind), exist_ok = True)
+      with open(quarantine_path, 'ab') as ab:
+        ab.writelines(x + b'\n' for x in rejected)
+      ans['rejected'] += len(rejected)
+
+    size = len(timestamps)
+    timestamps, values = normalize(timestamps, values)
+    timestamps, values = _drop_stored(email, kind, timestamps, values, f'{name}-{i}')
+    ans['duplicates'] += size - len(timestamps)
+    if len(timestamps) == 0: continue
+
+    write_segments(email, kind, timestamps, values, name = f'{name}-{i}')
+    ans['rows'] += len(timestamps)
+    ans['from_ts'] = min(int(timestamps.min()), ans['from_ts'] if ans['from_ts'] is not None else np.iinfo(np.int64).max)
+    ans['till_ts'] = max(int(timestamps.max()), ans['till_ts'] if ans['till_ts'] is not None else -1)
+  return ans
+
+
+def _write_upload(file: UploadedFile, path: str):
+  """ Writes an uploaded file to path in bounded chunks (uncompressed segments only, gzip frames are written by _write_frames) """
+
+  if hasattr(file, 'temporary_file_path'): return shutil.copyfile(file.temporary_file_path(), path)   # spooled to disk
+  with open(path, 'wb') as wb:
+    for chunk in file.chunks(CHUNK_SIZE):
+      wb.write(chunk)
+
+
+def get_raw_dir(email: str, kind: str) -> str:
+  return join(DATA_DUMP_DIR, email, RAW_DIRNAME, kind)
+
+
+def _ts_key(line: bytes) -> int:
+  ts = line.split(b',', 1)[0]
+  return int(ts) if ts.isdigit() else -1
+
+
+def _write_frames(chunks: Iterable[bytes], codec: str, wb: Optional[BinaryIO] = None) -> Tuple[List[list], int]:
+  """ Splits content into frames of whole lines (written to wb when given), returns the frame index and rows """
+
+  ans = list()
+  offset = 0
+  rows = 0
+  for block in iter_line_blocks(chunks, FRAME_SIZE):
+    data = gzip.compress(block, compresslevel = GZIP_LEVEL, mtime = 0) if codec == 'gzip' else block
+    if wb is not None: wb.write(data)
+
+    stamps = [x for x in map(_ts_key, block.splitlines()) if x >= 0]
+    ans.append([offset, len(data), min(stamps) if stamps else None, max(stamps) if stamps else None])
+    offset += len(data)
+    rows += len(stamps)
+  return ans, rows
+
+
+def _move(path: str, dst_path: str) -> bool:
+  try:
+    os.rename(path, dst_path)   # same filesystem: nothing is copied
+    return True
+  except OSError:
+    return False
+
+
+def _add_raw_segment(email: str, kind: str, record: dict, path: Optional[str] = None, file: Optional[UploadedFile] = None) -> dict:
+  """ Moves a file (or writes an upload) into a new raw segment and records it in the manifest """
+
+  dirpath = get_raw_dir(email, kind)
+  makedirs(dirpath, exist_ok = True)
+  name = f'{int(time.time()*1000)}-{uuid4().hex}.csv' + ('.gz' if CODEC == 'gzip' else '')
+  segment_path = join(dirpath, name)
+  tmp_path = join(dirpath, f'.{name}.tmp')
+  chunks = (lambda: file.chunks(CHUNK_SIZE)) if file is not None else (lambda: iter_file_chunks(path))
+
+  # segments appear atomically and are never modified, so concurrent uploads never touch the same file
+  if CODEC == 'gzip':
+    with open(tmp_path, 'wb') as wb:
+      frames, rows = _write_frames(chunks(), CODEC, wb)
+    os.replace(tmp_path, segment_path)
+    if file is None: remove(path)
+  else:
+    frames, rows = _write_frames(chunks(), CODEC)
+    if path is None or not _move(path, segment_path):
+      if file is not None: _write_upload(file, tmp_path)
+      else: shutil.copyfile(path, tmp_path)
+      os.replace(tmp_path, segment_path)
+
+  stamps = [x for frame in frames for x in frame[2:] if x is not None]
+  record = dict(
+    name = name,
+    size = os.stat(segment_path).st_size,
+    created = int(time.time()*1000),
+    codec = CODEC,
+    from_ts = min(stamps) if stamps else None,
+    till_ts = max(stamps) if stamps else None,
+    frames = frames,
+    rows = rows,
+    **record,
+  )
+  _append_manifest(dirpath, record)
+  return record
+
+
+def _lock_dir(dirpath: str, operation: int) -> int:
+  # appends share the lock, a manifest rewrite takes it exclusively so no append lands in the replaced file
+  fd = os.open(dirpath, os.O_RDONLY)
+  fcntl.flock(fd, operation)
+  return fd
+
+
+def _append_manifest(dirpath: str, record: dict):
+  # a single O_APPEND write: concurrent writers never interleave within a line
+  line = (json.dumps(record, separators = (',', ':')) + '\n').encode()
+  lock = _lock_dir(dirpath, fcntl.LOCK_SH)
+  try:
+    fd = os.open(join(dirpath, MANIFEST_FILENAME), os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o644)
+    try:
+      os.write(fd, line)
+    finally:
+      os.close(fd)
+  finally:
+    os.close(lock)
+
+
+def _rewrite_manifest(dirpath: str) -> bool:
+  """ Replaces the manifest with one line per live raw segment (dropping replaced ones and index markers) """
+
+  lock = _lock_dir(dirpath, fcntl.LOCK_EX)
+  try:
+    records, lines = _read_manifest(dirpath)
+    if lines == len(records): return False
+
+    tmp_path = join(dirpath, f'.{uuid4().hex}.tmp')
+    with open(tmp_path, 'wb') as wb:
+      wb.writelines((json.dumps(x, separators = (',', ':')) + '\n').encode() for x in records.values())
+    replace(tmp_path, join(dirpath, MANIFEST_FILENAME))
+    return True
+  finally:
+    os.close(lock)
+
+
+def get_fingerprint(file: UploadedFile) -> Tuple[int, str]:
+  """ Returns size and a fast 128-bit hash of an uploaded file """
+
+  size = 0
+  digest = hashlib.blake2b(digest_size = 16)
+  for chunk in file.chunks(CHUNK_SIZE):
+    size += len(chunk)
+    digest.update(chunk)
+  return size, digest.hexdigest()
+
+
+def store_upload(email: str, kind: str, file: UploadedFile) -> dict:
+  """ Stores an upload as a new raw segment (not indexed yet, see index_segment), returns the manifest record """
+
+  path = file.temporary_file_path() if hasattr(file, 'temporary_file_path') else None
+  return _add_raw_segment(email, kind, dict(indexed = False), path = path, file = file)
+
+
+def index_segment(email: str, kind: str, name: str) -> int:
+  """ Builds the (validated) columnar copy of a raw segment (repeatable), returns the number of stored rows """
+
+  record = get_raw_segment(email, kind, name)
+  if record is None: return 0   # removed meanwhile
+
+  # columnar segments are named after the raw segment: a repeated run replaces its own files
+  dirpath = get_raw_dir(email, kind)
+  rows = ingest(email, kind, _iter_frames(dirpath, record), name = name.split('.')[0])['rows']
+  if not record.get('indexed', True): _append_manifest(dirpath, dict(indexed = name))
+  return rows
+
+
+def get_raw_segment(email: str, kind: str, name: str) -> Optional[dict]:
+  return next((x for x in get_raw_segments(email, kind, upload_order = True) if x['name'] == name), None)
+
+
+def iter_samples(email: str, kind: str, name: str) -> Iterator[Tuple[np.ndarray, np.ndarray]]:
+  """ Yields validated (timestamps, values) blocks of a raw segment """
+
+  record = get_raw_segment(email, kind, name)
+  if record is None: raise FileNotFoundError(f'raw segment {name} of {kind} was removed (e.g., merged by compaction)')
+
+  for block in iter_line_blocks(_iter_frames(get_raw_dir(email, kind), record)):
+    timestamps, values, _ = validate_csv(block)
+    if len(timestamps) > 0: yield timestamps, values
+
+
+def get_raw_segments(email: str, kind: str, upload_order: bool = False) -> List[dict]:
+  """ Returns manifest records of live raw segments in timestamp (or manifest) order """
+
+  records, _ = _read_manifest(get_raw_dir(email, kind))
+  if upload_order: return list(records.values())
+
+  no_ts = np.iinfo(np.int64).max
+  return sorted(records.values(), key = lambda x: (x['from_ts'] if x['from_ts'] is not None else no_ts, x['name']))
+
+
+def _read_manifest(dirpath: str) -> Tuple[dict, int]:
+  """ Replays the manifest, returns live records by name (in manifest order) and the number of lines """
+
+  path = join(dirpath, MANIFEST_FILENAME)
+  if not exists(path): return dict(), 0
+
+  records = dict()
+  lines = 0
+  with open(path, 'rb') as rb:
+    for line in rb:
+      if not line.endswith(b'\n'): continue   # being written
+      lines += 1
+      record = json.loads(line)
+      if 'indexed' in record and 'name' not in record:
+        if record['indexed'] in records: records[record['indexed']]['indexed'] = True
+        continue
+      for name in record.get('replaces', list()):
+        records.pop(name, None)
+      records[record['name']] = record
+  return records, lines
+
+
+def _overlaps(from_ts: Optional[int], till_ts: Optional[int], range_from_ts: Optional[int], range_till_ts: Optional[int]) -> bool:
+  if range_from_ts is None and range_till_ts is None: return True
+  if from_ts is None or till_ts is None: return False
+  return (range_from_ts is None or till_ts >= range_from_ts) and (range_till_ts is None or from_ts <= range_till_ts)
+
+
+def _iter_frames(dirpath: str, record: dict, from_ts: Optional[int] = None, till_ts: Optional[int] = None) -> Iterator[bytes]:
+  """ Yields decompressed frames of a raw segment that overlap [from_ts, till_ts] """
+
+  # segments from before compression was introduced are one plain frame
+  frames = record.get('frames', [[0, record['size'], record['from_ts'], record['till_ts']]])
+  codec = record.get('codec', 'none')
+  with open(join(dirpath, record['name']), 'rb') as rb:
+    for offset, length, frame_from_ts, frame_till_ts in frames:
+      if not _overlaps(frame_from_ts, frame_till_ts, from_ts, till_ts): continue
+      rb.seek(offset)
+      if codec == 'gzip':
+        yield gzip.decompress(rb.read(length))
+      else:
+        chunks = (rb.read(min(CHUNK_SIZE, length - i)) for i in range(0, length, CHUNK_SIZE))
+        yield from iter_line_blocks(chunks, CHUNK_SIZE)
+
+
+def iter_raw(email: str, kind: str, from_ts: Optional[int] = None, till_ts: Optional[int] = None) -> Iterator[bytes]:
+  """ Yields raw csv content in segment timestamp order, only rows within [from_ts, till_ts] for a time range """
+
+  dirpath = get_raw_dir(email, kind)
+  for record in get_raw_segments(email, kind):
+    if not _overlaps(record['from_ts'], record['till_ts'], from_ts, till_ts): continue
+
+    last = b''
+    try:
+      for data in _iter_frames(dirpath, record, from_ts, till_ts):
+        if from_ts is not None or till_ts is not None:
+          data = b''.join(x for x in data.splitlines(keepends = True) if _in_range(_ts_key(x), from_ts, till_ts))
+        if data: yield data
+        last = data or last
+    except FileNotFoundError:
+      continue   # merged away by compaction
+    if last and not last.endswith(b'\n'): yield b'\n'
+
+
+def _in_range(ts: int, from_ts: Optional[int], till_ts: Optional[int]) -> bool:
+  return ts >= 0 and (from_ts is None or ts >= from_ts) and (till_ts is None or ts <= till_ts)
+
+
+def export_raw(email: str, kind: str, wb: BinaryIO, from_ts: Optional[int] = None, till_ts: Optional[int] = None) -> int:
+  """ Writes raw segments as one csv (legacy per-user file), returns the number of bytes """
+
+  ans = 0
+  for chunk in iter_raw(email, kind, from_ts, till_ts):
+    wb.write(chunk)
+    ans += len(chunk)
+  return ans
+
+
+def _iter_lines(dirpath: str, record: dict) -> Iterator[bytes]:
+  for data in _iter_frames(dirpath, record):
+    yield from (x if x.endswith(b'\n') else x + b'\n' for x in data.splitlines(keepends = True))
+
+
+def _iter_file_lines(path: str) -> Iterator[bytes]:
+  with open(path, 'rb') as rb:
+    yield from rb
+
+
+def _lines_in_order(lines: Iterable[bytes]) -> bool:
+  last = -1
+  for ts in map(_ts_key, lines):
+    if ts < last: return False
+    last = ts
+  return True
+
+
+def _sort_segment(dirpath: str, record: dict) -> str:
+  """ Writes the lines of a raw segment in timestamp order to a temporary file, returns its path """
+
+  lines = sorted(_iter_lines(dirpath, record), key = _ts_key)
+  path = join(dirpath, f'.{uuid4().hex}.tmp')
+  with open(path, 'wb') as wb:
+    wb.writelines(lines)
+  return path
+
+
+def compact_raw(email: str, kind: str, max_size: int = COMPACTION_RAW_MAX_SIZE, target_size: int = COMPACTION_RAW_TARGET_SIZE) -> int:
+  """ Merges small raw segments into timestamp-ordered ones, returns the number of removed segments """
+
+  dirpath = get_raw_dir(email, kind)
+  groups = [list()]
+  size = 0
+  for record in get_raw_segments(email, kind):
+    if record['size'] >= max_size or not record.get('indexed', True): continue   # waits for its columnar copy
+    if groups[-1] and (size + record['size'] > target_size or len(groups[-1]) >= COMPACTION_RAW_MAX_SEGMENTS):
+      groups.append(list())
+      size = 0
+    groups[-1].append(record)
+    size += record['size']
+
+  ans = 0
+  for records in groups:
+    if len(records) < 2: continue
+
+    # a k-way merge of per-segment ordered lines: only unordered segments are sorted, one at a time via a file
+    tmp_path = join(dirpath, f'.{uuid4().hex}.tmp')
+    sorted_paths = list()
+    try:
+      parts = list()
+      for record in records:
+        if _lines_in_order(_iter_lines(dirpath, record)):
+          parts.append(_iter_lines(dirpath, record))
+        else:
+          sorted_paths.append(_sort_segment(dirpath, record))
+          parts.append(_iter_file_lines(sorted_paths[-1]))
+      with open(tmp_path, 'wb') as wb:
+        wb.writelines(merge(*parts, key = _ts_key))
+    finally:
+      for path in sorted_paths:
+        remove(path)
+
+    _add_raw_segment(
+      email = email,
+      kind = kind,
+      path = tmp_path,
+      record = dict(replaces = [x['name'] for x in records]),
+    )
+    for record in records:
+      remove(join(dirpath, record['name']))
+    ans += len(records)
+
+  # keeps reads proportional to live segments, not to every upload and merge so far
+  if exists(join(dirpath, MANIFEST_FILENAME)): _rewrite_manifest(dirpath)
+  return ans
+
+
+def list_days(email: str, kind: str, from_ts: Optional[int] = None, till_ts: Optional[int] = None) -> List[str]:
+  dirpath = get_segments_dir(email, kind)
+  if not isdir(dirpath): return list()
+
+  days = sorted(x for x in listdir(dirpath) if x.isdigit())
+  if from_ts is not None: days = [x for x in days if x >= get_day(from_ts)]
+  if till_ts is not None: days = [x for x in days if x <= get_day(till_ts)]
+  return days
+
+
+def list_segments(email: str, kind: str, day: str) -> List[str]:
+  dirpath = join(get_segments_dir(email, kind), day)
+  if not isdir(dirpath): return list()
+  return [join(dirpath, x[:-len('.ts.npy')]) for x in sorted(listdir(dirpath)) if x.endswith('.ts.npy')]
+
+
+def load_segment(path: str) -> Tuple[np.ndarray, np.ndarray]:
+  """ Memory-maps a segment (no copies are made) """
+
+  return np.load(f'{path}.ts.npy', mmap_mode = 'r'), np.load(f'{path}.val.npy', mmap_mode = 'r')
+
+
+def iter_range(
+  email: str,
+  kind: str,
+  from_ts: Optional[int] = None,
+  till_ts: Optional[int] = None,
+) -> Iterator[Tuple[np.ndarray, np.ndarray]]:
+  """ Yields memory-mapped (timestamps, values) slices of segments within [from_ts, till_ts] """
+
+  for day in list_days(email, kind, from_ts, till_ts):
+    for path in list_segments(email, kind, day):
+      try:
+        timestamps, values = load_segment(path)
+      except FileNotFoundError:
+        continue   # merged away by compaction
+
+      i = 0 if from_ts is None else np.searchsorted(timestamps, from_ts, side = 'left')
+      j = len(timestamps) if till_ts is None else np.searchsorted(timestamps, till_ts, side = 'right')
+      if i < j: yield timestamps[i:j], values[i:j]
+
+
+def read_range(
+  email: str,
+  kind: str,
+  from_ts: Optional[int] = None,
+  till_ts: Optional[int] = None,
+) -> Tuple[np.ndarray, np.ndarray]:
+  """ Returns timestamp-ordered samples within [from_ts, till_ts], of the channel count most samples have """
+
+  parts = list(iter_range(email, kind, from_ts, till_ts))
+  if not parts: return np.empty(0, dtype = TIMESTAMP_DTYPE), np.empty((0, 0), dtype = VALUE_DTYPE)
+
+  # segments of a different watch app version (another channel count) cannot be stacked, they are left out
+  rows = dict()
+  for _, values in parts:
+    rows[values.shape[1]] = rows.get(values.shape[1], 0) + len(values)
+  channels = max(rows, key = rows.get)
+  parts = [x for x in parts if x[1].shape[1] == channels]
+  if len(parts) == 1: return parts[0]
+
+  timestamps = np.concatenate([x for x, _ in parts])
+  values = np.concatenate([x for _, x in parts])
+  if _in_order([x for x, _ in parts]): return timestamps, values
+
+  order = np.argsort(timestamps, kind = 'stable')
+  return timestamps[order], values[order]
+
+
+def read_timestamps(
+  email: str,
+  kind: str,
+  from_ts: Optional[int] = None,
+  till_ts: Optional[int] = None,
+) -> np.ndarray:
+  """ Returns sorted timestamps of samples within [from_ts, till_ts] """
+
+  parts = [x for x, _ in iter_range(email, kind, from_ts, till_ts)]
+  if not parts: return np.empty(0, dtype = TIMESTAMP_DTYPE)
+  if _in_order(parts): return np.concatenate(parts)
+  return np.sort(np.concatenate(parts), kind = 'stable')
+
+
+def _in_order(parts: List[np.ndarray]) -> bool:
+  # segments are sorted at ingest: consecutive uploads usually need no merge at all
+  return all(x[-1] <= y[0] for x, y in zip(parts, parts[1:]))
+
+
+def get_channels(email: str, kind: str, from_ts: Optional[int] = None, till_ts: Optional[int] = None) -> int:
+  """ Returns the number of values per sample (of the first segment within [from_ts, till_ts]) """
+
+  for _, values in iter_range(email, kind, from_ts, till_ts):
+    return values.shape[1]
+  return 0
+
+
+def iter_binary(email: str, kind: str, from_ts: Optional[int] = None, till_ts: Optional[int] = None) -> Iterator[bytes]:
+  """ Yields samples within [from_ts, till_ts] as little-endian records: int64 timestamp, float32 values """
+
+  channels = get_channels(email, kind, from_ts, till_ts)
+  for timestamps, values in iter_range(email, kind, from_ts, till_ts):
+    if values.shape[1] != channels: continue   # a different watch app version
+    for i in range(0, len(timestamps), EXPORT_BLOCK_ROWS):
+      yield _pack(timestamps[i:i + EXPORT_BLOCK_ROWS], values[i:i + EXPORT_BLOCK_ROWS]).tobytes()
+
+
+def compact(email: str, kind: str, max_rows: int = COMPACTION_MAX_ROWS) -> int:
+  """ Merges small segments of each day into one, returns the number of removed segments """
+
+  ans = 0
+  for day in list_days(email, kind):
+    groups = dict()
+    for path in list_segments(email, kind, day):
+      timestamps, values = load_segment(path)
+      if len(timestamps) < max_rows:
+        groups.setdefault(values.shape[1], list()).append(path)
+
+    for paths in groups.values():
+      if len(paths) < 2: continue
+
+      segments = [load_segment(x) for x in paths]
+      write_segments(
+        email = email,
+        kind = kind,
+        timestamps = np.concatenate([x for x, _ in segments]),
+        values = np.concatenate([x for _, x in segments]),
+      )
+      del segments
+      for path in paths:
+        remove(f'{path}.ts.npy')
+        remove(f'{path}.val.npy')
+      ans += len(paths)
+
+  return ans
+
+
+def _iter_csv_lines(path: str) -> Iterator[Tuple[int, bytes]]:
+  timestamps, values = load_segment(path)
+  fmt = ['%d'] + ['%.9g']*values.shape[1]
+  for i in range(0, len(timestamps), EXPORT_BLOCK_ROWS):
+    block = np.column_stack([timestamps[i:i + EXPORT_BLOCK_ROWS].astype(np.float64), values[i:i + EXPORT_BLOCK_ROWS]])
+    buf = BytesIO()
+    np.savetxt(buf, block, fmt = fmt, delimiter = ',')
+    yield from zip(timestamps[i:i + EXPORT_BLOCK_ROWS].tolist(), buf.getvalue().splitlines(keepends = True))
+
+
+def export_csv(email: str, kind: str, wb: BinaryIO, from_ts: Optional[int] = None, till_ts: Optional[int] = None) -> int:
+  """ Writes segments back as timestamp-ordered csv (legacy file format), returns the number of rows """
+
+  ans = 0
+  for day in list_days(email, kind, from_ts, till_ts):
+    lines = merge(*[_iter_csv_lines(x) for x in list_segments(email, kind, day)], key = lambda x: x[0])
+    for ts, line in lines:
+      if (from_ts is not None and ts < from_ts) or (till_ts is not None and ts > till_ts): continue
+      wb.write(line)
+      ans += 1
+
+  return ans
+
+
+def find_duplicate_ranges(email: str, kind: str) -> List[dict]:
+  """ Finds runs of rows that repeat earlier rows (re-uploaded chunks) in raw segments """
+
+  # one 64-bit row hash and a position per row, duplicates are found with a vectorized sort
+  dirpath = get_raw_dir(email, kind)
+  records = get_raw_segments(email, kind, upload_order = True)
+  hashes, segments, lines, stamps = list(), list(), list(), list()
+  for i, record in enumerate(records):
+    rows = [x.rstrip(b'\r\n') for data in _iter_frames(dirpath, record) for x in data.splitlines()]
+    rows = [x for x in rows if x]
+    hashes.append(np.fromiter((int.from_bytes(hashlib.blake2b(x, digest_size = 8).digest(), 'little') for x in rows), dtype = np.uint64, count = len(rows)))
+    stamps.append(np.fromiter(map(_ts_key, rows), dtype = np.int64, count = len(rows)))
+    segments.append(np.full(len(rows), i, dtype = np.int32))
+    lines.append(np.arange(len(rows), dtype = np.int64))
+  if not records: return list()
+
+  hashes, segments, lines, stamps = map(np.concatenate, [hashes, segments, lines, stamps])
+  order = np.argsort(hashes, kind = 'stable')
+  duplicate = np.zeros(len(hashes), dtype = bool)
+  duplicate[order[1:]] = hashes[order[1:]] == hashes[order[:-1]]
+
+  # contiguous duplicate rows of one segment make a range
+  joined = duplicate[1:] & duplicate[:-1] & (segments[1:] == segments[:-1])
+  starts = np.flatnonzero(duplicate & ~np.r_[False, joined])
+  ends = np.flatnonzero(duplicate & ~np.r_[joined, False])
+  ans = list()
+  for start, end in zip(starts, ends):
+    ans.append(dict(
+      segment = records[segments[start]]['name'],
+      from_line = int(lines[start]),
+      till_line = int(lines[end]),
+      rows = int(end - start + 1),
+      from_ts = int(stamps[start:end + 1].min()),
+      till_ts = int(stamps[start:end + 1].max()),
+    ))
+  return ans
+
+
+def rebuild_columnar(email: str, kind: str) -> int:
+  """ Re-creates columnar segments from raw segments (e.g., after a restore), returns the number of rows """
+
+  dirpath = get_segments_dir(email, kind)
+  if isdir(dirpath): shutil.rmtree(dirpath)
+  return sum(index_segment(email, kind, x['name']) for x in get_raw_segments(email, kind))
+
+
+def import_csv(email: str, kind: str, path: str) -> int:
+  """ Moves a legacy per-user csv file into segments, returns the number of rows """
+
+  if not exists(path): return 0
+  record = _add_raw_segment(email, kind, dict(indexed = False), path = path)
+  return index_segment(email, kind, record['name'])
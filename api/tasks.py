@@ -0,0 +1,98 @@
+from typing import Dict, List, Optional
+
+from django.conf import settings
+from datetime import datetime
+from dateutil import tz
+import numpy as np
+
+from api import services as svc
+from api import selectors as slc
+from api import features
+from api import storage
+from api import jobs
+from api import push
+from api import metrics
+
+SUMMARIZED_KINDS = ['ppg', 'acc']
+
+
+@jobs.handler('index_watch_segment')
+def index_watch_segment(user_id: int, kind: str, segment: str):
+  """ Builds the columnar copy of an uploaded smartwatch file """
+
+  user = slc.get_user(id = user_id)
+  if not user: return
+
+  # before the segment is marked indexed: compaction may merge it away afterwards
+  if kind == 'offbody' and storage.get_raw_segment(user.email, kind, segment): load_off_body(user_id, segment)
+  storage.index_segment(user.email, kind, segment)
+  record = storage.get_raw_segment(user.email, kind, segment)
+  if kind in SUMMARIZED_KINDS and record and record['from_ts'] is not None:
+    jobs.enqueue('summarize_watch_minutes', user_id = user_id, kind = kind, from_ts = record['from_ts'], till_ts = record['till_ts'])
+
+
+@jobs.handler('summarize_watch_minutes')
+def summarize_watch_minutes(user_id: int, kind: str, from_ts: int, till_ts: int) -> int:
+  """ Re-computes per-minute summaries of the minutes within [from_ts, till_ts] from all stored samples """
+
+  user = slc.get_user(id = user_id)
+  if not user: return 0
+
+  # whole minutes: samples of other uploads within the same minutes count as well
+  from_ts = int(features.get_minutes(from_ts))
+  till_ts = int(features.get_minutes(till_ts)) + features.MINUTE_MS - 1
+  timestamps, values = storage.read_range(user.email, kind, from_ts, till_ts)
+  summaries = features.get_ppg_summaries(timestamps, values) if kind == 'ppg' else features.get_acc_summaries(timestamps, values)
+  return svc.update_minute_summaries(user, summaries)
+
+
+@jobs.handler('send_ema_pushes')
+def send_ema_pushes(user_ids: Optional[List[int]] = None, queued_ts: Optional[int] = None) -> Dict[str, str]:
+  """ Sends EMA push notifications (in batches), returns the outcome per user id: sent, no_token, unregistered, unavailable or failed """
+
+  tokens = {x.id: x.fcm_token for x in slc.get_participants(user_ids)}
+  ans = {str(x): 'no_token' for x in user_ids or [] if x not in tokens}
+
+  # queued with a single attempt (participants would be prompted twice), transient failures are reported instead
+  sent_ts, latencies = jobs.now_ms(), dict()
+  errors = push.send_ema_pushes(tokens, latencies)
+  for user_id, error in errors.items():
+    ans[str(user_id)] = push.get_outcome(error)
+  svc.clear_fcm_tokens(int(x) for x, outcome in ans.items() if outcome == 'unregistered')
+  svc.create_push_deliveries('cohort', dict.fromkeys(tokens, queued_ts or sent_ts), sent_ts, errors, latencies)
+  return ans
+
+
+@jobs.handler('compute_push_metrics')
+def compute_push_metrics(days: int = 2) -> int:
+  """ Matches pushes of the last days to the self-reports answering them, then re-computes daily compliance and latencies """
+
+  utc_offset_ms = int(datetime.now(tz.gettz(settings.TIME_ZONE)).utcoffset().total_seconds()*1000)
+  from_ts = int(metrics.get_days(np.int64(jobs.now_ms()), utc_offset_ms)) - (days - 1)*metrics.DAY_MS
+
+  deliveries = list(slc.get_push_deliveries(from_ts).values_list('id', 'user_id', 'planned_ts', 'sent_ts', 'outcome'))
+  if not deliveries: return 0
+  ids, user_ids, planned_ts, sent_ts = (np.array(x, dtype = np.int64) for x in list(zip(*deliveries))[:4])
+  delivered = np.array([x[4] == 'sent' for x in deliveries])
+
+  # only delivered pushes can be answered
+  reports = np.array(slc.get_self_report_times(np.unique(user_ids).tolist(), from_ts), dtype = np.int64).reshape(-1, 2)
+  response_ts = np.full(len(ids), -1, dtype = np.int64)
+  response_ts[delivered] = metrics.match_responses(user_ids[delivered], sent_ts[delivered], reports[:, 0], reports[:, 1])
+  svc.update_push_responses(ids.tolist(), [x if x >= 0 else None for x in response_ts.tolist()], sent_ts.tolist())
+
+  return svc.update_response_metrics(metrics.get_daily_metrics(user_ids, planned_ts, sent_ts, delivered, response_ts, utc_offset_ms))
+
+
+@jobs.handler('load_off_body')
+def load_off_body(user_id: int, segment: str) -> int:
+  """ Loads an uploaded off-body file into the (indexed) OffBody table, raises FileNotFoundError for a removed segment """
+
+  user = slc.get_user(id = user_id)
+  if not user: return 0
+
+  ans = 0
+  for timestamps, values in storage.iter_samples(user.email, 'offbody', segment):
+    if values.shape[1] < 1: continue
+    ans += svc.create_off_body_data_bulk(user, timestamps.tolist(), (values[:, 0] != 0).tolist())
+  return ans
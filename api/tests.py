@@ -8,23 +8,43 @@ environ['DJANGO_SETTINGS_MODULE'] = 'dashboard.settings'
 dotenv.load_dotenv()
 setup()
 
-from django.test import TestCase
+from django.test import RequestFactory, TestCase, override_settings
+from django.http import HttpResponse
 from django.utils.timezone import datetime as dt
 from django.utils.timezone import timedelta as td
 from django.urls import reverse as get_url
-from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.files.uploadedfile import SimpleUploadedFile, TemporaryUploadedFile
+
+from asgiref.sync import sync_to_async
 
 from rest_framework import status
 from rest_framework.authtoken.models import Token
 from rest_framework.test import APIRequestFactory, force_authenticate
 
+from firebase_admin import messaging
+
 from os import listdir, remove
-from os.path import exists
+from os.path import exists, getsize
+from io import BytesIO, StringIO
+from unittest import mock
+import numpy as np
+import threading
+import tempfile
+import asyncio
 import time
 
 from api import models as mdl
 from api import services as svc
+from api import selectors as slc
+from api import push
+from api import resumable
+from api import jobs
+from api import metrics
+from api import storage
+from api import throttling
+from api import uploadhandlers
 from api import views as api
+from dashboard import loadshedding
 
 
 class BaseTestCase(TestCase):
@@ -36,6 +56,18 @@ class BaseTestCase(TestCase):
     self.email = 'example@email.com'
     self.password = 'example_password'
 
+  def setUp(self):
+    # token buckets and counts of a test go to a scratch directory
+    throttle_dir = tempfile.mkdtemp()
+    self.addCleanup(shutil.rmtree, throttle_dir)
+    table = throttling.BucketTable(join(throttle_dir, throttling.BUCKETS_FILENAME))
+    self.addCleanup(table.close)
+    for patcher in [mock.patch.object(throttling, 'THROTTLE_DIR', throttle_dir), mock.patch.object(throttling, 'buckets', table)]:
+      patcher.start()
+      self.addCleanup(patcher.stop)
+    throttling.counts.clear()
+    self.addCleanup(throttling.counts.clear)   # not flushed at exit
+
   def get_token(self) -> tuple[mdl.User, Token]:
     query_set = mdl.User.objects.filter(username = self.email)
     user = query_set[0] if query_set.exists() else svc.create_user(
@@ -600,11 +632,11 @@ class PPGTest(BaseTestCase):
 
     dirpath = join(self.DATA_DUMP_DIR, self.email)
     self.assertTrue(exists(dirpath))
-    expected = b''.join(x for x in test_files.values())
-    filepath = join(dirpath, 'ppg.csv')
-    self.assertTrue(exists(filepath))
-    with open(filepath, 'rb') as rb:
-      self.assertEqual(expected, rb.read())
+    expected = b''.join(x if x.endswith(b'\n') else x + b'\n' for x in test_files.values())
+    self.assertEqual(len(storage.get_raw_segments(self.email, 'ppg')), len(test_files))
+    buf = BytesIO()
+    storage.export_raw(self.email, 'ppg', buf)
+    self.assertEqual(expected, buf.getvalue())
     shutil.rmtree(dirpath)
 
   def test_insert_bad_name(self):
@@ -693,11 +725,11 @@ class AccTest(BaseTestCase):
 
     dirpath = join(self.DATA_DUMP_DIR, self.email)
     self.assertTrue(exists(dirpath))
-    expected = b''.join(x for x in test_files.values())
-    filepath = join(dirpath, 'acc.csv')
-    self.assertTrue(exists(filepath))
-    with open(filepath, 'rb') as rb:
-      self.assertEqual(expected, rb.read())
+    expected = b''.join(x if x.endswith(b'\n') else x + b'\n' for x in test_files.values())
+    self.assertEqual(len(storage.get_raw_segments(self.email, 'acc')), len(test_files))
+    buf = BytesIO()
+    storage.export_raw(self.email, 'acc', buf)
+    self.assertEqual(expected, buf.getvalue())
     shutil.rmtree(dirpath)
 
   def test_insert_bad_name(self):
@@ -786,11 +818,11 @@ class OffBodyTest(BaseTestCase):
 
     dirpath = join(self.DATA_DUMP_DIR, self.email)
     self.assertTrue(exists(dirpath))
-    expected = b''.join(x for x in test_files.values())
-    filepath = join(dirpath, 'offbody.csv')
-    self.assertTrue(exists(filepath))
-    with open(filepath, 'rb') as rb:
-      self.assertEqual(expected, rb.read())
+    expected = b''.join(x if x.endswith(b'\n') else x + b'\n' for x in test_files.values())
+    self.assertEqual(len(storage.get_raw_segments(self.email, 'offbody')), len(test_files))
+    buf = BytesIO()
+    storage.export_raw(self.email, 'offbody', buf)
+    self.assertEqual(expected, buf.getvalue())
     shutil.rmtree(dirpath)
 
   def test_insert_invalid(self):
@@ -806,3 +838,1151 @@ class OffBodyTest(BaseTestCase):
       )
       res = self.__view(self.force_auth(request = req))
       self.assertEqual(res.status_code, status.HTTP_400_BAD_REQUEST)
+
+
+class WatchStorageTest(BaseTestCase):
+  from api.views import DATA_DUMP_DIR
+
+  def __init__(self, *args, **kwargs):
+    self.__url = get_url('submitPPGApi')
+    self.__view = api.InsertPPG.as_view()
+    super().__init__(*args, **kwargs)
+
+  def __upload(self, name, content):
+    req = self.fac.post(path = self.__url, data = dict(file = SimpleUploadedFile(name = name, content = content)))
+    res = self.__view(self.force_auth(request = req))
+    self.assertEqual(res.status_code, status.HTTP_200_OK)
+    jobs.run_pending()
+
+  def tearDown(self):
+    dirpath = join(self.DATA_DUMP_DIR, self.email)
+    if exists(dirpath): shutil.rmtree(dirpath)
+
+  def test_read_range(self):
+    day = 1669852800000   # 2022-12-01 09:00 KST
+    self.__upload('ppg1.csv', f'{day + 2000},3\n{day + 1000},2\ntimestamp,value\n'.encode())
+    self.__upload('ppg2.csv', f'{day + 86400000},4\n{day + 3000},5\n'.encode())
+
+    self.assertEqual(len(storage.list_days(self.email, 'ppg')), 2)
+    self.assertEqual(storage.read_timestamps(self.email, 'ppg').tolist(), [day + 1000, day + 2000, day + 3000, day + 86400000])
+
+    parts = list(storage.iter_range(self.email, 'ppg', from_ts = day + 1500, till_ts = day + 3000))
+    self.assertTrue(all(isinstance(x.base, np.memmap) for x, _ in parts))
+
+    timestamps, values = storage.read_range(self.email, 'ppg', from_ts = day + 1500, till_ts = day + 3000)
+    self.assertEqual(timestamps.tolist(), [day + 2000, day + 3000])
+    self.assertEqual(values[:, 0].tolist(), [3, 5])
+
+    # a segment of another channel count is left out, its minute summary job still succeeds
+    self.__upload('ppg3.csv', f'{day + 2500},6,0\n'.encode())
+    timestamps, values = storage.read_range(self.email, 'ppg', from_ts = day + 1500, till_ts = day + 3000)
+    self.assertEqual((timestamps.tolist(), values.shape), ([day + 2000, day + 3000], (2, 1)))
+    self.assertFalse(mdl.Job.objects.exclude(status = 'done').exists())
+
+  def test_compact_and_export(self):
+    day = 1669852800000
+    for i in range(3):
+      self.__upload(f'ppg{i}.csv', f'{day + 10 - i},{i},0.5\n'.encode())
+
+    self.assertEqual(storage.compact(self.email, 'ppg'), 3)
+    self.assertEqual(len(storage.list_segments(self.email, 'ppg', storage.get_day(day))), 1)
+
+    buf = BytesIO()
+    self.assertEqual(storage.export_csv(self.email, 'ppg', buf), 3)
+    self.assertEqual(buf.getvalue(), f'{day + 8},2,0.5\n{day + 9},1,0.5\n{day + 10},0,0.5\n'.encode())
+
+
+class IngestValidationTest(BaseTestCase):
+  from api.views import DATA_DUMP_DIR
+
+  def tearDown(self):
+    dirpath = join(self.DATA_DUMP_DIR, self.email)
+    if exists(dirpath): shutil.rmtree(dirpath)
+
+  def test_validate_csv(self):
+    timestamps, values, rejected = storage.validate_csv(b'timestamp,a,b\r\n5,1,2\r\n3,x,1\n\n4,1\n12a,1,2\n6,1.5,2\n5,1,2')
+    self.assertEqual(timestamps.tolist(), [5, 6, 5])
+    self.assertEqual(values.tolist(), [[1, 2], [1.5, 2], [1, 2]])
+    self.assertEqual(rejected, [b'timestamp,a,b', b'3,x,1', b'4,1', b'12a,1,2'])
+
+    timestamps, values = storage.normalize(timestamps, values)
+    self.assertEqual((timestamps.tolist(), values.tolist()), ([5, 6], [[1, 2], [1.5, 2]]))
+
+    # a truncated first line does not set the format, out of range timestamps and non-finite values are rejected
+    timestamps, values, rejected = storage.validate_csv(b'1,2\n2,1,2\n3,1,2\n1669852800000000,1,2\n18446744073709551615,1,2\n4,nan,2\n5,inf,2\n6,1,2')
+    self.assertEqual(timestamps.tolist(), [2, 3, 6])
+    self.assertEqual(values.shape, (3, 2))
+    self.assertEqual(rejected, [b'1,2', b'1669852800000000,1,2', b'18446744073709551615,1,2', b'4,nan,2', b'5,inf,2'])
+
+  def test_clean_segments(self):
+    user, _ = self.get_token()
+    for content in [b'header\n3,1\n1,0\n1,0\n2,x\n', b'3,1\n4,1\n']:   # the 2nd upload repeats a row
+      svc.create_watch_upload(user, 'ppg', SimpleUploadedFile(name = 'ppg.csv', content = content))
+    jobs.run_pending()
+
+    timestamps, values = storage.read_range(self.email, 'ppg')
+    self.assertEqual((timestamps.tolist(), values[:, 0].tolist()), ([1, 3, 4], [0, 1, 1]))
+    quarantine_dir = storage.get_quarantine_dir(self.email, 'ppg')
+    self.assertEqual(b''.join(open(join(quarantine_dir, x), 'rb').read() for x in listdir(quarantine_dir)), b'header\n2,x\n')
+
+    # a repeated run neither duplicates rows nor quarantined lines
+    for record in storage.get_raw_segments(self.email, 'ppg'):
+      storage.index_segment(self.email, 'ppg', record['name'])
+    self.assertEqual(storage.read_timestamps(self.email, 'ppg').tolist(), [1, 3, 4])
+    self.assertEqual(len(listdir(quarantine_dir)), 1)
+
+
+class UploadStreamingTest(BaseTestCase):
+  from api.views import DATA_DUMP_DIR
+
+  def tearDown(self):
+    dirpath = join(self.DATA_DUMP_DIR, self.email)
+    if exists(dirpath): shutil.rmtree(dirpath)
+
+  def test_large_upload(self):
+    content = b''.join(f'{1669852800000 + i},{i % 512}\n'.encode() for i in range(200_000))
+    req = self.fac.post(
+      path = get_url('submitPPGApi'),
+      data = dict(file = SimpleUploadedFile(name = 'ppg.csv', content = content)),
+    )
+    res = api.InsertPPG.as_view()(self.force_auth(request = req))
+    self.assertEqual(res.status_code, status.HTTP_200_OK)
+
+    dirpath = join(self.DATA_DUMP_DIR, self.email)
+    buf = BytesIO()
+    storage.export_raw(self.email, 'ppg', buf)
+    self.assertEqual(buf.getvalue(), content)
+    self.assertEqual(listdir(join(dirpath, uploadhandlers.INCOMING_DIRNAME)), [])   # spooled copy was moved
+    self.assertEqual(jobs.run_pending(), 2)   # columnar copy, then per-minute summaries
+    self.assertEqual(len(storage.read_timestamps(self.email, 'ppg')), 200_000)
+
+  def test_in_memory_upload(self):
+    for content in [b'3,4\n', b'1,2']:
+      storage.store_upload(self.email, 'ppg', SimpleUploadedFile(name = 'ppg.csv', content = content))
+    buf = BytesIO()
+    storage.export_raw(self.email, 'ppg', buf)
+    self.assertEqual(buf.getvalue(), b'1,2\n3,4\n')
+
+
+class RawSegmentTest(BaseTestCase):
+  from api.views import DATA_DUMP_DIR
+
+  def tearDown(self):
+    dirpath = join(self.DATA_DUMP_DIR, self.email)
+    if exists(dirpath): shutil.rmtree(dirpath)
+
+  def test_concurrent_uploads(self):
+    from concurrent.futures import ThreadPoolExecutor
+
+    contents = [f'{1000 + i},{i}\n'.encode()*1000 for i in range(8)]
+    with ThreadPoolExecutor(max_workers = 8) as pool:
+      records = list(pool.map(
+        lambda x: storage.store_upload(self.email, 'acc', SimpleUploadedFile(name = 'acc.csv', content = x)),
+        contents,
+      ))
+
+    self.assertEqual(len(set(x['name'] for x in records)), len(contents))
+    segments = storage.get_raw_segments(self.email, 'acc')
+    self.assertEqual([x['from_ts'] for x in segments], [1000 + i for i in range(8)])
+    buf = BytesIO()
+    storage.export_raw(self.email, 'acc', buf)
+    self.assertEqual(buf.getvalue(), b''.join(contents))
+
+  def test_compact_raw(self):
+    for content in [b'30,3\n10,1\n', b'20,2\n', b'header\n5,0\n']:
+      storage.store_upload(self.email, 'ppg', SimpleUploadedFile(name = 'ppg.csv', content = content))
+    self.assertEqual(storage.compact_raw(self.email, 'ppg'), 0)   # not indexed yet
+    for record in storage.get_raw_segments(self.email, 'ppg'):
+      storage.index_segment(self.email, 'ppg', record['name'])
+
+    with mock.patch('api.storage._sort_segment', wraps = storage._sort_segment) as sort_segment:
+      self.assertEqual(storage.compact_raw(self.email, 'ppg'), 3)
+    self.assertEqual(sort_segment.call_count, 1)   # the others are merged as they are
+    segments = storage.get_raw_segments(self.email, 'ppg')
+    self.assertEqual(len(segments), 1)
+    self.assertEqual((segments[0]['rows'], segments[0]['from_ts'], segments[0]['till_ts']), (4, 5, 30))
+    self.assertEqual(sorted(listdir(storage.get_raw_dir(self.email, 'ppg'))), sorted([segments[0]['name'], storage.MANIFEST_FILENAME]))
+    with open(join(storage.get_raw_dir(self.email, 'ppg'), storage.MANIFEST_FILENAME), 'rb') as rb:
+      self.assertEqual(rb.read().count(b'\n'), 1)   # rewritten with the live segment only
+
+    buf = BytesIO()
+    storage.export_raw(self.email, 'ppg', buf)
+    self.assertEqual(buf.getvalue(), b'header\n5,0\n10,1\n20,2\n30,3\n')
+
+    # groups are capped by segment count as well as by size
+    for i in range(5):
+      record = storage.store_upload(self.email, 'acc', SimpleUploadedFile(name = 'acc.csv', content = f'{i},{i}\n'.encode()))
+      storage.index_segment(self.email, 'acc', record['name'])
+    with mock.patch('api.storage.COMPACTION_RAW_MAX_SEGMENTS', 2):
+      self.assertEqual(storage.compact_raw(self.email, 'acc'), 4)
+    segments = storage.get_raw_segments(self.email, 'acc')
+    self.assertEqual([x['rows'] for x in segments], [2, 2, 1])
+    self.assertTrue(all(x.get('indexed', True) for x in segments))   # the index marker of the left-over is folded in
+    with open(join(storage.get_raw_dir(self.email, 'acc'), storage.MANIFEST_FILENAME), 'rb') as rb:
+      self.assertEqual(rb.read().count(b'\n'), 3)
+
+  def test_range_read_frames(self):
+    day = 1669852800000
+    content = b''.join(f'{day + i},{i % 512},{i % 7}\n'.encode() for i in range(100_000))
+    record = storage.store_upload(self.email, 'ppg', SimpleUploadedFile(name = 'ppg.csv', content = content))
+    self.assertEqual(record['codec'], 'gzip')
+    self.assertGreater(len(record['frames']), 4)
+    self.assertLess(record['size'], len(content))
+
+    with mock.patch('api.storage.gzip.decompress', wraps = storage.gzip.decompress) as decompress:
+      buf = BytesIO()
+      storage.export_raw(self.email, 'ppg', buf, from_ts = day + 500, till_ts = day + 1500)
+    self.assertEqual(decompress.call_count, 1)
+    self.assertEqual(buf.getvalue(), b''.join(f'{day + i},{i % 512},{i % 7}\n'.encode() for i in range(500, 1501)))
+
+    self.assertEqual(storage.rebuild_columnar(self.email, 'ppg'), 100_000)
+
+  def test_uncompressed_codec(self):
+    with mock.patch('api.storage.CODEC', 'none'):
+      record = storage.store_upload(self.email, 'acc', SimpleUploadedFile(name = 'acc.csv', content = b'2,1\n1,0\n'))
+    self.assertEqual((record['codec'], record['frames']), ('none', [[0, 8, 1, 2]]))
+
+    buf = BytesIO()
+    storage.export_raw(self.email, 'acc', buf, from_ts = 2)
+    self.assertEqual(buf.getvalue(), b'2,1\n')
+
+    # an upload spooled to disk is copied as a file
+    with mock.patch('api.storage.CODEC', 'none'), TemporaryUploadedFile('acc.csv', 'text/csv', 8, None) as file:
+      file.write(b'4,1\n3,0\n')
+      file.flush()
+      record = storage.store_upload(self.email, 'acc', file)
+    self.assertEqual(record['frames'], [[0, 8, 3, 4]])
+    buf = BytesIO()
+    storage.export_raw(self.email, 'acc', buf, from_ts = 3)
+    self.assertEqual(buf.getvalue(), b'4,1\n3,0\n')
+
+
+class WatchUploadDedupTest(BaseTestCase):
+  from api.views import DATA_DUMP_DIR
+
+  def tearDown(self):
+    dirpath = join(self.DATA_DUMP_DIR, self.email)
+    if exists(dirpath): shutil.rmtree(dirpath)
+
+  def test_duplicate_upload(self):
+    for _ in range(2):
+      req = self.fac.post(
+        path = get_url('submitAccApi'),
+        data = dict(file = SimpleUploadedFile(name = 'acc1.csv', content = b'1,2,3\n4,5,6\n')),
+      )
+      res = api.InsertAcc.as_view()(self.force_auth(request = req))
+      self.assertEqual(res.status_code, status.HTTP_200_OK)
+
+    self.assertTrue(res.data['duplicate'])
+    self.assertEqual(mdl.WatchUpload.objects.filter(user = self.get_token()[0], kind = 'acc').count(), 1)
+    self.assertEqual(len(storage.get_raw_segments(self.email, 'acc')), 1)
+    self.assertEqual(jobs.run_pending(), 2)
+    self.assertEqual(storage.read_timestamps(self.email, 'acc').tolist(), [1, 4])
+
+  def test_unfinished_upload(self):
+    user, _ = self.get_token()
+    file = lambda: SimpleUploadedFile(name = 'acc1.csv', content = b'1,2,3\n4,5,6\n')
+    size, digest = storage.get_fingerprint(file())
+    # a worker was killed while storing the file
+    upload = mdl.WatchUpload.objects.create(user = user, timestamp = int(time.time()*1000), kind = 'acc', size = size, digest = digest)
+
+    self.assertIsNone(svc.create_watch_upload(user, 'acc', file()))   # may still be stored by another request
+    mdl.WatchUpload.objects.filter(id = upload.id).update(timestamp = int(time.time()*1000) - svc.UPLOAD_LEASE_MS - 1)
+    self.assertEqual(svc.create_watch_upload(user, 'acc', file()).id, upload.id)   # the retry takes it over
+    self.assertIsNotNone(mdl.WatchUpload.objects.get(id = upload.id).segment)
+    self.assertEqual(len(storage.get_raw_segments(self.email, 'acc')), 1)
+    self.assertIsNone(svc.create_watch_upload(user, 'acc', file()))
+
+  def test_find_duplicate_ranges(self):
+    user, _ = self.get_token()
+    for content in [b'1,0\n2,0\n3,0\n', b'2,0\n3,0\n4,0\n', b'5,0\n1,0\n']:
+      svc.create_watch_upload(user, 'ppg', SimpleUploadedFile(name = 'ppg.csv', content = content))
+
+    ranges = storage.find_duplicate_ranges(self.email, 'ppg')
+    self.assertEqual([(x['from_line'], x['till_line'], x['from_ts'], x['till_ts']) for x in ranges], [(0, 1, 2, 3), (1, 1, 1, 1)])   # 2,3 of the 2nd upload, 1 of the 3rd
+
+
+class ResumableUploadTest(BaseTestCase):
+  from api.views import DATA_DUMP_DIR
+
+  def tearDown(self):
+    dirpath = join(self.DATA_DUMP_DIR, self.email)
+    if exists(dirpath): shutil.rmtree(dirpath)
+
+  def __put(self, session_id, offset, content):
+    req = self.fac.put(
+      path = f'{get_url("uploadSessionApi", args = [session_id])}?offset={offset}',
+      data = content,
+      content_type = 'application/octet-stream',
+    )
+    return api.UploadSessionChunk.as_view()(self.force_auth(request = req), session_id = session_id)
+
+  def test_resumed_upload(self):
+    content = b''.join(f'{1669852800000 + i},{i}\n'.encode() for i in range(1000))
+    req = self.fac.post(path = get_url('createUploadSessionApi'), data = dict(kind = 'ppg', name = 'ppg1.csv', size = len(content)))
+    res = api.CreateUploadSession.as_view()(self.force_auth(request = req))
+    self.assertEqual(res.status_code, status.HTTP_201_CREATED)
+    session_id = res.data['id']
+
+    res = self.__put(session_id, 0, content[:5000])
+    self.assertEqual((res.status_code, res.data['offset']), (status.HTTP_200_OK, 5000))
+
+    # a dropped response: the client re-sends from a stale offset and learns where to resume
+    res = self.__put(session_id, 0, content[:5000])
+    self.assertEqual((res.status_code, res.data['offset']), (status.HTTP_409_CONFLICT, 5000))
+    req = self.fac.get(path = get_url('uploadSessionApi', args = [session_id]))
+    res = api.UploadSessionChunk.as_view()(self.force_auth(request = req), session_id = session_id)
+    self.assertEqual(res.data['offset'], 5000)
+
+    finalize = lambda: api.FinalizeUploadSession.as_view()(
+      self.force_auth(request = self.fac.post(path = get_url('finalizeUploadSessionApi', args = [session_id]))),
+      session_id = session_id,
+    )
+    self.assertEqual(finalize().status_code, status.HTTP_409_CONFLICT)   # incomplete
+
+    res = self.__put(session_id, 5000, content[5000:])
+    self.assertEqual(res.data['offset'], len(content))
+    self.assertEqual(finalize().status_code, status.HTTP_200_OK)
+    self.assertEqual(finalize().status_code, status.HTTP_404_NOT_FOUND)
+
+    buf = BytesIO()
+    storage.export_raw(self.email, 'ppg', buf)
+    self.assertEqual(buf.getvalue(), content)
+    self.assertEqual(listdir(resumable.get_uploads_dir(self.email)), [])
+
+  def test_size_limit(self):
+    create = lambda **x: api.CreateUploadSession.as_view()(self.force_auth(request = self.fac.post(path = get_url('createUploadSessionApi'), data = dict(kind = 'ppg', name = 'ppg1.csv', **x))))
+    self.assertEqual(create(size = resumable.SESSION_MAX_SIZE + 1).status_code, status.HTTP_400_BAD_REQUEST)
+
+    # without a declared size, a session is cut off at the server-side limit
+    session_id = create().data['id']
+    with mock.patch('api.resumable.SESSION_MAX_SIZE', 16):
+      self.assertEqual(self.__put(session_id, 0, b'1669852800000,1\n').status_code, status.HTTP_200_OK)
+      res = self.__put(session_id, 16, b'1669852800001,2\n')
+    self.assertEqual(res.status_code, status.HTTP_413_REQUEST_ENTITY_TOO_LARGE)
+    self.assertEqual(listdir(resumable.get_uploads_dir(self.email)), [])
+
+  def test_invalid_session(self):
+    req = self.fac.get(path = get_url('uploadSessionApi', args = ['..']))
+    res = api.UploadSessionChunk.as_view()(self.force_auth(request = req), session_id = '..')
+    self.assertEqual(res.status_code, status.HTTP_404_NOT_FOUND)
+
+
+class JobQueueTest(BaseTestCase):
+  from api.views import DATA_DUMP_DIR
+
+  def tearDown(self):
+    dirpath = join(self.DATA_DUMP_DIR, self.email)
+    if exists(dirpath): shutil.rmtree(dirpath)
+
+  def test_upload_is_processed_by_job(self):
+    req = self.fac.post(
+      path = get_url('submitPPGApi'),
+      data = dict(file = SimpleUploadedFile(name = 'ppg.csv', content = b'2,1\n1,0\n')),
+    )
+    res = api.InsertPPG.as_view()(self.force_auth(request = req))
+    self.assertEqual(res.status_code, status.HTTP_200_OK)
+    self.assertEqual(len(storage.read_timestamps(self.email, 'ppg')), 0)
+    self.assertEqual(jobs.get_stats()['pending'], 1)
+
+    self.assertEqual(jobs.run_pending(), 2)   # columnar copy, then per-minute summaries
+    self.assertEqual(storage.read_timestamps(self.email, 'ppg').tolist(), [1, 2])
+    stats = jobs.get_stats()
+    self.assertEqual((stats['pending'], stats['done']), (0, 2))
+    self.assertIsNotNone(stats['latency_p95'])
+
+    # a repeated run replaces its own columnar segments
+    job = mdl.Job.objects.get(name = 'index_watch_segment')
+    jobs.run(job)
+    self.assertEqual(storage.read_timestamps(self.email, 'ppg').tolist(), [1, 2])
+
+  def test_retry_and_fail(self):
+    calls = list()
+
+    @jobs.handler('test_failing')
+    def failing(value):
+      calls.append(value)
+      raise ValueError(value)
+
+    job = jobs.enqueue('test_failing', value = 1)
+    self.assertEqual(jobs.run_pending(), 1)
+    job.refresh_from_db()
+    self.assertEqual((job.status, job.attempts), ('pending', 1))
+    self.assertIn('ValueError', job.error)
+    self.assertEqual(jobs.run_pending(), 0)   # delayed
+
+    for _ in range(jobs.MAX_ATTEMPTS - 1):
+      mdl.Job.objects.filter(id = job.id).update(run_after_ts = 0)
+      jobs.run_pending()
+    job.refresh_from_db()
+    self.assertEqual((job.status, len(calls)), ('failed', jobs.MAX_ATTEMPTS))
+    self.assertEqual(jobs.get_stats()['failed'], 1)
+    jobs.HANDLERS.pop('test_failing')
+
+  def test_claim_once(self):
+    jobs.enqueue('index_watch_segment', user_id = 0, kind = 'ppg', segment = 'x')
+    self.assertIsNotNone(jobs.claim())
+    self.assertIsNone(jobs.claim())   # taken by the first worker
+
+    mdl.Job.objects.update(started_ts = 0)
+    self.assertEqual(jobs.requeue_stale(), 1)
+    self.assertIsNotNone(jobs.claim())
+
+  def test_single_attempt(self):
+    @jobs.handler('test_failing')
+    def failing():
+      raise ValueError()
+
+    job = jobs.enqueue('test_failing', max_attempts = 1)
+    jobs.run_pending()
+    job.refresh_from_db()
+    self.assertEqual((job.status, job.attempts), ('failed', 1))
+
+    # a crashed worker's job is not run again either
+    job = jobs.enqueue('test_failing', max_attempts = 1)
+    self.assertIsNotNone(jobs.claim())
+    mdl.Job.objects.filter(id = job.id).update(started_ts = 0)
+    self.assertEqual(jobs.requeue_stale(), 0)
+    job.refresh_from_db()
+    self.assertEqual(job.status, 'failed')
+    self.assertIsNone(jobs.claim())
+    jobs.HANDLERS.pop('test_failing')
+
+
+class OffBodyLoadTest(BaseTestCase):
+  from api.views import DATA_DUMP_DIR
+
+  def tearDown(self):
+    dirpath = join(self.DATA_DUMP_DIR, self.email)
+    if exists(dirpath): shutil.rmtree(dirpath)
+
+  def test_load_off_body(self):
+    from django.core.management import call_command
+
+    hour = 1669852800000
+    req = self.fac.post(
+      path = get_url('submitOffBodyApi'),
+      data = dict(file = SimpleUploadedFile(name = 'offbody.csv', content = f'timestamp,isOffBody\n{hour},true\n{hour + 1},False\n{hour},true\n{hour + 3600000},1\n'.encode())),
+    )
+    res = api.InsertOffBody.as_view()(self.force_auth(request = req))
+    self.assertEqual(res.status_code, status.HTTP_200_OK)
+    self.assertEqual(jobs.run_pending(), 1)   # loaded by the index job, before compaction can merge the segment away
+
+    user, _ = self.get_token()
+    rows = mdl.OffBody.objects.filter(user = user).order_by('timestamp')
+    self.assertEqual([(x.timestamp, x.is_off_body) for x in rows], [(hour, True), (hour + 1, False), (hour + 3600000, True)])
+    self.assertEqual(slc.get_offbody_hourly_counts(user), {hour: 2, hour + 3600000: 1})
+
+    call_command('load_off_body_data', stdout = StringIO())
+    self.assertEqual(mdl.OffBody.objects.filter(user = user).count(), 3)   # backfill skips loaded records
+
+    # a job of a removed segment fails instead of loading nothing
+    job = jobs.enqueue('load_off_body', user_id = user.id, segment = 'removed.csv')
+    jobs.run_pending()
+    job.refresh_from_db()
+    self.assertEqual(job.status, 'pending')
+    self.assertIn('FileNotFoundError', job.error)
+
+
+class MinuteSummaryTest(BaseTestCase):
+  from api.views import DATA_DUMP_DIR
+
+  def tearDown(self):
+    dirpath = join(self.DATA_DUMP_DIR, self.email)
+    if exists(dirpath): shutil.rmtree(dirpath)
+
+  def test_summaries(self):
+    user, _ = self.get_token()
+    minute = 1669852800000
+    timestamps = minute + np.arange(0, 3*60000, 40)   # 25 Hz, 3 minutes
+    rng = np.random.default_rng(0)
+    ppg = 1000 + 50*np.sin(2*np.pi*1.2*timestamps/1000) + rng.normal(0, 2, len(timestamps))   # 72 bpm
+    acc = np.column_stack([np.zeros(len(timestamps)), np.zeros(len(timestamps)), np.full(len(timestamps), 2*9.80665)])
+    for kind, values in [('ppg', ppg[:, None]), ('acc', acc)]:
+      content = ''.join(f'{t},{",".join(map(str, v))}\n' for t, v in zip(timestamps.tolist(), values.tolist())).encode()
+      svc.create_watch_upload(user, kind, SimpleUploadedFile(name = f'{kind}.csv', content = content))
+    jobs.run_pending()
+
+    summaries = slc.get_minute_summaries(user, minute, minute + 3*60000)
+    self.assertEqual(len(summaries), 3)
+    for summary in summaries:
+      self.assertEqual((summary.ppg_count, summary.acc_count), (1500, 1500))
+      self.assertAlmostEqual(summary.heart_rate, 72, delta = 2)
+      self.assertAlmostEqual(summary.acc_mean, 2)
+      self.assertAlmostEqual(summary.acc_enmo, 1000, places = 3)
+
+    # a repeated run overwrites the same minutes
+    from django.core.management import call_command
+    call_command('summarize_watch_data', stdout = StringIO())
+    self.assertEqual(mdl.MinuteSummary.objects.filter(user = user).count(), 3)
+
+
+class ExportWatchDataTest(BaseTestCase):
+  from api.views import DATA_DUMP_DIR
+
+  def tearDown(self):
+    dirpath = join(self.DATA_DUMP_DIR, self.email)
+    if exists(dirpath): shutil.rmtree(dirpath)
+
+  def __export(self, **params):
+    req = self.fac.get(path = get_url('exportWatchDataApi'), data = params)
+    return api.ExportWatchData.as_view()(self.force_auth(request = req))
+
+  def test_export(self):
+    user, _ = self.get_token()
+    day = 1669852800000
+    content = b''.join(f'{day + i},{i % 512},{i % 7}\n'.encode() for i in range(100_000))
+    svc.create_watch_upload(user, 'ppg', SimpleUploadedFile(name = 'ppg.csv', content = content))
+    jobs.run_pending()
+
+    res = self.__export(pid = user.id, kind = 'ppg')
+    self.assertEqual(res.status_code, status.HTTP_403_FORBIDDEN)
+    user.is_staff = True
+    user.save()
+
+    with mock.patch('api.storage.gzip.decompress', wraps = storage.gzip.decompress) as decompress:
+      res = self.__export(pid = user.id, kind = 'ppg', from_ts = day + 500, till_ts = day + 1500)
+      self.assertEqual(res.status_code, status.HTTP_200_OK)
+      self.assertTrue(res.streaming)
+      self.assertEqual(b''.join(res.streaming_content), b''.join(f'{day + i},{i % 512},{i % 7}\n'.encode() for i in range(500, 1501)))
+    self.assertEqual(decompress.call_count, 1)   # a single frame was read
+
+    res = self.__export(pid = user.id, kind = 'ppg', from_ts = day + 500, till_ts = day + 1500, file_format = 'bin')
+    self.assertEqual(res['X-Channels'], '2')
+    records = np.frombuffer(b''.join(res.streaming_content), dtype = [('timestamp', '<i8'), ('values', '<f4', (2,))])
+    self.assertEqual(records['timestamp'].tolist(), list(range(day + 500, day + 1501)))
+    self.assertEqual(records['values'][:2].tolist(), [[500, 3], [501, 4]])
+
+    self.assertEqual(self.__export(pid = 0, kind = 'ppg').status_code, status.HTTP_400_BAD_REQUEST)
+
+
+class SchedulerTest(TestCase):
+
+  def test_run_in_order(self):
+    from svc.scheduler import Scheduler
+
+    now = [100.0]
+    calls = list()
+    scheduler = Scheduler(clock = lambda: now[0])
+    scheduler.schedule(130, calls.append, 'c')
+    scheduler.schedule(110, calls.append, 'a')
+    cancelled = scheduler.schedule(115, calls.append, 'x')
+    scheduler.schedule(110, calls.append, 'b')
+    scheduler.cancel(cancelled)
+    self.assertEqual((len(scheduler), scheduler.next_due()), (3, 110))
+
+    self.assertEqual(scheduler.run_pending(), 0)
+    now[0] = 120
+    self.assertEqual(scheduler.run_pending(), 2)
+    self.assertEqual((calls, scheduler.next_due()), (['a', 'b'], 130))
+    scheduler.cancel(cancelled)   # cancelling twice, or after running, is a no-op
+    self.assertEqual(len(scheduler), 1)
+
+  def test_virtual_clock(self):
+    from svc.scheduler import Scheduler, VirtualClock
+
+    clock = VirtualClock(100.0)
+    scheduler = Scheduler(clock = clock)
+    scheduler.schedule(3600, clock.advance, 5)
+    clock.advance_to(scheduler.next_due())
+    self.assertEqual(scheduler.run_pending(), 1)
+    self.assertEqual(clock(), 3605)
+    clock.advance_to(10)   # never goes back
+    self.assertEqual(clock(), 3605)
+
+  def test_run_forever(self):
+    from svc.scheduler import Scheduler
+
+    scheduler = Scheduler()
+    calls = list()
+    thread = threading.Thread(target = scheduler.run_forever)
+    thread.start()
+    scheduler.schedule(time.time() + 3600, calls.append, 'later')
+    scheduler.schedule(time.time(), calls.append, 'now')   # wakes the sleeping scheduler
+    scheduler.schedule(time.time() + 0.05, scheduler.stop)
+    thread.join(timeout = 5)
+    self.assertFalse(thread.is_alive())
+    self.assertEqual(calls, ['now'])
+
+
+class EmaScheduleTest(BaseTestCase):
+
+  def test_resume_after_restart(self):
+    from svc import push_ema_svc
+    from svc.scheduler import Scheduler
+
+    user, _ = self.get_token()
+    user.fcm_token = 'token'
+    user.save()
+
+    morning = dt.now().replace(hour = 8, minute = 0, second = 0, microsecond = 0).timestamp()
+    scheduler = Scheduler(clock = lambda: morning)
+    push_ema_svc.Planner(scheduler).plan()
+    schedules = list(mdl.EmaSchedule.objects.filter(user = user).order_by('planned_ts'))
+    self.assertGreater(len(schedules), 1)
+    self.assertEqual(len(scheduler), len(schedules) + 1)   # plus the next planning round
+
+    # a restart after the second notification was due: the stored plan is resumed, not re-planned
+    now = schedules[1].planned_ts/1000 + 60
+    scheduler = Scheduler(clock = lambda: now)
+    fcm = push.FakeMessaging()
+    with mock.patch('api.push.backend', fcm):
+      push_ema_svc.Planner(scheduler).plan()
+      self.assertEqual(mdl.EmaSchedule.objects.filter(user = user).count(), len(schedules))
+      self.assertEqual(scheduler.run_pending(), 2)   # the due notification, then the batch
+      self.assertEqual([x.token for x in fcm.messages], ['token'])
+
+    statuses = list(mdl.EmaSchedule.objects.filter(user = user).order_by('planned_ts').values_list('status', flat = True))
+    self.assertEqual(statuses[:2], ['missed', 'sent'])
+    self.assertTrue(all(x == 'pending' for x in statuses[2:]))
+    self.assertEqual(len(scheduler), len(schedules) - 2 + 1)
+
+  def test_recover_sending(self):
+    from svc import push_ema_svc
+    from svc.scheduler import Scheduler
+
+    user, _ = self.get_token()
+    user.fcm_token = 'token'
+    user.save()
+    morning = dt.now().replace(hour = 8, minute = 0, second = 0, microsecond = 0).timestamp()
+    push_ema_svc.Planner(Scheduler(clock = lambda: morning)).plan()
+    schedule = mdl.EmaSchedule.objects.filter(user = user).order_by('planned_ts').first()
+    svc.claim_ema_schedules([schedule.id], schedule.planned_ts)   # then the instance crashed while sending
+
+    now = [schedule.planned_ts/1000 + 60]
+    scheduler = Scheduler(clock = lambda: now[0])
+    planner = push_ema_svc.Planner(scheduler)
+    planner.plan()
+    fcm = push.FakeMessaging()
+    with mock.patch('api.push.backend', fcm):
+      planner.recover()
+      scheduler.run_pending()
+      self.assertEqual(mdl.EmaSchedule.objects.get(id = schedule.id).status, 'sending')   # may still be sent by a live instance
+
+      now[0] += push_ema_svc.SENDING_STALE
+      planner.recover()
+      scheduler.run_pending()
+    self.assertEqual([x.token for x in fcm.messages], ['token'])
+    self.assertEqual(mdl.EmaSchedule.objects.get(id = schedule.id).status, 'sent')
+
+  def test_enrollment(self):
+    from svc import push_ema_svc
+    from svc.scheduler import Scheduler
+
+    morning = dt.now().replace(hour = 8, minute = 0, second = 0, microsecond = 0).timestamp()
+    scheduler = Scheduler(clock = lambda: morning)
+    planner = push_ema_svc.Planner(scheduler)
+    planner.plan()
+    self.assertEqual(len(scheduler), 1)   # nobody to notify yet
+
+    # sign-up with a token and setting a token both announce the participant
+    with mock.patch('api.events.notify_participant') as notify:
+      res = api.SignUp.as_view()(self.fac.post(get_url('signUpApi'), dict(
+        email = 'other@email.com',
+        full_name = 'Dummy',
+        gender = 'F',
+        date_of_birth = '19960527',
+        fcm_token = 'other-token',
+        password = self.password,
+      )))
+      self.assertEqual(res.status_code, status.HTTP_201_CREATED)
+      other = mdl.User.objects.get(email = 'other@email.com')
+      user, _ = self.get_token()
+      res = api.SetFcmToken.as_view()(self.force_auth(self.fac.put(get_url('setFcmTokenApi'), dict(fcm_token = 'token'))))
+      self.assertEqual(res.status_code, status.HTTP_200_OK)
+    self.assertEqual([x.args[0] for x in notify.call_args_list], [other.id, user.id])
+
+    # a notification plans the affected participant only
+    planner.plan_participant(user.id)
+    self.assertEqual(set(mdl.EmaSchedule.objects.values_list('user_id', flat = True)), {user.id})
+    planned = len(scheduler)
+    planner.plan_participant(user.id)
+    self.assertEqual(len(scheduler), planned)
+
+    # polling (no notifications, e.g. SQLite) picks up the rest
+    planner.plan_unplanned()
+    self.assertEqual(set(mdl.EmaSchedule.objects.values_list('user_id', flat = True)), {user.id, other.id})
+    self.assertEqual(planner.planned, {user.id, other.id})
+
+
+class ShardedPushTest(BaseTestCase):
+
+  def test_assign_shards(self):
+    from svc import sharding
+
+    workers = ['a', 'b', 'c']
+    shards = {x: sharding.assign_shards(workers, x) for x in workers}
+    self.assertEqual(sorted(sum(map(list, shards.values()), [])), list(range(sharding.NUM_SHARDS)))
+    self.assertTrue(all(len(x) > sharding.NUM_SHARDS/6 for x in shards.values()))
+    # a leaving worker's shards move, the others stay
+    self.assertTrue(shards['a'] <= sharding.assign_shards(['a', 'c'], 'a'))
+    self.assertEqual(sharding.assign_shards(['a'], 'b'), set())
+
+  def test_failover(self):
+    from svc import push_ema_svc
+    from svc import sharding
+    from svc.scheduler import Scheduler
+
+    mdl.User.objects.bulk_create([
+      mdl.User(username = f'u{i}', email = f'u{i}@email.com', full_name = 'x', gender = 'M', date_of_birth = '1996-05-27', fcm_token = f'token-{i}')
+      for i in range(40)
+    ])
+    now = [dt.now().replace(hour = 8, minute = 0, second = 0, microsecond = 0).timestamp()]
+    planners, coordinators = dict(), dict()
+    with mock.patch.object(sharding.LocalLocks, 'owners', dict()):
+      for name in ['a', 'b']:
+        planners[name] = push_ema_svc.Planner(Scheduler(clock = lambda: now[0]))
+        coordinators[name] = sharding.Coordinator(planners[name].scheduler, planners[name], name = name)
+
+      coordinators['a'].rebalance()   # alone: owns every shard
+      self.assertEqual(len(planners['a'].planned), 40)
+      coordinators['b'].rebalance()   # shards are still locked by a
+      self.assertEqual(planners['b'].planned, set())
+      coordinators['a'].rebalance()   # a hands over b's share
+      coordinators['b'].rebalance()
+      self.assertEqual(planners['a'].planned | planners['b'].planned, set(mdl.User.objects.values_list('id', flat = True)))
+      self.assertEqual(planners['a'].planned & planners['b'].planned, set())
+      self.assertGreater(len(planners['b'].planned), 0)
+      self.assertEqual(len(planners['a'].scheduler), sum(len(x) for x in planners['a'].entries.values()))
+
+      # b dies: its locks go with the database session, a takes over after the heartbeat timeout
+      coordinators['b'].locks.close()
+      now[0] += sharding.HEARTBEAT_TIMEOUT + 1
+      coordinators['a'].rebalance()
+      self.assertEqual(len(planners['a'].planned), 40)
+      self.assertEqual(coordinators['a'].shards, set(range(sharding.NUM_SHARDS)))
+    self.assertEqual(mdl.EmaSchedule.objects.values('user').distinct().count(), 40)
+    self.assertEqual(mdl.EmaSchedule.objects.count(), sum(len(x) for x in planners['a'].entries.values()))   # resumed, not re-planned
+
+
+class PushSimulationTest(BaseTestCase):
+
+  def test_simulate(self):
+    from svc import push_ema_svc
+
+    user, _ = self.get_token()
+    user.fcm_token = 'token'
+    user.save()
+    backend = push.backend
+    with mock.patch.object(push_ema_svc.Planner, 'plan_users', autospec = True, side_effect = push_ema_svc.Planner.plan_users) as plan_users:
+      stats = push_ema_svc.simulate(participants = 20, days = 2, latency = 0.05, unregistered = 0.1)
+    self.assertNotIn(user.id, [x.id for call in plan_users.call_args_list for x in call.args[1]])   # real participants are left alone
+    self.assertEqual(stats['participants'], 20)
+    self.assertGreater(stats['pushes'], 20*2*5)
+    self.assertLess(stats['sent'], stats['pushes'])   # 2 uninstalled apps: only their first push is attempted
+    self.assertLessEqual(stats['fcm_requests'], stats['pushes'])
+    self.assertEqual(stats['max_threads'], threading.active_count())
+    self.assertIs(push.backend, backend)
+    # nothing is kept
+    self.assertEqual(mdl.User.objects.filter(username__startswith = 'sim-').count(), 0)
+    self.assertEqual(mdl.EmaSchedule.objects.count() + mdl.PushDelivery.objects.count(), 0)
+
+
+class BatchedPushTest(BaseTestCase):
+
+  def test_send_each(self):
+    fcm = push.FakeMessaging(unregistered = {'token-7'})
+    with mock.patch('api.push.backend', fcm):
+      errors = push.send_ema_pushes({i: f'token-{i}' for i in range(1203)})
+    self.assertEqual(fcm.requests, 3)   # 500 per request
+    self.assertEqual(len(fcm.messages), 1202)
+    self.assertEqual([x for x, e in errors.items() if e], [7])
+    self.assertIsInstance(errors[7], messaging.UnregisteredError)
+
+  def test_co_scheduled_pushes(self):
+    from svc import push_ema_svc
+    from svc.scheduler import Scheduler
+
+    now = dt.now().timestamp()
+    scheduler = Scheduler(clock = lambda: now)
+    planner = push_ema_svc.Planner(scheduler)
+    users = mdl.User.objects.bulk_create([
+      mdl.User(username = f'u{i}', email = f'u{i}@email.com', full_name = 'x', gender = 'M', date_of_birth = '1996-05-27', fcm_token = f'token-{i}')
+      for i in range(20)
+    ])
+    for user in users:
+      for schedule in svc.create_ema_schedules(user, [int(now*1000)]):
+        scheduler.schedule(now, planner.send, schedule.id)
+
+    fcm = push.FakeMessaging()
+    with mock.patch('api.push.backend', fcm):
+      scheduler.run_pending()
+    self.assertEqual((fcm.requests, len(fcm.messages)), (1, 20))
+    self.assertEqual(mdl.EmaSchedule.objects.filter(status = 'sent').count(), 20)
+
+
+class CohortPushTest(BaseTestCase):
+
+  def test_all_active(self):
+    user, _ = self.get_token()
+    user.is_staff = True
+    user.save()
+    users = mdl.User.objects.bulk_create([
+      mdl.User(username = f'u{i}', email = f'u{i}@email.com', full_name = 'x', gender = 'M', date_of_birth = '1996-05-27', fcm_token = f'token-{i}')
+      for i in range(3)
+    ])
+    view = api.SendEmaPushes.as_view()
+    res = view(self.force_auth(self.fac.post(get_url('sendEMAPushesApi'), dict(), format = 'json')))
+    self.assertEqual(res.status_code, status.HTTP_400_BAD_REQUEST)
+
+    res = view(self.force_auth(self.fac.post(get_url('sendEMAPushesApi'), dict(all_active = True), format = 'json')))
+    self.assertEqual(res.status_code, status.HTTP_202_ACCEPTED)   # nothing sent within the request
+    job_id = res.data['job_id']
+    status_view = api.GetPushJob.as_view()
+    res = status_view(self.force_auth(self.fac.get(get_url('pushJobApi', args = [job_id]))), job_id = job_id)
+    self.assertEqual((res.data['status'], res.data['outcomes']), ('pending', None))
+
+    self.assertEqual(slc.get_job(job_id).max_attempts, 1)   # not retried: participants would be prompted twice
+    fcm = push.FakeMessaging(unregistered = {'token-1'})
+    with mock.patch('api.push.backend', fcm):
+      self.assertEqual(jobs.run_pending(), 1)
+    self.assertEqual(fcm.requests, 1)
+    res = status_view(self.force_auth(self.fac.get(get_url('pushJobApi', args = [job_id]))), job_id = job_id)
+    self.assertEqual(res.data['status'], 'done')
+    self.assertEqual(res.data['outcomes'], {str(users[0].id): 'sent', str(users[1].id): 'unregistered', str(users[2].id): 'sent'})
+    self.assertIsNone(mdl.User.objects.get(id = users[1].id).fcm_token)
+
+  def test_pids(self):
+    user, _ = self.get_token()
+    user.is_staff = True
+    user.save()
+    other = mdl.User.objects.create(username = 'u', email = 'u@email.com', full_name = 'x', gender = 'M', date_of_birth = '1996-05-27', fcm_token = 'token')
+    res = api.SendEmaPushes.as_view()(self.force_auth(self.fac.post(
+      get_url('sendEMAPushesApi'),
+      dict(pids = [other.id, user.id]),
+      format = 'json',
+    )))
+    self.assertEqual(res.status_code, status.HTTP_202_ACCEPTED)
+
+    fcm = push.FakeMessaging()
+    with mock.patch('api.push.backend', fcm):
+      jobs.run_pending()
+    self.assertEqual(slc.get_job(res.data['job_id']).result, {str(other.id): 'sent', str(user.id): 'no_token'})
+    res = api.GetPushJob.as_view()(self.force_auth(self.fac.get(get_url('pushJobApi', args = [0]))), job_id = 0)
+    self.assertEqual(res.status_code, status.HTTP_404_NOT_FOUND)
+
+
+class PushMetricsTest(BaseTestCase):
+
+  def test_match_responses(self):
+    minute = 60*1000
+    push_users = np.array([1, 1, 2, 3, 1])
+    push_ts = np.array([0, 30, 0, 0, 200])*minute
+    report_users = np.array([1, 1, 2, 3, 1])
+    report_ts = np.array([40, 45, 10, 90, 190])*minute
+    # user 1: the first push is superseded by the second one, user 3 answered too late, the last push is unanswered
+    self.assertEqual(
+      (metrics.match_responses(push_users, push_ts, report_users, report_ts)//minute).tolist(),
+      [-1, 40, 10, -1, -1],
+    )
+
+  def test_daily_metrics(self):
+    user, _ = self.get_token()
+    user.is_staff = True
+    user.save()
+    users = mdl.User.objects.bulk_create([
+      mdl.User(username = f'u{i}', email = f'u{i}@email.com', full_name = 'x', gender = 'M', date_of_birth = '1996-05-27', fcm_token = f'token-{i}')
+      for i in range(3)
+    ])
+    fcm = push.FakeMessaging(unregistered = {'token-2'})
+    with mock.patch('api.push.backend', fcm):
+      res = api.SendEmaPush.as_view()(self.force_auth(self.fac.post(get_url('sendEMAPushApi'), dict(pid = users[0].id))))
+      self.assertEqual(res.status_code, status.HTTP_200_OK)
+      svc.queue_ema_pushes()
+      jobs.run_pending()
+    self.assertEqual(mdl.PushDelivery.objects.filter(source = 'manual').count(), 1)
+    self.assertEqual(
+      sorted(mdl.PushDelivery.objects.filter(source = 'cohort').values_list('user_id', 'outcome')),
+      [(users[0].id, 'sent'), (users[1].id, 'sent'), (users[2].id, 'unregistered')],
+    )
+
+    # user 0 answers the later (cohort) push after five minutes
+    sent_ts = mdl.PushDelivery.objects.get(source = 'cohort', user = users[0]).sent_ts
+    mdl.SelfReport.objects.create(
+      user = users[0],
+      timestamp = sent_ts + 5*60*1000,
+      pss_control = 1,
+      pss_confident = 1,
+      pss_yourway = 1,
+      pss_difficulties = 1,
+      stresslvl = 1,
+      social_settings = 'alone',
+      location = 'home',
+      activity = 'work',
+    )
+    self.assertIsNotNone(jobs.enqueue_unique('compute_push_metrics'))
+    self.assertIsNone(jobs.enqueue_unique('compute_push_metrics'))
+    jobs.run_pending()
+
+    answered = mdl.PushDelivery.objects.get(source = 'cohort', user = users[0])
+    self.assertEqual(answered.response_latency_ms, 5*60*1000)
+    self.assertIsNone(mdl.PushDelivery.objects.get(source = 'manual').response_ts)
+    rows = {x.user_id: x for x in mdl.ResponseMetric.objects.all()}
+    self.assertEqual((rows[users[0].id].pushes, rows[users[0].id].delivered, rows[users[0].id].responded), (2, 2, 1))
+    self.assertEqual(rows[users[0].id].response_p50_ms, 5*60*1000)
+    self.assertEqual((rows[users[2].id].delivered, rows[users[2].id].responded), (0, 0))
+
+    week = slc.get_response_metrics(0)
+    self.assertEqual(week[users[0].id]['compliance'], 50)
+    self.assertEqual(week[users[0].id]['response_minutes'], 5.0)
+    self.assertIsNone(week[users[2].id]['compliance'])
+
+
+class PushRetryTest(BaseTestCase):
+
+  def test_outage(self):
+    from svc import push_ema_svc
+    from svc.scheduler import Scheduler
+
+    now = [dt.now().timestamp()]
+    scheduler = Scheduler(clock = lambda: now[0])
+    planner = push_ema_svc.Planner(scheduler)
+    users = mdl.User.objects.bulk_create([
+      mdl.User(username = f'u{i}', email = f'u{i}@email.com', full_name = 'x', gender = 'M', date_of_birth = '1996-05-27', fcm_token = f'token-{i}')
+      for i in range(10)
+    ])
+    for user in users:
+      for schedule in svc.create_ema_schedules(user, [int(now[0]*1000)]):
+        scheduler.schedule(now[0], planner.send, schedule.id)
+
+    fcm = push.FakeMessaging(unregistered = {'token-0'})
+    fcm.down = True
+    with mock.patch('api.push.backend', fcm):
+      while not planner.breaker.opened_at:
+        now[0] = scheduler.next_due()
+        scheduler.run_pending()
+      self.assertEqual(fcm.requests, push.BREAKER_THRESHOLD)
+
+      # no requests while the circuit is open, participants stay enrolled
+      while scheduler.next_due() < planner.breaker.retry_at:
+        now[0] = scheduler.next_due()
+        scheduler.run_pending()
+      self.assertEqual(fcm.requests, push.BREAKER_THRESHOLD)
+      self.assertEqual(mdl.User.objects.filter(fcm_token__isnull = True).count(), 0)
+      self.assertEqual(mdl.EmaSchedule.objects.filter(status = 'pending').count(), 10)
+
+      fcm.down = False
+      while scheduler.next_due() is not None:
+        now[0] = scheduler.next_due()
+        scheduler.run_pending()
+
+    self.assertEqual(mdl.EmaSchedule.objects.filter(status = 'sent').count(), 9)
+    self.assertEqual(list(mdl.EmaSchedule.objects.filter(status = 'failed').values_list('user', flat = True)), [users[0].id])
+    self.assertEqual(list(mdl.User.objects.filter(fcm_token__isnull = True).values_list('id', flat = True)), [users[0].id])
+
+  def test_retry_delay(self):
+    delays = [push.get_retry_delay(x) for x in range(20)]
+    self.assertTrue(all(0 <= x <= push.RETRY_MAX_DELAY for x in delays))
+    self.assertLessEqual(push.get_retry_delay(0), push.RETRY_BASE_DELAY)
+
+
+@override_settings(ROOT_URLCONF = 'dashboard.ingestion_urls')
+class IngestionAppTest(BaseTestCase):
+
+  def test_api_only(self):
+    _, token = self.get_token()
+    res = self.client.put(
+      get_url('setFcmTokenApi'),
+      data = 'fcm_token=token',
+      content_type = 'application/x-www-form-urlencoded',
+      HTTP_AUTHORIZATION = f'Token {token.key}',
+    )
+    self.assertEqual(res.status_code, status.HTTP_200_OK)
+    self.assertEqual(self.client.get('/').status_code, status.HTTP_404_NOT_FOUND)   # dashboard pages live in the other pool
+    self.assertEqual(self.client.get('/admin/').status_code, status.HTTP_404_NOT_FOUND)
+
+
+@override_settings(ROOT_URLCONF = 'dashboard.ingestion_asgi_urls', MIDDLEWARE = [])
+class AsyncIngestionTest(BaseTestCase):
+  from api.views import DATA_DUMP_DIR
+
+  def tearDown(self):
+    dirpath = join(self.DATA_DUMP_DIR, self.email)
+    if exists(dirpath): shutil.rmtree(dirpath)
+
+  async def test_insert_file(self):
+    _, token = await sync_to_async(self.get_token)()
+    headers = dict(authorization = f'Token {token.key}')
+    post = lambda name: self.async_client.post(
+      get_url('submitPPGApi'),
+      data = dict(file = SimpleUploadedFile(name = name, content = b'1669852800000,1\n1669852800040,2\n')),
+      headers = headers,
+    )
+
+    res = await post('ppg1.csv')
+    self.assertEqual(res.status_code, status.HTTP_200_OK)
+    res = await post('ppg1.csv')   # a retry
+    self.assertEqual((res.status_code, res.json()), (status.HTTP_200_OK, dict(duplicate = True)))
+    self.assertEqual((await post('acc1.csv')).status_code, status.HTTP_400_BAD_REQUEST)
+    self.assertEqual(await mdl.WatchUpload.objects.filter(kind = 'ppg').acount(), 1)
+    self.assertEqual(len(storage.get_raw_segments(self.email, 'ppg')), 1)
+
+    res = await self.async_client.post(get_url('submitPPGApi'), data = dict(file = SimpleUploadedFile(name = 'ppg2.csv', content = b'1,2\n')))
+    self.assertEqual(res.status_code, status.HTTP_401_UNAUTHORIZED)
+    res = await self.async_client.post(get_url('submitPPGApi'), headers = dict(authorization = 'Token invalid'))
+    self.assertEqual(res.status_code, status.HTTP_401_UNAUTHORIZED)
+
+  async def test_upload_chunk(self):
+    _, token = await sync_to_async(self.get_token)()
+    headers = dict(authorization = f'Token {token.key}')
+    content = b''.join(f'{1669852800000 + i},{i}\n'.encode() for i in range(1000))
+    session = resumable.create_session(self.email, 'ppg', 'ppg1.csv', len(content))
+    url = get_url('uploadSessionApi', args = [session['id']])
+    put = lambda offset, data: self.async_client.put(f'{url}?offset={offset}', data = data, content_type = 'application/octet-stream', headers = headers)
+
+    res = await put(0, content[:5000])
+    self.assertEqual((res.status_code, res.json()['offset']), (status.HTTP_200_OK, 5000))
+    res = await put(0, content[:5000])   # a stale offset
+    self.assertEqual((res.status_code, res.json()['offset']), (status.HTTP_409_CONFLICT, 5000))
+    res = await put(5000, content[5000:])
+    self.assertEqual(res.json()['offset'], len(content))
+    res = await self.async_client.get(url, headers = headers)
+    self.assertEqual(res.json(), dict(offset = len(content), size = len(content)))
+
+    # finalizing is a short request, served by the sync view
+    res = await self.async_client.post(get_url('finalizeUploadSessionApi', args = [session['id']]), headers = headers)
+    self.assertEqual(res.status_code, status.HTTP_200_OK)
+    buf = BytesIO()
+    storage.export_raw(self.email, 'ppg', buf)
+    self.assertEqual(buf.getvalue(), content)
+
+  async def test_no_export(self):
+    # streamed under WSGI by the dashboard pool, ASGI would collect the whole export in memory
+    res = await self.async_client.get('/api/export_watch_data', dict(pid = 1, kind = 'ppg'))
+    self.assertEqual(res.status_code, status.HTTP_404_NOT_FOUND)
+    res = await self.async_client.post('/api/send_ema_pushes')
+    self.assertEqual(res.status_code, status.HTTP_401_UNAUTHORIZED)   # the other sync views are routed
+
+
+class ThrottleTest(BaseTestCase):
+
+  def test_token_bucket(self):
+    with mock.patch.dict(throttling.BUCKETS, records = (4, 1.0)):
+      res = [throttling.take('records', 1, now = 1000.0) for _ in range(5)]
+      self.assertEqual(res, [(0, None), (0, None), (0, 1), (0, 2), (1.0, 2)])   # the hint comes before the refusal
+      self.assertEqual(throttling.take('records', 2, now = 1000.0), (0, None))   # buckets are per participant
+      self.assertEqual(throttling.take('records', 1, now = 1002.5), (0, 1))   # refilled by 2.5 requests
+
+    # no database queries, concurrent requests never overspend a bucket
+    with mock.patch.dict(throttling.BUCKETS, records = (50, 0.001)), self.assertNumQueries(0):
+      allowed = list()
+      threads = [threading.Thread(target = lambda: allowed.extend(throttling.take('records', 3, now = 1000.0)[0] == 0 for _ in range(20))) for _ in range(8)]
+      for thread in threads:
+        thread.start()
+      for thread in threads:
+        thread.join()
+      self.assertEqual(sum(allowed), 50)
+
+  def test_bucket_table(self):
+    table = throttling.BucketTable(join(throttling.THROTTLE_DIR, 'small.bin'), slots = 1)
+    self.addCleanup(table.close)
+    take = lambda key, ts: table.update(key, lambda state: ((state[0] + 1 if state else 1, ts), state))
+
+    for i in range(throttling.PROBES):
+      self.assertIsNone(take(f'key{i}', float(i)))
+    self.assertEqual(take('key1', 10.0), (1, 1.0))
+    self.assertEqual(getsize(table.path), (1 + throttling.PROBES)*throttling.SLOT.size)   # a fixed size
+    # all slots taken: the least recently updated bucket (key0) is reused
+    self.assertIsNone(take('other', 11.0))
+    self.assertIsNone(take('key0', 12.0))
+    self.assertEqual(take('key1', 13.0), (2, 10.0))
+
+  def test_throttled_response(self):
+    _, token = self.get_token()
+    get = lambda: self.client.get(get_url('getSelfReportsApi'), HTTP_AUTHORIZATION = f'Token {token.key}')
+
+    with mock.patch.dict(throttling.BUCKETS, records = (2, 0.01)):
+      self.assertNotIn(throttling.BATCH_HINT_HEADER, get())
+      res = get()
+      self.assertEqual((res.status_code, res[throttling.BATCH_HINT_HEADER]), (status.HTTP_200_OK, '100'))   # below half of the burst
+      res = get()
+      self.assertEqual((res.status_code, res['Retry-After']), (status.HTTP_429_TOO_MANY_REQUESTS, '100'))
+      self.assertEqual(res[throttling.BATCH_HINT_HEADER], '100')
+      self.assertEqual(self.client.get(get_url('pushJobApi', args = [0])).status_code, status.HTTP_401_UNAUTHORIZED)   # not throttled
+
+    throttling.flush_counts()
+    counts = throttling.get_counts(time.time() - throttling.HOUR, time.time())
+    self.assertEqual([(x['scope'], x['allowed'], x['hinted'], x['throttled']) for x in counts], [('records', 1, 1, 1)])
+
+  @override_settings(ROOT_URLCONF = 'dashboard.ingestion_asgi_urls', MIDDLEWARE = ['api.throttling.batch_hint_middleware'])
+  async def test_async_view(self):
+    _, token = await sync_to_async(self.get_token)()
+    put = lambda: self.async_client.put(
+      get_url('uploadSessionApi', args = ['0'*32]),
+      data = b'1,2\n',
+      content_type = 'application/octet-stream',
+      headers = dict(authorization = f'Token {token.key}'),
+    )
+
+    with mock.patch.dict(throttling.BUCKETS, files = (1, 0.5)):
+      res = await put()
+      self.assertEqual((res.status_code, res[throttling.BATCH_HINT_HEADER]), (status.HTTP_404_NOT_FOUND, '1'))
+      res = await put()
+      self.assertEqual((res.status_code, res['Retry-After']), (status.HTTP_429_TOO_MANY_REQUESTS, '2'))
+
+
+class LoadSheddingTest(BaseTestCase):
+
+  def test_signals(self):
+    now = [0.0]
+    monitor = loadshedding.LoadMonitor(clock = lambda: now[0])
+    for ms in range(loadshedding.DB_MIN_SAMPLES - 1):
+      monitor.record_query(ms)
+    self.assertEqual(monitor.get_db_p95(), 0.0)   # too few queries
+
+    for ms in range(100):
+      monitor.record_query(ms*10)
+    now[0] = loadshedding.DB_P95_INTERVAL
+    self.assertEqual(monitor.get_db_p95(), 930)
+    for _ in range(3):
+      monitor.start()
+    monitor.finish()
+    self.assertEqual(monitor.get_load(), 930/loadshedding.DB_P95_LIMIT_MS)   # no in-flight limit by default (sync workers)
+    with mock.patch.object(loadshedding, 'MAX_IN_FLIGHT', 1):
+      self.assertEqual(monitor.get_load(), 2.0)
+
+    now[0] = loadshedding.DB_P95_INTERVAL + loadshedding.DB_WINDOW + 1
+    self.assertEqual(monitor.get_db_p95(), 0.0)   # old queries leave the window
+
+  def test_priorities(self):
+    statuses = lambda: [
+      self.client.get(get_url('index')).status_code,
+      self.client.get(get_url('exportWatchDataApi')).status_code,
+      self.client.post(get_url('submitLocationApi')).status_code,
+      self.client.post(get_url('signInApi')).status_code,
+    ]
+    shed = status.HTTP_503_SERVICE_UNAVAILABLE
+    for load, expected in [
+      (0.5, [status.HTTP_302_FOUND, status.HTTP_401_UNAUTHORIZED, status.HTTP_401_UNAUTHORIZED, status.HTTP_400_BAD_REQUEST]),
+      (1.2, [shed, shed, status.HTTP_401_UNAUTHORIZED, status.HTTP_400_BAD_REQUEST]),   # dashboard and exports first
+      (1.6, [shed, shed, shed, status.HTTP_400_BAD_REQUEST]),   # then ingestion
+      (2.0, [shed, shed, shed, shed]),
+    ]:
+      with mock.patch.object(loadshedding.monitor, 'get_load', return_value = load):
+        self.assertEqual(statuses(), expected)
+
+    with mock.patch.object(loadshedding.monitor, 'get_load', return_value = 1.0):
+      self.assertEqual(self.client.get(get_url('index'))['Retry-After'], str(loadshedding.RETRY_AFTER))
+    self.assertEqual(loadshedding.monitor.in_flight, 0)
+
+  async def test_in_flight(self):
+    release = asyncio.Event()
+
+    async def get_response(request):
+      await release.wait()
+      return HttpResponse()
+
+    middleware = loadshedding.load_shedding_middleware(get_response)
+    fac = RequestFactory()
+    with mock.patch.object(loadshedding, 'MAX_IN_FLIGHT', 2):
+      held = [asyncio.ensure_future(middleware(fac.post(get_url('submitLocationApi')))) for _ in range(2)]
+      await asyncio.sleep(0)
+      self.assertEqual(loadshedding.monitor.in_flight, 2)
+      # the 3rd request in flight: 1.5 times the limit
+      self.assertEqual((await middleware(fac.get(get_url('exportWatchDataApi')))).status_code, status.HTTP_503_SERVICE_UNAVAILABLE)
+      self.assertEqual((await middleware(fac.post(get_url('submitLocationApi')))).status_code, status.HTTP_503_SERVICE_UNAVAILABLE)
+
+      release.set()
+      self.assertEqual([x.status_code for x in await asyncio.gather(*held)], [status.HTTP_200_OK]*2)
+      self.assertEqual((await middleware(fac.get(get_url('exportWatchDataApi')))).status_code, status.HTTP_200_OK)
+    self.assertEqual(loadshedding.monitor.in_flight, 0)
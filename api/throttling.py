@@ -0,0 +1,203 @@
+from typing import Any, Callable, List, Optional, Tuple
+from collections import Counter
+from uuid import uuid4
+import threading
+import hashlib
+import atexit
+import struct
+import fcntl
+import json
+import math
+import time
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.utils.decorators import sync_and_async_middleware
+
+from os import environ, makedirs, replace
+from os.path import join, dirname, exists
+import os
+
+from rest_framework.throttling import BaseThrottle
+
+THROTTLE_DIR = environ.get('THROTTLE_DIR', join(environ['DATA_DUMP_DIR'], '.throttle'))   # local disk, shared by the workers of the api and dashboard servers
+BUCKETS_FILENAME = 'buckets.bin'
+COUNTS_FILENAME = 'counts.json'
+BUCKETS = {   # endpoint group (a view's throttle_scope): burst (requests), sustained rate (requests per second)
+  'auth': (30, 0.5),
+  'records': (300, 2.0),   # phone sensor records, a request per row
+  'files': (60, 0.2),   # watch files and resumable upload chunks
+  'exports': (5, 1/60),
+}
+HINT_LEVEL = 0.5   # share of the burst left, below it responses ask the client to batch more
+BATCH_HINT_HEADER = 'X-Batch-Interval'   # seconds to collect data before the next request of the group
+OUTCOMES = ['allowed', 'hinted', 'throttled']
+COUNTS_FLUSH_INTERVAL = 10   # seconds, counts of a process are added to the shared counts file
+COUNTS_MAX_AGE = 7*24*60*60   # seconds
+SLOTS = 1 << 16   # buckets of participants (and client addresses) x endpoint groups, the file has a fixed size
+PROBES = 4   # slots a key may take, the least recently used of them is reused when all are taken
+SLOT = struct.Struct('<Qdd')   # key digest (0: empty), tokens, last update (seconds)
+HOUR = 60*60
+
+
+class BucketTable:
+  """ Token buckets in a fixed-size file of slots shared by worker processes, the slots of a key are updated under a byte-range lock """
+
+  def __init__(self, path: str, slots: int = SLOTS):
+    self.path = path
+    self.slots = slots
+    self.fd = None
+    self.pid = None
+    self.lock = threading.Lock()   # record locks are per process, threads of a worker take turns
+
+  def get_fd(self) -> int:
+    if self.fd is None or self.pid != os.getpid():   # not the descriptor of a preloading master
+      makedirs(dirname(self.path), exist_ok = True)
+      self.fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+      self.pid = os.getpid()
+      size = (self.slots + PROBES)*SLOT.size
+      if os.fstat(self.fd).st_size < size: os.ftruncate(self.fd, size)   # zero-filled: empty slots
+    return self.fd
+
+  def update(self, key: str, func: Callable[[Optional[Tuple[float, float]]], Tuple[Optional[Tuple[float, float]], Any]]) -> Any:
+    """ Calls func with the (tokens, ts) of a key (None: no bucket), stores the state it returns (None: unchanged), returns its result """
+
+    digest = int.from_bytes(hashlib.blake2b(key.encode(), digest_size = 8).digest(), 'little') or 1
+    offset, length = digest%self.slots*SLOT.size, PROBES*SLOT.size
+    with self.lock:
+      fd = self.get_fd()
+      fcntl.lockf(fd, fcntl.LOCK_EX, length, offset)
+      try:
+        slots = list(SLOT.iter_unpack(os.pread(fd, length, offset)))
+        i = next((i for i, x in enumerate(slots) if x[0] == digest), None)
+        state = slots[i][1:] if i is not None else None
+        if i is None: i = min(range(PROBES), key = lambda x: (slots[x][0] != 0, slots[x][2]))   # an empty slot, else the stalest one
+        state, ans = func(state)
+        if state is not None: os.pwrite(fd, SLOT.pack(digest, *state), offset + i*SLOT.size)
+      finally:
+        fcntl.lockf(fd, fcntl.LOCK_UN, length, offset)
+    return ans
+
+  def close(self):
+    if self.fd is not None and self.pid == os.getpid(): os.close(self.fd)
+    self.fd = None
+
+
+buckets = BucketTable(join(THROTTLE_DIR, BUCKETS_FILENAME))
+
+counts: Counter = Counter()   # (scope, outcome, hour) -> requests of this process, not flushed yet
+counts_lock = threading.Lock()
+flushed_at = time.time()
+
+
+def take(scope: str, ident, now: Optional[float] = None) -> Tuple[float, Optional[int]]:
+  """ Takes a request from the bucket of a participant (or client address) and endpoint group, returns seconds to wait (0: allowed) and the batch hint """
+
+  burst, rate = BUCKETS[scope]
+  now = time.time() if now is None else now
+
+  def refill(state):
+    tokens = burst if state is None else min(burst, state[0] + max(0.0, now - state[1])*rate)
+    if tokens < 1: return None, (tokens, (1 - tokens)/rate)   # a refused request does not change the bucket
+    return (tokens - 1, now), (tokens - 1, 0.0)
+
+  # the slots are locked: concurrent requests of a participant (in any worker) take tokens one after another
+  tokens, wait = buckets.update(f'{scope}:{ident}', refill)
+
+  hint = math.ceil((HINT_LEVEL*burst - tokens)/rate) if tokens < HINT_LEVEL*burst else None
+  count(scope, 'throttled' if wait else 'hinted' if hint else 'allowed', now)
+  return wait, hint
+
+
+def count(scope: str, outcome: str, now: float):
+  with counts_lock:
+    counts[(scope, outcome, int(now//HOUR*HOUR))] += 1
+    due = time.time() - flushed_at >= COUNTS_FLUSH_INTERVAL
+  if due: flush_counts()
+
+
+def flush_counts():
+  """ Adds the counts of this process to the shared counts file """
+
+  global flushed_at
+
+  with counts_lock:
+    flushed_at = time.time()
+    pending = dict(counts)
+    counts.clear()
+  if not pending: return
+
+  # under a file lock, counts of workers flushing at the same moment add up; replaced whole, readers never see a partial file
+  makedirs(THROTTLE_DIR, exist_ok = True)
+  path = join(THROTTLE_DIR, COUNTS_FILENAME)
+  with open(f'{path}.lock', 'w') as lock:
+    fcntl.flock(lock, fcntl.LOCK_EX)
+    stored = read_counts()
+    for (scope, outcome, hour), n in pending.items():
+      key = f'{scope}:{outcome}:{hour}'
+      stored[key] = stored.get(key, 0) + n
+    oldest = time.time() - COUNTS_MAX_AGE
+    tmp_path = join(THROTTLE_DIR, f'.{uuid4().hex}.tmp')
+    with open(tmp_path, 'w') as w:
+      json.dump({x: n for x, n in stored.items() if int(x.rsplit(':', 1)[1]) >= oldest}, w)
+    replace(tmp_path, path)
+
+
+def read_counts() -> dict:
+  path = join(THROTTLE_DIR, COUNTS_FILENAME)
+  if not exists(path): return dict()
+  with open(path, 'r') as r:
+    return json.load(r)
+
+
+atexit.register(flush_counts)   # e.g., a worker restarted after max_requests
+
+
+def get_counts(from_ts: float, till_ts: float) -> List[dict]:
+  """ Returns requests per hour and endpoint group (of all workers), by outcome: allowed, hinted (asked to batch more) and throttled """
+
+  hours = range(int(from_ts//HOUR*HOUR), int(till_ts) + 1, HOUR)
+  values = read_counts()
+
+  ans = list()
+  for hour in hours:
+    for scope in BUCKETS:
+      row = {x: values.get(f'{scope}:{x}:{hour}', 0) for x in OUTCOMES}
+      if any(row.values()): ans.append(dict(hour = hour, scope = scope, **row))
+  return ans
+
+
+class TokenBucketThrottle(BaseThrottle):
+  """ Token buckets per participant (or client address, before sign-in) and endpoint group: the view's throttle_scope """
+
+  def allow_request(self, request, view):
+    scope = getattr(view, 'throttle_scope', None)
+    if scope is None: return True
+
+    ident = request.user.pk if request.user and request.user.is_authenticated else self.get_ident(request)
+    self.delay, request._request.batch_interval = take(scope, ident)   # the hint is added by batch_hint_middleware
+    return not self.delay
+
+  def wait(self):
+    return self.delay
+
+
+@sync_and_async_middleware
+def batch_hint_middleware(get_response):
+  """ Adds the batch hint of throttled endpoint groups to the response, without a thread hop under ASGI """
+
+  def set_header(request, response):
+    hint = getattr(request, 'batch_interval', None)
+    if hint is not None: response[BATCH_HINT_HEADER] = str(hint)
+    return response
+
+  if iscoroutinefunction(get_response):
+    async def middleware(request):
+      return set_header(request, await get_response(request))
+
+    markcoroutinefunction(middleware)
+  else:
+    def middleware(request):
+      return set_header(request, get_response(request))
+
+  return middleware
+
@@ -0,0 +1,69 @@
+from django.core.files.uploadedfile import UploadedFile
+from django.core.files.uploadhandler import FileUploadHandler, SkipFile
+
+from os import makedirs
+from os.path import join
+import tempfile
+
+from api import storage
+
+INCOMING_DIRNAME = '.incoming'
+
+
+class UserDirUploadedFile(UploadedFile):
+  """ An uploaded file spooled into the participant's data directory (same filesystem as the final data) """
+
+  def __init__(self, dirpath, name, content_type, size, charset, content_type_extra = None):
+    makedirs(dirpath, exist_ok = True)
+    file = tempfile.NamedTemporaryFile(suffix = '.upload', dir = dirpath)
+    super().__init__(file, name, content_type, size, charset, content_type_extra)
+
+  def temporary_file_path(self):
+    return self.file.name
+
+  def close(self):
+    try:
+      return self.file.close()
+    except FileNotFoundError:
+      pass   # the file was moved into place already
+
+
+class UserDirUploadHandler(FileUploadHandler):
+  """ Writes uploaded chunks straight to disk, so memory use does not depend on the file size """
+
+  field_name = 'file'
+
+  def new_file(self, field_name, *args, **kwargs):
+    if field_name != self.field_name: raise SkipFile()   # the file views accept a single file field
+    super().new_file(field_name, *args, **kwargs)
+    self.file = UserDirUploadedFile(
+      dirpath = join(storage.DATA_DUMP_DIR, self.request.user.email, INCOMING_DIRNAME),
+      name = self.file_name,
+      content_type = self.content_type,
+      size = 0,
+      charset = self.charset,
+      content_type_extra = self.content_type_extra,
+    )
+
+  def receive_data_chunk(self, raw_data, start):
+    self.file.write(raw_data)
+
+  def file_complete(self, file_size):
+    self.file.seek(0)
+    self.file.size = file_size
+    return self.file
+
+  def upload_interrupted(self):
+    if hasattr(self, 'file'): self.file.close()
+
+
+class UserDirUploadMixin:
+  """ File views: spools uploads into participant's directory and removes leftovers with the response """
+
+  def initialize_request(self, request, *args, **kwargs):
+    request.upload_handlers = [UserDirUploadHandler(request)]
+    return super().initialize_request(request, *args, **kwargs)
+
+  def finalize_response(self, request, response, *args, **kwargs):
+    request.close()   # closing a spooled upload deletes it
+    return super().finalize_response(request, response, *args, **kwargs)
@@ -24,6 +24,16 @@ urlpatterns = [
   path('submit_acc', views.InsertAcc.as_view(), name = 'submitAccApi'),
   path('submit_off_body', views.InsertOffBody.as_view(), name = 'submitOffBodyApi'),
 
+   # resumable file upload views
+  path('upload_session', views.CreateUploadSession.as_view(), name = 'createUploadSessionApi'),
+  path('upload_session/<str:session_id>', views.UploadSessionChunk.as_view(), name = 'uploadSessionApi'),
+  path('upload_session/<str:session_id>/finalize', views.FinalizeUploadSession.as_view(), name = 'finalizeUploadSessionApi'),
+
+   # export view
+  path('export_watch_data', views.ExportWatchData.as_view(), name = 'exportWatchDataApi'),
+
    # push notification view
   path('send_ema_push', views.SendEmaPush.as_view(), name = 'sendEMAPushApi'),
+  path('send_ema_pushes', views.SendEmaPushes.as_view(), name = 'sendEMAPushesApi'),
+  path('push_job/<int:job_id>', views.GetPushJob.as_view(), name = 'pushJobApi'),
 ]
@@ -1,4 +1,5 @@
 from django.contrib.auth import authenticate
+from django.http import StreamingHttpResponse
 from django.utils.timezone import datetime as dt
 
 from rest_framework import generics, permissions, authentication
@@ -7,25 +8,19 @@ from rest_framework import response, status
 from rest_framework.exceptions import ValidationError
 from rest_framework.authtoken.models import Token
 
-from firebase_admin.exceptions import InvalidArgumentError
-from firebase_admin import messaging
-import firebase_admin
-
 from api import models as mdl
 from api import services as svc
 from api import selectors as slc
 from api import serializers as srz
+from api import push
+from api import resumable
+from api import storage
+from api import uploadhandlers
 
-from os import environ, mkdir
-from os.path import join, exists
+from os import environ
 
 DATA_DUMP_DIR = environ['DATA_DUMP_DIR']
 
-# Firebase sdk
-if not firebase_admin._apps:
-  cred = firebase_admin.credentials.Certificate('fcm_secret.json')
-  firebase_app = firebase_admin.initialize_app(credential = cred)
-
 
 class SignUp(generics.CreateAPIView):
 
@@ -56,6 +51,7 @@ class SignUp(generics.CreateAPIView):
 
   http_method_names = ['post']
   serializer_class = InputSerializer
+  throttle_scope = 'auth'
 
   def post(self, request, *args, **kwargs):
     serializer = SignUp.InputSerializer(data = request.data)
@@ -69,6 +65,7 @@ class SignUp(generics.CreateAPIView):
       gender = serializer.validated_data['gender'],
       date_of_birth = serializer.validated_data['date_of_birth'],
       password = serializer.validated_data['password'],
+      fcm_token = serializer.validated_data['fcm_token'],
     )
 
     serializer = srz.UserSerializer(instance = new_user)
@@ -87,6 +84,7 @@ class SignIn(generics.CreateAPIView):
 
   http_method_names = ['post']
   serializer_class = InputSerializer
+  throttle_scope = 'auth'
 
   def post(self, request, *args, **kwargs):
     serializer = SignIn.InputSerializer(data = request.data)
@@ -115,14 +113,14 @@ class SetFcmToken(generics.UpdateAPIView):
   authentication_classes = [authentication.TokenAuthentication]
   permission_classes = [permissions.IsAuthenticated]
   serializer_class = InputSerializer
+  throttle_scope = 'auth'
 
   def update(self, request, *args, **kwargs):
     serializer = SetFcmToken.InputSerializer(data = request.data)
     if not serializer.is_valid():
       return response.Response(serializer.errors, status = status.HTTP_400_BAD_REQUEST)
 
-    request.user.fcm_token = serializer.validated_data['fcm_token']
-    request.user.save()
+    svc.set_fcm_token(request.user, serializer.validated_data['fcm_token'])
 
     return response.Response(status = status.HTTP_200_OK)
 
@@ -132,12 +130,14 @@ class InsertSelfReport(generics.CreateAPIView):
   serializer_class = srz.SelfReportSerializer
   authentication_classes = [authentication.TokenAuthentication]
   permission_classes = [permissions.IsAuthenticated]
+  throttle_scope = 'records'
 
 
 class GetSelfReports(generics.ListAPIView):
   serializer_class = srz.ReadOnlySelfReportSerializer
   authentication_classes = [authentication.TokenAuthentication]
   permission_classes = [permissions.IsAuthenticated]
+  throttle_scope = 'records'
 
   def get_queryset(self):
     return slc.get_self_reports(user = self.request.user)
@@ -148,6 +148,7 @@ class InsertLocation(generics.CreateAPIView):
   serializer_class = srz.LocationSerializer
   authentication_classes = [authentication.TokenAuthentication]
   permission_classes = [permissions.IsAuthenticated]
+  throttle_scope = 'records'
 
 
 class InsertCallLog(generics.CreateAPIView):
@@ -155,6 +156,7 @@ class InsertCallLog(generics.CreateAPIView):
   serializer_class = srz.CallLogSerializer
   authentication_classes = [authentication.TokenAuthentication]
   permission_classes = [permissions.IsAuthenticated]
+  throttle_scope = 'records'
 
 
 class InsertActivityTransition(generics.CreateAPIView):
@@ -162,6 +164,7 @@ class InsertActivityTransition(generics.CreateAPIView):
   serializer_class = srz.ActivityTransitionSerializer
   authentication_classes = [authentication.TokenAuthentication]
   permission_classes = [permissions.IsAuthenticated]
+  throttle_scope = 'records'
 
 
 class InsertActivityRecognition(generics.CreateAPIView):
@@ -169,6 +172,7 @@ class InsertActivityRecognition(generics.CreateAPIView):
   serializer_class = srz.ActivityRecognitionSerializer
   authentication_classes = [authentication.TokenAuthentication]
   permission_classes = [permissions.IsAuthenticated]
+  throttle_scope = 'records'
 
 
 class InsertScreenState(generics.CreateAPIView):
@@ -176,6 +180,7 @@ class InsertScreenState(generics.CreateAPIView):
   serializer_class = srz.ScreenStateSerializer
   authentication_classes = [authentication.TokenAuthentication]
   permission_classes = [permissions.IsAuthenticated]
+  throttle_scope = 'records'
 
 
 class InsertCalendarEvent(generics.CreateAPIView):
@@ -183,9 +188,10 @@ class InsertCalendarEvent(generics.CreateAPIView):
   serializer_class = srz.CalendarEventSerializer
   authentication_classes = [authentication.TokenAuthentication]
   permission_classes = [permissions.IsAuthenticated]
+  throttle_scope = 'records'
 
 
-class InsertPPG(generics.CreateAPIView):
+class InsertPPG(uploadhandlers.UserDirUploadMixin, generics.CreateAPIView):
 
   class InputSerializer(serializers.Serializer):
     file = serializers.FileField(required = True, allow_empty_file = False)
@@ -203,6 +209,7 @@ class InsertPPG(generics.CreateAPIView):
   authentication_classes = [authentication.TokenAuthentication]
   permission_classes = [permissions.IsAuthenticated]
   serializer_class = InputSerializer
+  throttle_scope = 'files'
 
   def post(self, request, *args, **kwargs):
     serializer = InsertPPG.InputSerializer(data = request.data)
@@ -210,19 +217,14 @@ class InsertPPG(generics.CreateAPIView):
     if not serializer.is_valid():
       return response.Response(serializer.errors, status = status.HTTP_400_BAD_REQUEST)
 
-    # prepare user's directory
-    dirpath = join(DATA_DUMP_DIR, request.user.email)
-    if not exists(dirpath): mkdir(dirpath)
-
-    # save the files
-    file = serializer.validated_data['file']
-    with open(join(dirpath, 'ppg.csv'), 'ab+') as wb:
-      wb.write(file.read())
+    # save the file as a new segment (re-sent files are acknowledged, but not stored twice)
+    if not svc.create_watch_upload(request.user, 'ppg', serializer.validated_data['file']):
+      return response.Response(dict(duplicate = True), status = status.HTTP_200_OK)
 
     return response.Response(status = status.HTTP_200_OK)
 
 
-class InsertAcc(generics.CreateAPIView):
+class InsertAcc(uploadhandlers.UserDirUploadMixin, generics.CreateAPIView):
 
   class InputSerializer(serializers.Serializer):
     file = serializers.FileField(required = True, allow_empty_file = False)
@@ -240,6 +242,7 @@ class InsertAcc(generics.CreateAPIView):
   serializer_class = InputSerializer
   authentication_classes = [authentication.TokenAuthentication]
   permission_classes = [permissions.IsAuthenticated]
+  throttle_scope = 'files'
 
   def post(self, request, *args, **kwargs):
     serializer = InsertAcc.InputSerializer(data = request.data)
@@ -247,19 +250,14 @@ class InsertAcc(generics.CreateAPIView):
     if not serializer.is_valid():
       return response.Response(serializer.errors, status = status.HTTP_400_BAD_REQUEST)
 
-    # prepare user's directory
-    dirpath = join(DATA_DUMP_DIR, request.user.email)
-    if not exists(dirpath): mkdir(dirpath)
-
-    # save the files
-    file = serializer.validated_data['file']
-    with open(join(dirpath, 'acc.csv'), 'ab+') as wb:
-      wb.write(file.read())
+    # save the file as a new segment (re-sent files are acknowledged, but not stored twice)
+    if not svc.create_watch_upload(request.user, 'acc', serializer.validated_data['file']):
+      return response.Response(dict(duplicate = True), status = status.HTTP_200_OK)
 
     return response.Response(status = status.HTTP_200_OK)
 
 
-class InsertOffBody(generics.CreateAPIView):
+class InsertOffBody(uploadhandlers.UserDirUploadMixin, generics.CreateAPIView):
 
   class InputSerializer(serializers.Serializer):
     file = serializers.FileField(required = True, allow_empty_file = False)
@@ -277,6 +275,7 @@ class InsertOffBody(generics.CreateAPIView):
   serializer_class = InputSerializer
   authentication_classes = [authentication.TokenAuthentication]
   permission_classes = [permissions.IsAuthenticated]
+  throttle_scope = 'files'
 
   def post(self, request, *args, **kwargs):
     serializer = InsertOffBody.InputSerializer(data = request.data)
@@ -284,18 +283,184 @@ class InsertOffBody(generics.CreateAPIView):
     if not serializer.is_valid():
       return response.Response(serializer.errors, status = status.HTTP_400_BAD_REQUEST)
 
-    # prepare user's directory
-    dirpath = join(DATA_DUMP_DIR, request.user.email)
-    if not exists(dirpath): mkdir(dirpath)
+    # save the file as a new segment (re-sent files are acknowledged, but not stored twice)
+    if not svc.create_watch_upload(request.user, 'offbody', serializer.validated_data['file']):
+      return response.Response(dict(duplicate = True), status = status.HTTP_200_OK)
+
+    return response.Response(status = status.HTTP_200_OK)
+
+
+class CreateUploadSession(generics.CreateAPIView):
+
+  class InputSerializer(serializers.Serializer):
+    kind = serializers.ChoiceField(choices = storage.KINDS, required = True)
+    name = serializers.CharField(max_length = 256, required = True, allow_blank = False)
+    size = serializers.IntegerField(min_value = 1, max_value = resumable.SESSION_MAX_SIZE, default = None, allow_null = True)
+
+    class Meta:
+      fields = '__all__'
+
+  serializer_class = InputSerializer
+  authentication_classes = [authentication.TokenAuthentication]
+  permission_classes = [permissions.IsAuthenticated]
+  throttle_scope = 'files'
+
+  def post(self, request, *args, **kwargs):
+    serializer = CreateUploadSession.InputSerializer(data = request.data)
+
+    if not serializer.is_valid():
+      return response.Response(serializer.errors, status = status.HTTP_400_BAD_REQUEST)
+
+    session = resumable.create_session(request.user.email, **serializer.validated_data)
+    return response.Response(dict(id = session['id'], offset = 0), status = status.HTTP_201_CREATED)
 
-    # save the files
-    file = serializer.validated_data['file']
-    with open(join(dirpath, 'offbody.csv'), 'ab+') as wb:
-      wb.write(file.read())
 
+class UploadSessionChunk(generics.GenericAPIView):
+  authentication_classes = [authentication.TokenAuthentication]
+  permission_classes = [permissions.IsAuthenticated]
+  throttle_scope = 'files'
+
+  def get(self, request, session_id, *args, **kwargs):
+    session = resumable.get_session(request.user.email, session_id)
+    if not session:
+      return response.Response(status = status.HTTP_404_NOT_FOUND)
+
+    return response.Response(dict(offset = session['offset'], size = session['size']), status = status.HTTP_200_OK)
+
+  def put(self, request, session_id, *args, **kwargs):
+    session = resumable.get_session(request.user.email, session_id)
+    if not session:
+      return response.Response(status = status.HTTP_404_NOT_FOUND)
+
+    # chunks must follow the received bytes, a client resumes from the offset returned by GET
+    offset = request.query_params.get('offset', '')
+    if not offset.isdigit():
+      return response.Response(dict(offset = 'Offset is required'), status = status.HTTP_400_BAD_REQUEST)
+    if int(offset) != session['offset']:
+      return response.Response(dict(offset = session['offset']), status = status.HTTP_409_CONFLICT)
+
+    chunks = iter(lambda: request.stream.read(storage.CHUNK_SIZE), b'') if request.stream else []
+    offset = resumable.write_chunk(request.user.email, session, session['offset'], chunks)
+    if offset > resumable.get_max_size(session):
+      resumable.remove_session(request.user.email, session_id)
+      if session['size']: return response.Response(dict(size = 'Received more bytes than declared'), status = status.HTTP_400_BAD_REQUEST)
+      return response.Response(dict(size = f'Uploads are limited to {resumable.SESSION_MAX_SIZE} bytes'), status = status.HTTP_413_REQUEST_ENTITY_TOO_LARGE)
+
+    return response.Response(dict(offset = offset), status = status.HTTP_200_OK)
+
+
+class FinalizeUploadSession(generics.GenericAPIView):
+  authentication_classes = [authentication.TokenAuthentication]
+  permission_classes = [permissions.IsAuthenticated]
+  throttle_scope = 'files'
+
+  def post(self, request, session_id, *args, **kwargs):
+    session = resumable.get_session(request.user.email, session_id)
+    if not session:
+      return response.Response(status = status.HTTP_404_NOT_FOUND)
+    if session['offset'] == 0 or (session['size'] and session['offset'] != session['size']):
+      return response.Response(dict(offset = session['offset']), status = status.HTTP_409_CONFLICT)
+
+    # hand the assembled file to the regular file upload path
+    file = resumable.open_assembled_file(request.user.email, session)
+    try:
+      upload = svc.create_watch_upload(request.user, session['kind'], file)
+    finally:
+      file.close()
+    resumable.remove_session(request.user.email, session_id)
+
+    if not upload:
+      return response.Response(dict(duplicate = True), status = status.HTTP_200_OK)
     return response.Response(status = status.HTTP_200_OK)
 
 
+class ExportWatchData(generics.GenericAPIView):
+
+  class InputSerializer(serializers.Serializer):
+    pid = serializers.IntegerField(required = True)
+    kind = serializers.ChoiceField(choices = storage.KINDS, required = True)
+    from_ts = serializers.IntegerField(default = None, allow_null = True)
+    till_ts = serializers.IntegerField(default = None, allow_null = True)
+    file_format = serializers.ChoiceField(choices = ['csv', 'bin'], default = 'csv')   # 'format' is taken by DRF
+
+    def validate(self, attrs):
+      if not slc.user_exists(id = attrs['pid']):
+        raise ValidationError('Invalid user id provided!')
+      return attrs
+
+    class Meta:
+      fields = '__all__'
+
+  serializer_class = InputSerializer
+  authentication_classes = [authentication.TokenAuthentication]
+  permission_classes = [permissions.IsAuthenticated, permissions.IsAdminUser]
+  throttle_scope = 'exports'
+
+  def get(self, request, *args, **kwargs):
+    serializer = ExportWatchData.InputSerializer(data = request.query_params)
+
+    if not serializer.is_valid():
+      return response.Response(serializer.errors, status = status.HTTP_400_BAD_REQUEST)
+
+    # only the indexed frames within the range are read, memory use does not depend on the range
+    data = serializer.validated_data
+    email = slc.get_user(id = data['pid']).email
+    if data['file_format'] == 'csv':
+      res = StreamingHttpResponse(storage.iter_raw(email, data['kind'], data['from_ts'], data['till_ts']), content_type = 'text/csv')
+    else:
+      res = StreamingHttpResponse(storage.iter_binary(email, data['kind'], data['from_ts'], data['till_ts']), content_type = 'application/octet-stream')
+      res['X-Channels'] = storage.get_channels(email, data['kind'], data['from_ts'], data['till_ts'])
+    res['Content-Disposition'] = f'attachment; filename="{data["pid"]}-{data["kind"]}.{data["file_format"]}"'
+    return res
+
+
+class SendEmaPushes(generics.CreateAPIView):
+
+  class InputSerializer(serializers.Serializer):
+    pids = serializers.ListField(child = serializers.IntegerField(), required = False, allow_empty = False)
+    all_active = serializers.BooleanField(default = False)
+
+    def validate(self, attrs):
+      if attrs['all_active'] == ('pids' in attrs):
+        raise ValidationError('Either pids or all_active must be provided!')
+      return attrs
+
+    class Meta:
+      fields = '__all__'
+
+  serializer_class = InputSerializer
+  authentication_classes = [authentication.TokenAuthentication]
+  permission_classes = [permissions.IsAuthenticated, permissions.IsAdminUser]
+
+  def post(self, request, *args, **kwargs):
+    serializer = SendEmaPushes.InputSerializer(data = request.data)
+
+    if not serializer.is_valid():
+      return response.Response(serializer.errors, status = status.HTTP_400_BAD_REQUEST)
+
+    job = svc.queue_ema_pushes(None if serializer.validated_data['all_active'] else serializer.validated_data['pids'])
+    return response.Response(dict(job_id = job.id), status = status.HTTP_202_ACCEPTED)
+
+
+class GetPushJob(generics.GenericAPIView):
+  authentication_classes = [authentication.TokenAuthentication]
+  permission_classes = [permissions.IsAuthenticated, permissions.IsAdminUser]
+
+  def get(self, request, job_id: int, *args, **kwargs):
+    job = slc.get_job(id = job_id, name = 'send_ema_pushes')
+    if not job:
+      return response.Response(status = status.HTTP_404_NOT_FOUND)
+
+    return response.Response(dict(
+      job_id = job.id,
+      status = job.status,
+      attempts = job.attempts,
+      created_ts = job.created_ts,
+      finished_ts = job.finished_ts,
+      outcomes = job.result,
+    ), status = status.HTTP_200_OK)
+
+
 class SendEmaPush(generics.CreateAPIView):
 
   class InputSerializer(serializers.Serializer):
@@ -314,26 +479,20 @@ class SendEmaPush(generics.CreateAPIView):
   permission_classes = [permissions.IsAuthenticated, permissions.IsAdminUser]
 
   def post(self, request, *args, **kwargs):
+    from firebase_admin.exceptions import InvalidArgumentError   # imported on first use, as in api.push
+
     serializer = SendEmaPush.InputSerializer(data = request.data)
 
     if not serializer.is_valid():
       return response.Response(serializer.errors, status = status.HTTP_400_BAD_REQUEST)
 
-    try:
-      messaging.send(
-        message = messaging.Message(
-          android = messaging.AndroidConfig(
-            priority = 'high',
-            notification = messaging.AndroidNotification(
-              title = "Stress report time!",
-              body = "Please log your current situation and stress levels.",
-              channel_id = 'sosw.app.push',
-            ),
-          ),
-          token = slc.get_fcm_token(id = serializer.validated_data['pid']),
-        ),
-        app = firebase_app,
-      )
-      return response.Response(status = status.HTTP_200_OK)
-    except InvalidArgumentError:
+    pid = serializer.validated_data['pid']
+    sent_ts, latencies = int(dt.now().timestamp()*1000), dict()
+    error = push.send_ema_pushes({pid: slc.get_fcm_token(id = pid)}, latencies)[pid]
+    svc.create_push_deliveries('manual', {pid: sent_ts}, sent_ts, {pid: error}, latencies)
+    if isinstance(error, InvalidArgumentError):
       return response.Response(status = status.HTTP_400_BAD_REQUEST)
+    if error and push.is_transient(error):
+      return response.Response(status = status.HTTP_503_SERVICE_UNAVAILABLE)
+    if error: raise error
+    return response.Response(status = status.HTTP_200_OK)
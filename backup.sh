@@ -1 +1,2 @@
-env GZIP=-9 tar cvzf sosw_data.tar.gz sosw_data
+# raw segments are gzip-compressed already, columnar segments are rebuilt with `manage.py rebuild_watch_segments`
+tar cvf sosw_data.tar --exclude='segments' sosw_data
@@ -0,0 +1,18 @@
+"""
+ASGI config of the ingestion app (api endpoints only, see dashboard.ingestion_asgi_settings).
+
+It exposes the ASGI callable as a module-level variable named ``application``,
+served by gunicorn with uvicorn workers (GUNICORN_WORKER_CLASS=uvicorn_worker.UvicornWorker).
+"""
+
+import os
+
+from django.core.asgi import get_asgi_application
+
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'dashboard.ingestion_asgi_settings')
+
+application = get_asgi_application()
+
+# loads the url patterns (and views) at startup instead of on the first request, before fork with preload_app
+from django.urls import get_resolver   # noqa: E402
+get_resolver().url_patterns
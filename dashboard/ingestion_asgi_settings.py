@@ -0,0 +1,19 @@
+"""
+Django settings of the ASGI ingestion app: the api endpoints, file uploads served by async views.
+Exports are not routed here, they are streamed by the dashboard pool (see api.async_urls).
+
+A slow upload then waits in the event loop instead of holding a worker thread (see dashboard.ingestion_asgi).
+"""
+
+from dashboard.ingestion_settings import *  # noqa: F401,F403
+
+ROOT_URLCONF = 'dashboard.ingestion_asgi_urls'
+ASGI_APPLICATION = 'dashboard.ingestion_asgi.application'
+
+# under ASGI, every hook of a (sync-style) middleware is a hop to a worker thread: the api views authenticate by token
+# and need neither sessions, messages nor csrf (the admin that does is not routed here)
+MIDDLEWARE = [   # async capable
+  'dashboard.loadshedding.load_shedding_middleware',
+  'api.throttling.batch_hint_middleware',
+]
+SILENCED_SYSTEM_CHECKS = ['admin.E408', 'admin.E409', 'admin.E410']
@@ -0,0 +1,11 @@
+"""
+Django settings of the ingestion app: the api endpoints only (smartphone and smartwatch uploads).
+
+The dashboard (pages, admin, DQ plots) is served by a separate pool with dashboard.settings,
+so a heavy render never holds a worker that a sensor upload is waiting for.
+"""
+
+from dashboard.settings import *  # noqa: F401,F403
+
+ROOT_URLCONF = 'dashboard.ingestion_urls'
+WSGI_APPLICATION = 'dashboard.ingestion_wsgi.application'
@@ -0,0 +1,6 @@
+from django.urls import path
+from django.urls import include
+
+urlpatterns = [
+  path('api/', include('api.urls')),
+]
@@ -0,0 +1,17 @@
+"""
+WSGI config of the ingestion app (api endpoints only, see dashboard.ingestion_settings).
+
+It exposes the WSGI callable as a module-level variable named ``application``.
+"""
+
+import os
+
+from django.core.wsgi import get_wsgi_application
+
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'dashboard.ingestion_settings')
+
+application = get_wsgi_application()
+
+# loads the url patterns (and views) at startup instead of on the first request, before fork with preload_app
+from django.urls import get_resolver   # noqa: E402
+get_resolver().url_patterns
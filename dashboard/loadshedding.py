@@ -0,0 +1,140 @@
+"""
+Load shedding of a worker process: when requests pile up or database queries slow down,
+low-priority requests get 503 (with Retry-After) right away, so the ones that matter keep being served.
+
+Dashboard pages and bulk exports are shed first, sensor ingestion next, sign-in last.
+"""
+
+from typing import Optional
+from collections import deque
+from os import environ
+import threading
+import time
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.db.backends.signals import connection_created
+from django.http import JsonResponse
+from django.urls import Resolver404, resolve
+from django.utils.decorators import sync_and_async_middleware
+
+from rest_framework import status
+
+# a sync worker has at most one request in flight and a gthread worker at most GUNICORN_THREADS, the others wait unseen in
+# gunicorn's backlog: the limit is set for ASGI workers (or gthread ones, below their threads), the database signal applies to all
+MAX_IN_FLIGHT = int(environ.get('SHED_MAX_IN_FLIGHT', 0))   # requests of a worker process being processed at once, 0: no limit
+DB_P95_LIMIT_MS = float(environ.get('SHED_DB_P95_MS', 500))   # p95 of database query times
+DB_WINDOW = 10   # seconds of queries in the rolling p95
+DB_MIN_SAMPLES = 20   # fewer queries in the window: no latency signal
+DB_MAX_SAMPLES = 2000
+DB_P95_INTERVAL = 1   # seconds, the p95 is re-computed at most this often
+RETRY_AFTER = 10   # seconds
+
+# priorities: a request is shed once the load (1.0: a limit reached) is at its level
+BULK, INGESTION, AUTH = 'bulk', 'ingestion', 'auth'
+SHED_AT = {BULK: 1.0, INGESTION: 1.5, AUTH: 2.0}
+AUTH_URLS = {'signInApi', 'signUpApi'}
+BULK_URLS = {'exportWatchDataApi', 'sendEMAPushApi', 'sendEMAPushesApi', 'pushJobApi'}
+
+
+class LoadMonitor:
+  """ Load signals of a worker process: requests in flight and a rolling p95 of database query times """
+
+  def __init__(self, clock = time.monotonic):
+    self.clock = clock
+    self.in_flight = 0
+    self.queries = deque(maxlen = DB_MAX_SAMPLES)   # (timestamp, milliseconds)
+    self.lock = threading.Lock()
+    self.db_p95_ms = 0.0
+    self.computed_at = float('-inf')
+
+  def start(self):
+    with self.lock:
+      self.in_flight += 1
+
+  def finish(self):
+    with self.lock:
+      self.in_flight -= 1
+
+  def record_query(self, ms: float):
+    self.queries.append((self.clock(), ms))   # thread-safe, the oldest sample drops out
+
+  def get_db_p95(self) -> float:
+    now = self.clock()
+    if now - self.computed_at >= DB_P95_INTERVAL:
+      samples = sorted(ms for ts, ms in list(self.queries) if now - ts <= DB_WINDOW)
+      self.db_p95_ms = samples[int(0.95*(len(samples) - 1))] if len(samples) >= DB_MIN_SAMPLES else 0.0
+      self.computed_at = now
+    return self.db_p95_ms
+
+  def get_load(self) -> float:
+    """ The most exceeded signal relative to its limit, 1.0: a limit reached """
+
+    in_flight = self.in_flight/MAX_IN_FLIGHT if MAX_IN_FLIGHT else 0.0
+    return max(in_flight, self.get_db_p95()/DB_P95_LIMIT_MS)
+
+
+monitor = LoadMonitor()
+
+
+def time_query(execute, sql, params, many, context):
+  started = time.perf_counter()
+  try:
+    return execute(sql, params, many, context)
+  finally:
+    monitor.record_query((time.perf_counter() - started)*1000)
+
+
+def install_query_timer(sender, connection, **kwargs):
+  # every connection of the process (under ASGI, queries run in worker threads of their own)
+  connection.execute_wrappers.append(time_query)
+
+
+connection_created.connect(install_query_timer, dispatch_uid = 'dashboard.loadshedding')
+
+
+def get_priority(request) -> str:
+  try:
+    name = resolve(request.path_info, getattr(request, 'urlconf', None)).url_name or ''
+  except Resolver404:
+    return BULK
+  if name in AUTH_URLS: return AUTH
+  if name in BULK_URLS or not name.endswith('Api'): return BULK   # researcher tools and dashboard pages
+  return INGESTION
+
+
+def shed(request) -> Optional[JsonResponse]:
+  load = monitor.get_load()
+  if load < SHED_AT[BULK]: return None
+  priority = get_priority(request)
+  if load < SHED_AT[priority]: return None
+
+  res = JsonResponse(dict(detail = 'The server is overloaded, please retry later.'), status = status.HTTP_503_SERVICE_UNAVAILABLE)
+  res['Retry-After'] = str(RETRY_AFTER)
+  return res
+
+
+@sync_and_async_middleware
+def load_shedding_middleware(get_response):
+  """ Counts requests in flight (a signal of ASGI and gthread workers only) and sheds them by priority under load; goes first, before any other middleware does work """
+
+  # a streamed response (e.g., an export) leaves the count when it is returned, not when it is sent
+  if iscoroutinefunction(get_response):
+    async def middleware(request):
+      monitor.start()
+      try:
+        res = shed(request)
+        return res if res is not None else await get_response(request)
+      finally:
+        monitor.finish()
+
+    markcoroutinefunction(middleware)
+  else:
+    def middleware(request):
+      monitor.start()
+      try:
+        res = shed(request)
+        return res if res is not None else get_response(request)
+      finally:
+        monitor.finish()
+
+  return middleware
@@ -48,6 +48,7 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+  'dashboard.loadshedding.load_shedding_middleware',   # first: a shed request costs nothing else
   'django.middleware.security.SecurityMiddleware',
   'django.contrib.sessions.middleware.SessionMiddleware',
   'django.middleware.common.CommonMiddleware',
@@ -55,6 +56,7 @@ MIDDLEWARE = [
   'django.contrib.auth.middleware.AuthenticationMiddleware',
   'django.contrib.messages.middleware.MessageMiddleware',
   'django.middleware.clickjacking.XFrameOptionsMiddleware',
+  'api.throttling.batch_hint_middleware',
 ]
 
 ROOT_URLCONF = 'dashboard.urls'
@@ -131,6 +133,10 @@ REST_FRAMEWORK = {
    # 'rest_framework.authentication.TokenAuthentication',
    # 'rest_framework.authentication.SessionAuthentication',
   ],
+   # token buckets of views with a throttle_scope (see api.throttling)
+  'DEFAULT_THROTTLE_CLASSES': [
+    'api.throttling.TokenBucketThrottle',
+  ],
 }
 LOGIN_URL = 'rest_framework:login'
 LOGOUT_URL = 'rest_framework:logout'
@@ -4,16 +4,11 @@ from django.shortcuts import render
 
 from rest_framework.authtoken.models import Token
 
-from os.path import exists
-from os import environ
-
 from api import selectors as slc
-from plotly.subplots import make_subplots
-import plotly.graph_objects as go
+from api import storage
 from datetime import datetime as dt
 from datetime import timedelta as td
 from dateutil import tz
-import plotly
 from collections import defaultdict
 from bisect import bisect_left as bleft
 from bisect import bisect_right as bright
@@ -22,12 +17,19 @@ from bisect import bisect_right as bright
 @login_required
 @user_passes_test(lambda u: u.is_superuser)
 def handle_index(request):
+  # push compliance and latencies of the last week, precomputed by the jobs worker
+  week_ago = dt.now().replace(hour = 0, minute = 0, second = 0, microsecond = 0) - td(days = 6)
+  metrics = slc.get_response_metrics(int(week_ago.timestamp()*1000))
+  users = sorted(slc.get_users(), key = lambda x: x.id)
+  for user in users:
+    user.metrics = metrics.get(user.id)
+
   return render(
     request = request,
     template_name = 'index.html',
     context = dict(
       title = '',
-      users = sorted(slc.get_users(), key = lambda x: x.id),
+      users = users,
       token = Token.objects.get(user = request.user).key,
     ),
   )
@@ -36,6 +38,11 @@ def handle_index(request):
 @login_required
 @user_passes_test(lambda u: u.is_superuser)
 def handle_dq_plot(request):
+  # plotly is imported on first use: workers serving the api only never load it
+  from plotly.subplots import make_subplots
+  import plotly.graph_objects as go
+  import plotly.offline
+
   users = list()
   if 'pid' in request.GET and slc.user_exists(id = request.GET['pid']):
     user = slc.get_user(id = int(request.GET['pid']))
@@ -81,11 +88,10 @@ def handle_dq_plot(request):
     )
     fig.add_trace(go.Bar(x = timestamps, y = calendarevent_counts, name = 'CalendarEvent'), row = 7, col = 1)
 
-  def add_smartwatch_dq_plots(fig, ppg_timestamps, acc_timestamps, offbody_timestamps, timestamps, delta):
+  def add_smartwatch_dq_plots(fig, ppg_timestamps, acc_timestamps, offbody_counts, timestamps, delta):
     # amounts
     ppg_amounts = defaultdict(int)
     acc_amounts = defaultdict(int)
-    offbody_amounts = defaultdict(int)
 
     # compute amount of samples
     for ts in timestamps:
@@ -100,14 +106,10 @@ def handle_dq_plot(request):
       j = bright(acc_timestamps, till_ts)
       acc_amounts[ts] += j - i
 
-      i = bleft(offbody_timestamps, from_ts)
-      j = bright(offbody_timestamps, till_ts)
-      offbody_amounts[ts] += j - i
-
     # re-organize amount of samples
     ppg_amounts = [ppg_amounts[d] for d in timestamps]
     acc_amounts = [acc_amounts[d] for d in timestamps]
-    offbody_amounts = [offbody_amounts[d] for d in timestamps]
+    offbody_amounts = [offbody_counts.get(int(d.timestamp()*1000), 0) for d in timestamps]
 
     # make dq figures
     fig.add_trace(go.Bar(x = timestamps, y = ppg_amounts, name = 'PPG'), row = 8, col = 1)
@@ -140,42 +142,13 @@ def handle_dq_plot(request):
       ],
     )
 
-    # file paths
-    ppg_path = f'{environ["DATA_DUMP_DIR"]}/{user.email}/ppg.csv'
-    acc_path = f'{environ["DATA_DUMP_DIR"]}/{user.email}/acc.csv'
-    offbody_path = f'{environ["DATA_DUMP_DIR"]}/{user.email}/offbody.csv'
-
-    # read smartwatch data files
-    if exists(ppg_path):
-      with open(ppg_path, 'r') as r:
-        ppg_timestamps = list()
-        for l in r:
-          ts = l[:l.index(',')]
-          if ts.isdigit(): ppg_timestamps.append(int(ts))
-        ppg_timestamps.sort()
-        if ppg_timestamps: from_ts = min(from_ts, ppg_timestamps[0])
-    else:
-      ppg_timestamps = list()
-    if exists(acc_path):
-      with open(acc_path, 'r') as r:
-        acc_timestamps = list()
-        for l in r:
-          ts = l[:l.index(',')]
-          if ts.isdigit(): acc_timestamps.append(int(ts))
-        acc_timestamps.sort()
-        if acc_timestamps: from_ts = min(from_ts, acc_timestamps[0])
-    else:
-      acc_timestamps = list()
-    if exists(offbody_path):
-      with open(offbody_path, 'r') as r:
-        offbody_timestamps = list()
-        for l in r:
-          ts = l[:l.index(',')]
-          if ts.isdigit(): offbody_timestamps.append(int(ts))
-        offbody_timestamps.sort()
-        if offbody_timestamps: from_ts = min(from_ts, offbody_timestamps[0])
-    else:
-      offbody_timestamps = list()
+    # read smartwatch data (columnar segments, already sorted; off-body counts per hour from the database)
+    ppg_timestamps = storage.read_timestamps(user.email, 'ppg')
+    acc_timestamps = storage.read_timestamps(user.email, 'acc')
+    offbody_counts = slc.get_offbody_hourly_counts(user)
+    for x in [ppg_timestamps, acc_timestamps]:
+      if len(x) > 0: from_ts = min(from_ts, int(x[0]))
+    if offbody_counts: from_ts = min(from_ts, min(offbody_counts))
 
     # make common timestamps for subplots for a selected day
     tz_korea = tz.gettz('Asia/Seoul')
@@ -200,7 +173,7 @@ def handle_dq_plot(request):
     if night_start is not None: night_periods.append([night_start, timestamps[-1]])
 
     add_smartphone_dq_plots(fig, user, timestamps, td(hours = 1))
-    add_smartwatch_dq_plots(fig, ppg_timestamps, acc_timestamps, offbody_timestamps, timestamps, td(hours = 1))
+    add_smartwatch_dq_plots(fig, ppg_timestamps, acc_timestamps, offbody_counts, timestamps, td(hours = 1))
 
     fig.update_layout(height = 1000, showlegend = False)
     for annotation in fig['layout']['annotations']:
@@ -14,3 +14,7 @@ from django.core.wsgi import get_wsgi_application
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'dashboard.settings')
 
 application = get_wsgi_application()
+
+# loads the url patterns (and views) at startup instead of on the first request, before fork with preload_app
+from django.urls import get_resolver   # noqa: E402
+get_resolver().url_patterns
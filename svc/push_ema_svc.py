@@ -3,35 +3,52 @@ import os, django
 os.environ.setdefault("DJANGO_SETTINGS_MODULE", "dashboard.settings")
 django.setup()
 
-import firebase_admin
 from firebase_admin import messaging
 from firebase_admin import exceptions
 from random import randint
-import threading
-import time
 from datetime import datetime
 from datetime import timedelta
 from requests.exceptions import HTTPError
-from typing import List
+from typing import Dict, Iterable, List, Optional, Set
+from contextlib import redirect_stdout
+import threading
+import resource
+import argparse
+import random
+import signal
+import time
+import sys
+
+from django.db import transaction
+from django.db.models import F, Q
+import numpy as np
 
 from api import models as mdl
-from api.views import firebase_app
 from api import services as svc
+from api import selectors as slc
+from api import push
+from api import events
+from svc.scheduler import Scheduler, VirtualClock
+from svc import sharding
 
 NOTIFICATIONS_PER_DAY = 12
 NOTIFICATION_HOUR_RANGE = {'from': 9, 'till': 21}
 NOTIFICATION_DELAY_RANGE = {'min': 40, 'max': 80}
-
-# Firebase sdk
-if not firebase_admin._apps:
-  cred = firebase_admin.credentials.Certificate('fcm_secret.json')
-  firebase_app = firebase_admin.initialize_app(credential = cred)
+POLL_INTERVAL = 60   # seconds, looking for new participants without database notifications (e.g., SQLite)
+SWEEP_INTERVAL = 60*60   # seconds, a safety net when new participants are notified
+LISTEN_TIMEOUT = 30   # seconds
+RECONNECT_DELAY = 10   # seconds
+PLANNING_BATCH = 1000   # participants planned with one query
+MISSED_AFTER = 10*60   # seconds, older notifications are not sent late after a restart
+SENDING_STALE = 5*60   # seconds, a notification still being sent after it was claimed by a crashed instance
+RECOVER_INTERVAL = 60   # seconds between looking for stale notifications
+SIMULATED_PREFIX = 'sim-'   # usernames of synthetic participants (see simulate)
 
 
-def get_daily_notification_timings() -> List[datetime]:
+def get_daily_notification_timings(now: Optional[datetime] = None) -> List[datetime]:
   ans: List[datetime] = list()
 
-  dt = datetime.now()
+  dt = now or datetime.now()
   if dt.hour <= NOTIFICATION_HOUR_RANGE['from']:
     dt = dt.replace(hour = max(dt.hour, NOTIFICATION_HOUR_RANGE['from']), minute = 0, second = 0, microsecond = 0)
 
@@ -43,72 +60,284 @@ def get_daily_notification_timings() -> List[datetime]:
   return ans
 
 
-def send_push_notification(user: mdl.User) -> bool:
-  if user.fcm_token is None:
-    print(user.full_name, 'empty fcm_token')
-    return
+class Planner:
+  """ Plans daily notifications of participants (persisted, so a restart resumes the plan) on the scheduler """
 
-  try:
-    messaging.send(
-      message = messaging.Message(
-        android = messaging.AndroidConfig(
-          priority = 'high',
-          notification = messaging.AndroidNotification(
-            title = "Stress report time!",
-            body = "Please log your current situation and stress levels.",
-            channel_id = 'sosw.app.push',
-          ),
-        ),
-        token = user.fcm_token,
-      ),
-      app = firebase_app,
-    )
-    return True
-  except messaging.UnregisteredError:
-    user.fcm_token = None
-    user.save()
-    return False
-  except exceptions.UnavailableError:
-    print('FCM service is temporarily unavailable')
-    user.fcm_token = None
-    user.save()
-    return False
-  except exceptions.FirebaseError:
-    user.fcm_token = None
-    user.save()
-    return False
+  def __init__(self, scheduler: Scheduler, interval: float = POLL_INTERVAL, participants: Optional[dict] = None):
+    self.scheduler = scheduler
+    self.interval = interval   # seconds between planning rounds
+    self.participants = participants or dict()   # user filter (e.g., synthetic participants of a simulation), empty: all
+    self.planned: Set[int] = set()
+    self.entries: Dict[int, List[list]] = dict()   # scheduled notifications per participant
+    self.shards: Optional[Set[int]] = None   # participants of other push service instances are skipped, None: all
+    self.due: List[int] = list()
+    self.attempts: Dict[int, int] = dict()   # failed attempts of notifications being retried
+    self.breaker = push.CircuitBreaker(clock = scheduler.clock)
+    self.day = self.now().day
 
+  def now(self) -> datetime:
+    return datetime.fromtimestamp(self.scheduler.clock())
 
-def init():
-  day = datetime.now().day
-  threads = set()
+  def start_day(self):
+    if self.day != self.now().day:
+      self.day = self.now().day
+      self.planned.clear()
+      self.entries.clear()
+
+  def owns(self, user_id: int) -> bool:
+    return self.shards is None or sharding.get_shard(user_id) in self.shards
+
+  def plan(self):
+    """ Plans today's notifications of participants that have no plan yet, then re-schedules itself """
+
+    self.plan_unplanned()
+    self.scheduler.schedule(self.scheduler.clock() + self.interval, self.plan)
+
+  def plan_unplanned(self):
+    self.start_day()
+    # only participants without a plan are loaded, not the whole user table
+    users = mdl.User.objects.filter(**self.participants).exclude(fcm_token__isnull = True).exclude(fcm_token = '').exclude(id__in = self.planned)
+    if self.shards is not None:
+      users = users.annotate(shard = F('id')%sharding.NUM_SHARDS).filter(shard__in = list(self.shards))
+    users = list(users)
+    for i in range(0, len(users), PLANNING_BATCH):
+      self.plan_users(users[i:i + PLANNING_BATCH])
+
+  def recover(self):
+    """ Puts notifications of own participants left as being sent (a crash while sending) back on the schedule, then re-schedules itself """
+
+    now = self.scheduler.clock()
+    stale = mdl.EmaSchedule.objects.filter(Q(claimed_ts__lt = int((now - SENDING_STALE)*1000)) | Q(claimed_ts__isnull = True), status = 'sending')
+    stale = stale.filter(**{f'user__{x}': y for x, y in self.participants.items()})
+    if self.shards is not None:
+      stale = stale.annotate(shard = F('user_id')%sharding.NUM_SHARDS).filter(shard__in = list(self.shards))
+    missed = list()
+    for schedule in svc.release_ema_schedules(stale.values_list('id', flat = True)):
+      if schedule.user_id not in self.planned: continue   # resumed (or found missed) once the participant is planned
+      if schedule.planned_ts/1000 < now - MISSED_AFTER:
+        missed.append(schedule.id)
+        continue
+      self.entries.setdefault(schedule.user_id, list()).append(self.scheduler.schedule(now, self.send, schedule.id))
+    svc.update_ema_schedules(missed, 'missed')
+    self.scheduler.schedule(now + RECOVER_INTERVAL, self.recover)
+
+  def plan_participant(self, user_id: int):
+    """ Plans notifications of a participant that just signed up or set the fcm token """
+
+    self.start_day()
+    if user_id in self.planned or not self.owns(user_id): return
+    user = mdl.User.objects.filter(id = user_id, **self.participants).first()
+    if user and user.fcm_token: self.plan_users([user])
+
+  def release(self, shards: Iterable[int]):
+    """ Forgets participants of shards taken over by another push service instance """
+
+    shards = set(shards)
+    for user_id in [x for x in self.planned if sharding.get_shard(x) in shards]:
+      for entry in self.entries.pop(user_id, []):
+        self.scheduler.cancel(entry)
+      self.planned.discard(user_id)
+
+  def plan_users(self, users: List[mdl.User]):
+    # a plan stored earlier today (e.g., before a restart) is resumed instead of re-planned
+    day = self.now().replace(hour = 0, minute = 0, second = 0, microsecond = 0)
+    schedules: Dict[int, List[mdl.EmaSchedule]] = {x.id: list() for x in users}
+    for schedule in slc.get_users_ema_schedules(list(schedules), int(day.timestamp()*1000), int((day + timedelta(days = 1)).timestamp()*1000) - 1):
+      schedules[schedule.user_id].append(schedule)
+
+    timings = {x.id: get_daily_notification_timings(self.now()) for x in users if not schedules[x.id]}
+    for schedule in svc.create_ema_schedules_bulk({x: [int(y.timestamp()*1000) for y in ts] for x, ts in timings.items()}):
+      schedules[schedule.user_id].append(schedule)
+    for user_id, ts in timings.items():
+      if len(ts) == 1:
+        print(f'EMA for participant({user_id}): {ts[0].strftime("%m/%d %H:%M")}')
+      elif len(ts) > 1:
+        print(f'EMA for participant({user_id}): {ts[0].strftime("%m/%d %H:%M")}', ", ".join([x.strftime("%H:%M") for x in ts[1:]]))
+
+    # one heap entry per notification, all sent from the scheduler thread
+    missed = list()
+    for user_id, user_schedules in schedules.items():
+      entries = self.entries.setdefault(user_id, list())
+      for schedule in user_schedules:
+        if schedule.status != 'pending': continue
+        if schedule.planned_ts/1000 < self.scheduler.clock() - MISSED_AFTER:
+          missed.append(schedule.id)
+          continue
+        entries.append(self.scheduler.schedule(schedule.planned_ts/1000, self.send, schedule.id))
+      self.planned.add(user_id)
+    svc.update_ema_schedules(missed, 'missed')
+
+  def send(self, schedule_id: int):
+    """ Queues a due notification: notifications due at the same time are sent as one batch """
+
+    if not self.due: self.scheduler.schedule(self.scheduler.clock(), self.flush)   # runs after the co-due entries
+    self.due.append(schedule_id)
 
+  def flush(self) -> int:
+    """ Sends queued notifications, returns the number of delivered ones """
+
+    schedule_ids, self.due = self.due, list()
+    if not self.breaker.allow():
+      # FCM is down: wait for the circuit breaker instead of hammering the service
+      for schedule_id in schedule_ids:
+        self.scheduler.schedule(self.breaker.retry_at, self.send, schedule_id)
+      return 0
+
+    claimed = svc.claim_ema_schedules(schedule_ids, int(self.scheduler.clock()*1000))
+    schedules = mdl.EmaSchedule.objects.select_related('user').filter(id__in = claimed)
+    for schedule in schedules:
+      if not schedule.user.fcm_token: print(schedule.user.full_name, 'empty fcm_token')
+
+    # the tokens are read at sending time: they may have changed since planning
+    tokens = {x.user.id: x.user.fcm_token for x in schedules if x.user.fcm_token}
+    sent_ts, latencies = int(self.scheduler.clock()*1000), dict()
+    try:
+      errors = push.send_ema_pushes(tokens, latencies)
+    except exceptions.FirebaseError as e:
+      errors = {x: e for x in tokens}
+    svc.create_push_deliveries('scheduled', {x.user.id: x.planned_ts for x in schedules}, sent_ts, errors, latencies)
+    if tokens and all(x and push.is_transient(x) for x in errors.values()):
+      print('FCM service is temporarily unavailable')
+      self.breaker.record_failure()
+    elif tokens:
+      self.breaker.record_success()
+
+    # only an uninstalled app invalidates a token, other errors leave participants enrolled
+    svc.clear_fcm_tokens(x for x, error in errors.items() if isinstance(error, messaging.UnregisteredError))
+    sent = set(x.id for x in schedules if x.user.id in errors and not errors[x.user.id])
+    retried = set()
+    for schedule in schedules:
+      error = errors.get(schedule.user.id)
+      if error and push.is_transient(error) and self.attempts.get(schedule.id, 0) < push.RETRY_MAX_ATTEMPTS:
+        self.attempts[schedule.id] = self.attempts.get(schedule.id, 0) + 1
+        self.scheduler.schedule(self.scheduler.clock() + push.get_retry_delay(self.attempts[schedule.id]), self.send, schedule.id)
+        retried.add(schedule.id)
+      else:
+        self.attempts.pop(schedule.id, None)
+    svc.update_ema_schedules(sent, 'sent', sent_ts)
+    svc.update_ema_schedules(retried, 'pending')
+    svc.update_ema_schedules([x.id for x in schedules if x.id not in sent and x.id not in retried], 'failed')
+    return len(sent)
+
+
+def listen(planner: Planner):
+  """ Forwards participant notifications (LISTEN/NOTIFY) to the scheduler thread, reconnects after errors """
+
+  scheduler = planner.scheduler
   while True:
-    for user in mdl.User.objects.exclude(fcm_token__isnull = True):
-      if user not in threads and user.fcm_token:
-        timings = get_daily_notification_timings()
-
-        for dt in timings:
-          threading.Timer(
-            interval = (dt - datetime.now()).total_seconds(),
-            function = send_push_notification,
-            args = [user],
-          ).start()
-
-        if len(timings) == 1:
-          print(f'EMA for participant({user.full_name}): {timings[0].strftime("%m/%d %H:%M")}')
-        elif len(timings) > 1:
-          print(
-            f'EMA for participant({user.id}): {timings[0].strftime("%m/%d %H:%M")}',
-            ", ".join([x.strftime("%H:%M") for x in timings[1:]]),
-          )
-        threads.add(user)
-
-    time.sleep(20*60)
-    if day != datetime.now().day:
-      day = datetime.now().day
-      threads.clear()
+    try:
+      listener = events.Listener()
+    except Exception as e:
+      print(f'Listening for participants failed: {e!r}')
+      time.sleep(RECONNECT_DELAY)
+      continue
+
+    # notifications are not queued while disconnected, participants that joined meanwhile are looked up
+    scheduler.schedule(scheduler.clock(), planner.plan_unplanned)
+    try:
+      while True:
+        for user_id in listener.wait(LISTEN_TIMEOUT):
+          scheduler.schedule(scheduler.clock(), planner.plan_participant, user_id)
+    except Exception as e:
+      print(f'Listening for participants failed: {e!r}')
+      listener.close()
+
+
+def init():
+  scheduler = Scheduler()
+  if events.is_supported():
+    planner = Planner(scheduler, interval = SWEEP_INTERVAL)
+    threading.Thread(target = listen, args = (planner,), daemon = True).start()
+  else:
+    planner = Planner(scheduler, interval = POLL_INTERVAL)
+
+  # instances split participants by shards, the first heartbeat takes shards before the first planning round
+  coordinator = sharding.Coordinator(scheduler, planner)
+  scheduler.schedule(scheduler.clock(), coordinator.beat)
+  scheduler.schedule(scheduler.clock(), planner.plan)
+  scheduler.schedule(scheduler.clock(), planner.recover)
+  signal.signal(signal.SIGTERM, lambda *_: scheduler.stop())   # e.g., docker stop
+  try:
+    scheduler.run_forever()
+  finally:
+    coordinator.stop()
+
+
+def simulate(participants: int, days: int, latency: float = 0.05, unregistered: float = 0.0, seed: int = 0) -> dict:
+  """ Replays days of the service for synthetic participants on a virtual clock and a fake FCM backend, nothing is stored """
+
+  random.seed(seed)
+  start = (datetime.now() + timedelta(days = 1)).replace(hour = 0, minute = 0, second = 0, microsecond = 0).timestamp()
+  clock = VirtualClock(start, busy = True)
+  scheduler = Scheduler(clock = clock)
+  # only the synthetic participants: real ones (on a live database) are neither planned nor locked by the run
+  synthetic = dict(username__startswith = SIMULATED_PREFIX, email__endswith = '@sim')
+  planner = Planner(scheduler, interval = SWEEP_INTERVAL, participants = synthetic)   # as with PostgreSQL notifications
+  tokens = [f'sim-token-{i}' for i in range(participants)]
+  backend, push.backend = push.backend, push.FakeMessaging(
+    unregistered = set(random.sample(tokens, int(participants*unregistered))),
+    latency = latency,   # virtual seconds: later notifications of a busy instant are sent late
+    sleep = clock.advance,
+  )
+
+  ticks, threads, entries = list(), threading.active_count(), 0
+  try:
+    with transaction.atomic(), open(os.devnull, 'w') as devnull, redirect_stdout(devnull):
+      mdl.User.objects.bulk_create([
+        mdl.User(username = f'{SIMULATED_PREFIX}{i}', email = f'{SIMULATED_PREFIX}{i}@sim', full_name = f'sim {i}', gender = 'M', date_of_birth = '2000-01-01', fcm_token = x)
+        for i, x in enumerate(tokens)
+      ], batch_size = 5000)
+
+      # instead of waiting, the clock jumps to the next due callback
+      started = time.perf_counter()
+      scheduler.schedule(clock(), planner.plan)
+      while scheduler.next_due() is not None and scheduler.next_due() < start + days*24*60*60:
+        clock.advance_to(scheduler.next_due())
+        tick = time.perf_counter()
+        scheduler.run_pending()
+        ticks.append(time.perf_counter() - tick)
+        threads, entries = max(threads, threading.active_count()), max(entries, len(scheduler))
+      wall = time.perf_counter() - started
+
+      deliveries = mdl.PushDelivery.objects.filter(source = 'scheduled', user__username__startswith = SIMULATED_PREFIX)
+      lags = np.array(deliveries.values_list('planned_ts', 'sent_ts'), dtype = np.int64).reshape(-1, 2)
+      lags = (lags[:, 1] - lags[:, 0])/1000
+      sent = deliveries.filter(outcome = 'sent').count()
+      transaction.set_rollback(True)
+  finally:
+    requests, push.backend = push.backend.requests, backend
+  memory = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss*(1 if sys.platform == 'darwin' else 1024)   # bytes on macOS, KiB on linux
+
+  ticks = np.array(ticks)*1000
+  return dict(
+    participants = participants,
+    days = days,
+    wall_seconds = round(wall, 2),
+    pushes = len(lags),
+    sent = sent,
+    fcm_requests = requests,
+    pushes_per_second = round(len(lags)/wall, 1) if wall else None,
+    jitter_p50_seconds = float(np.percentile(lags, 50)) if len(lags) else None,
+    jitter_p95_seconds = float(np.percentile(lags, 95)) if len(lags) else None,
+    jitter_max_seconds = float(lags.max()) if len(lags) else None,
+    tick_p95_ms = round(float(np.percentile(ticks, 95)), 2) if len(ticks) else None,
+    tick_max_ms = round(float(ticks.max()), 2) if len(ticks) else None,
+    max_scheduled = entries,
+    max_threads = threads,
+    peak_rss_mb = round(memory/2**20, 1),
+  )
 
 
 if __name__ == '__main__':
-  init()
+  parser = argparse.ArgumentParser(description = 'EMA push notification service')
+  parser.add_argument('--simulate', action = 'store_true', help = 'replay synthetic participants on a virtual clock and exit')
+  parser.add_argument('--participants', type = int, default = 5000)
+  parser.add_argument('--days', type = int, default = 3)
+  parser.add_argument('--latency', type = float, default = 0.05, help = 'simulated seconds per FCM request')
+  parser.add_argument('--unregistered', type = float, default = 0.0, help = 'fraction of participants that uninstalled the app')
+  args = parser.parse_args()
+
+  if not args.simulate: init()
+  else:
+    for key, value in simulate(args.participants, args.days, args.latency, args.unregistered).items():
+      print(f'{key}: {value}')
@@ -0,0 +1,96 @@
+from typing import Callable, List, Optional
+import itertools
+import threading
+import heapq
+import time
+
+
+class VirtualClock:
+  """ A clock that jumps over idle time (simulations replay days in seconds), busy time optionally runs in real time """
+
+  def __init__(self, now: float, busy: bool = False):
+    self.now = now
+    self.busy = busy   # time spent computing between jumps counts, e.g. database queries delay later callbacks
+    self._jumped = time.perf_counter()
+
+  def __call__(self) -> float:
+    return self.now + (time.perf_counter() - self._jumped if self.busy else 0)
+
+  def advance(self, seconds: float):
+    self.now += seconds
+
+  def advance_to(self, now: float):
+    self.now = max(self(), now)
+    self._jumped = time.perf_counter()
+
+
+class Scheduler:
+  """ Runs callbacks at planned times from a single thread, pending calls are kept in a heap """
+
+  def __init__(self, clock: Callable[[], float] = time.time):
+    self.clock = clock   # seconds, e.g. time.time or a virtual clock
+    self._heap: List[list] = list()
+    self._counter = itertools.count()   # ties run in scheduling order
+    self._condition = threading.Condition()
+    self._stopped = False
+    self._pending = 0   # entries not cancelled
+
+  def __len__(self) -> int:
+    return self._pending
+
+  def schedule(self, due: float, func: Callable, *args) -> list:
+    """ Plans func(*args) at due (clock seconds), returns an entry that can be cancelled """
+
+    entry = [due, next(self._counter), func, args]
+    with self._condition:
+      heapq.heappush(self._heap, entry)
+      self._pending += 1
+      self._condition.notify()   # the new entry may be due earlier than the one being waited for
+    return entry
+
+  def cancel(self, entry: list):
+    with self._condition:
+      if entry[2] is not None: self._pending -= 1
+      entry[2] = None   # removed lazily when it reaches the top of the heap
+
+  def next_due(self) -> Optional[float]:
+    with self._condition:
+      while self._heap and self._heap[0][2] is None:
+        heapq.heappop(self._heap)
+      return self._heap[0][0] if self._heap else None
+
+  def run_pending(self) -> int:
+    """ Runs all due callbacks, returns their number """
+
+    ans = 0
+    while True:
+      with self._condition:
+        if not self._heap or self._heap[0][0] > self.clock(): break
+        entry = heapq.heappop(self._heap)
+        _, _, func, args = entry
+        if func is not None:
+          entry[2] = None   # a later cancel() of a run entry is a no-op
+          self._pending -= 1
+      if func is None: continue
+
+      try:
+        func(*args)
+      except Exception as e:
+        print(f'Scheduled call {getattr(func, "__name__", func)} failed: {e!r}')
+      ans += 1
+    return ans
+
+  def run_forever(self):
+    """ Sleeps until the next due callback (or a newly scheduled one), until stopped """
+
+    while not self._stopped:
+      self.run_pending()
+      with self._condition:
+        if self._stopped: break
+        due = self._heap[0][0] if self._heap else None
+        self._condition.wait(timeout = None if due is None else max(due - self.clock(), 0))
+
+  def stop(self):
+    with self._condition:
+      self._stopped = True
+      self._condition.notify()
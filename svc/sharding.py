@@ -0,0 +1,128 @@
+from typing import Dict, Iterable, Optional, Set
+import hashlib
+import socket
+import os
+
+from django.db import connection
+
+from api import services as svc
+from api import selectors as slc
+from svc.scheduler import Scheduler
+
+NUM_SHARDS = 64   # participants are split by user id, shards move between instances as a whole
+HEARTBEAT_INTERVAL = 2   # seconds
+HEARTBEAT_TIMEOUT = 10   # seconds without a heartbeat: the instance is dead, survivors take over its shards
+FORGET_AFTER = 24*60*60   # seconds, heartbeat rows of dead instances are removed
+LOCK_NAMESPACE = 4042   # first key of the shards' advisory locks
+
+
+def get_shard(user_id: int) -> int:
+  return user_id%NUM_SHARDS
+
+
+def get_worker_name() -> str:
+  return f'{socket.gethostname()}-{os.getpid()}'
+
+
+def _weight(worker: str, shard: int) -> int:
+  # a stable hash (python's hash() is salted per process)
+  return int.from_bytes(hashlib.blake2b(f'{worker}/{shard}'.encode(), digest_size = 8).digest(), 'big')
+
+
+def assign_shards(workers: Iterable[str], worker: str) -> Set[int]:
+  """ Returns shards of a worker: rendezvous hashing, so a joining or leaving worker only moves its own share """
+
+  workers = list(workers)
+  if worker not in workers: return set()
+  return {x for x in range(NUM_SHARDS) if max(workers, key = lambda w: _weight(w, x)) == worker}
+
+
+class AdvisoryLocks:
+  """ Shard ownership as PostgreSQL session-level advisory locks, released by the database when an instance dies """
+
+  def held(self) -> Set[int]:
+    # asked every time: a lost connection loses the locks
+    with connection.cursor() as cursor:
+      cursor.execute(
+        "SELECT objid FROM pg_locks WHERE locktype = 'advisory' AND pid = pg_backend_pid() AND classid = %s AND objsubid = 2",
+        [LOCK_NAMESPACE],
+      )
+      return {int(x[0]) for x in cursor.fetchall()}
+
+  def acquire(self, shard: int) -> bool:
+    with connection.cursor() as cursor:
+      cursor.execute('SELECT pg_try_advisory_lock(%s, %s)', [LOCK_NAMESPACE, shard])
+      return cursor.fetchone()[0]
+
+  def release(self, shard: int):
+    with connection.cursor() as cursor:
+      cursor.execute('SELECT pg_advisory_unlock(%s, %s)', [LOCK_NAMESPACE, shard])
+
+  def close(self):
+    with connection.cursor() as cursor:
+      cursor.execute('SELECT pg_advisory_unlock_all()')
+
+
+class LocalLocks:
+  """ In-process stand-in of advisory locks (e.g., SQLite): ownership across processes then follows heartbeats only """
+
+  owners: Dict[int, str] = dict()
+
+  def __init__(self, name: str):
+    self.name = name
+
+  def held(self) -> Set[int]:
+    return {x for x, owner in self.owners.items() if owner == self.name}
+
+  def acquire(self, shard: int) -> bool:
+    return self.owners.setdefault(shard, self.name) == self.name
+
+  def release(self, shard: int):
+    if self.owners.get(shard) == self.name: del self.owners[shard]
+
+  def close(self):
+    for shard in self.held():
+      self.release(shard)
+
+
+class Coordinator:
+  """ Keeps the heartbeat of a push service instance and the shards it owns, tells the planner what it gained or lost """
+
+  def __init__(self, scheduler: Scheduler, planner, name: Optional[str] = None, locks = None):
+    self.scheduler = scheduler
+    self.planner = planner
+    self.name = name or get_worker_name()
+    self.locks = locks or (AdvisoryLocks() if connection.vendor == 'postgresql' else LocalLocks(self.name))
+    self.shards: Set[int] = set()
+    planner.shards = self.shards   # nothing is planned before the first heartbeat
+
+  def beat(self):
+    """ Records the heartbeat, takes over shards of dead instances and hands over shards of new ones, then re-schedules itself """
+
+    self.rebalance()
+    self.scheduler.schedule(self.scheduler.clock() + HEARTBEAT_INTERVAL, self.beat)
+
+  def rebalance(self):
+    now = int(self.scheduler.clock()*1000)
+    svc.beat_push_worker(self.name, now)
+    svc.remove_push_workers(before_ts = now - FORGET_AFTER*1000)
+    wanted = assign_shards(slc.get_live_push_workers(now - HEARTBEAT_TIMEOUT*1000), self.name)
+
+    held = self.locks.held()
+    for shard in held - wanted:
+      self.locks.release(shard)
+    # a shard still locked by its previous owner (not yet handed over) is tried again on the next heartbeat
+    held = (held & wanted) | {x for x in wanted - held if self.locks.acquire(x)}
+
+    lost, gained = self.shards - held, held - self.shards
+    self.shards.clear()
+    self.shards.update(held)
+    if lost: self.planner.release(lost)
+    if gained: self.planner.plan_unplanned()
+    if lost or gained: print(f'Push worker {self.name}: {len(held)} shards (+{len(gained)} -{len(lost)})')
+
+  def stop(self):
+    """ Hands the shards over right away (instead of after the heartbeat timeout) """
+
+    self.locks.close()
+    svc.remove_push_workers(names = [self.name])